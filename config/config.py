@@ -12,6 +12,8 @@ class OCRConfig(object):
     def __init__(self):
         self.prob_threshold = 0.4
         self.max_chunk_size = 16
+        # beam width of the 32px model, 1 is greedy decoding
+        self.beams_k = 5
         
 class TextRendererConfig(object):
     def __init__(self):
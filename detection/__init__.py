@@ -3,13 +3,18 @@ import torch
 import cv2
 from typing import List
 import numpy as np
-from utils import Quadrilateral
+from utils import Quadrilateral, QuadrilateralBatch, bilateral_filter_resized
 from .DBNet_resnet34 import TextDetection as TextDetectionDefault
 from . import imgproc, dbnet_utils, craft_utils
 import einops
 
 DEFAULT_MODEL = None
 
+# pages whose long side is more than this many times their short side are detected in windows at native scale
+STRIP_ASPECT_RATIO = 3
+# number of strip windows in one forward pass
+STRIP_BATCH_SIZE = 4
+
 def load_model(cuda: bool, model_name: str = 'default') :
 	global DEFAULT_MODEL
 	if model_name not in ['default'] :
@@ -23,23 +28,31 @@ def load_model(cuda: bool, model_name: str = 'default') :
 			model = model.cuda()
 		DEFAULT_MODEL = model
 
-async def run_default(img: np.ndarray, detect_size: int, cuda: bool, verbose: bool, args: dict) :
-	global DEFAULT_MODEL
-	img_resized, target_ratio, _, pad_w, pad_h = imgproc.resize_aspect_ratio(cv2.bilateralFilter(img, 17, 80, 80), detect_size, cv2.INTER_LINEAR, mag_ratio = 1)
+def preprocess_default(img: np.ndarray, detect_size: int, img_filtered: np.ndarray = None) :
+	"""
+	img_filtered is img bilateral filtered by bilateral_filter_resized at detect_size or larger, it is computed here if not given
+	"""
+	if img_filtered is None :
+		img_filtered = bilateral_filter_resized(img, detect_size)
+	img_resized, target_ratio, _, pad_w, pad_h = imgproc.resize_aspect_ratio(img_filtered, detect_size, cv2.INTER_LINEAR, mag_ratio = 1)
+	# ratio from img instead of img_filtered
+	target_ratio *= max(img_filtered.shape[: 2]) / max(img.shape[: 2])
+	return img_resized, target_ratio, pad_w, pad_h
+
+def padding_ratio(img_shape, pad_w: int, pad_h: int) -> float :
+	"""
+	Fraction of the network input that is padding
+	"""
+	return 1 - ((img_shape[0] - pad_h) * (img_shape[1] - pad_w)) / (img_shape[0] * img_shape[1])
+
+def postprocess_default(db: torch.Tensor, mask: np.ndarray, img_shape, target_ratio: float, pad_w: int, pad_h: int, args: dict) :
 	ratio_h = ratio_w = 1 / target_ratio
-	if verbose :
-		print(f'Detection resolution: {img_resized.shape[1]}x{img_resized.shape[0]}')
-	img_resized = img_resized.astype(np.float32) / 127.5 - 1.0
-	img = torch.from_numpy(img_resized)
-	if cuda :
-		img = img.cuda()
-	img = einops.rearrange(img, 'h w c -> 1 c h w')
-	with torch.no_grad() :
-		db, mask = DEFAULT_MODEL(img)
-		db = db.sigmoid().cpu()
-		mask = mask[0, 0, :, :].cpu().numpy()
+	# drop the bottom and right padding from both outputs, boxes are then clipped to the image instead of the padded input
+	h, w = img_shape[0] - pad_h, img_shape[1] - pad_w
+	db = db[:, :, : int(round(h * db.shape[2] / img_shape[0])), : int(round(w * db.shape[3] / img_shape[1]))]
+	mask = mask[: int(round(h * mask.shape[0] / img_shape[0])), : int(round(w * mask.shape[1] / img_shape[1]))]
 	det = dbnet_utils.SegDetectorRepresenter(args.text_threshold, args.box_threshold, unclip_ratio = args.unclip_ratio)
-	boxes, scores = det({'shape':[(img_resized.shape[0], img_resized.shape[1])]}, db)
+	boxes, scores = det({'shape':[(h, w)]}, db)
 	boxes, scores = boxes[0], scores[0]
 	if boxes.size == 0 :
 		polys = []
@@ -49,20 +62,189 @@ async def run_default(img: np.ndarray, detect_size: int, cuda: bool, verbose: bo
 		polys = polys.astype(np.float64)
 		polys = craft_utils.adjustResultCoordinates(polys, ratio_w, ratio_h, ratio_net = 1)
 		polys = polys.astype(np.int16)
-	textlines = [Quadrilateral(pts.astype(int), '', 0) for pts in polys]
-	textlines = list(filter(lambda q: q.area > 16, textlines))
-	mask_resized = cv2.resize(mask, (mask.shape[1] * 2, mask.shape[0] * 2), interpolation = cv2.INTER_LINEAR)
-	if pad_h > 0 :
-		mask_resized = mask_resized[:-pad_h, :]
-	elif pad_w > 0 :
-		mask_resized = mask_resized[:, : -pad_w]
+	textlines = QuadrilateralBatch(np.asarray(polys, dtype = int).reshape(-1, 4, 2))
+	textlines = textlines[textlines.area > 16].to_list()
+	mask_resized = cv2.resize(mask, (w, h), interpolation = cv2.INTER_LINEAR)
 	return textlines, np.clip(mask_resized * 255, 0, 255).astype(np.uint8)
 
-async def dispatch(img: np.ndarray, detect_size: int, cuda: bool, args: dict, model_name: str = 'default', verbose: bool = False) -> List[Quadrilateral] :
+async def run_default(img: np.ndarray, detect_size: int, cuda: bool, verbose: bool, args: dict, img_filtered: np.ndarray = None) :
+	global DEFAULT_MODEL
+	img_resized, target_ratio, pad_w, pad_h = preprocess_default(img, detect_size, img_filtered)
+	if verbose :
+		print(f'Detection resolution: {img_resized.shape[1]}x{img_resized.shape[0]}, {padding_ratio(img_resized.shape, pad_w, pad_h) * 100:.1f}% padding')
+	img_resized = img_resized.astype(np.float32) / 127.5 - 1.0
+	img = torch.from_numpy(img_resized)
+	if cuda :
+		img = img.cuda()
+	img = einops.rearrange(img, 'h w c -> 1 c h w')
+	with torch.no_grad() :
+		db, mask = DEFAULT_MODEL(img)
+		db = db.sigmoid().cpu()
+		mask = mask[0, 0, :, :].cpu().numpy()
+	return postprocess_default(db, mask, (img_resized.shape[0], img_resized.shape[1]), target_ratio, pad_w, pad_h, args)
+
+async def run_default_batch(imgs: List[np.ndarray], detect_size: int, cuda: bool, verbose: bool, args: dict, imgs_filtered: List[np.ndarray] = None) :
+	"""
+	Run images of the same padded shape through the network together, one forward pass per shape.
+	Padded shapes are multiples of 256 up to detect_size, so there are only a few of them and no image is padded beyond its own shape.
+	"""
+	if imgs_filtered is None :
+		imgs_filtered = [None] * len(imgs)
+	prepared = [preprocess_default(img, detect_size, img_filtered) for img, img_filtered in zip(imgs, imgs_filtered)]
+	buckets = {}
+	for i, (img_resized, _, _, _) in enumerate(prepared) :
+		buckets.setdefault(img_resized.shape[: 2], []).append(i)
+	results = [None] * len(imgs)
+	for (batch_h, batch_w), indices in buckets.items() :
+		if verbose :
+			padding = np.mean([padding_ratio((batch_h, batch_w), prepared[i][2], prepared[i][3]) for i in indices])
+			print(f'Detection resolution: {len(indices)}x{batch_w}x{batch_h}, {padding * 100:.1f}% padding')
+		batch = np.stack([prepared[i][0] for i in indices]).astype(np.float32) / 127.5 - 1.0
+		batch = torch.from_numpy(batch)
+		if cuda :
+			batch = batch.cuda()
+		batch = einops.rearrange(batch, 'n h w c -> n c h w')
+		with torch.no_grad() :
+			db, mask = DEFAULT_MODEL(batch)
+			db = db.sigmoid().cpu()
+			mask = mask[:, 0, :, :].cpu().numpy()
+		for j, i in enumerate(indices) :
+			_, target_ratio, pad_w, pad_h = prepared[i]
+			results[i] = postprocess_default(db[j : j + 1], mask[j], (batch_h, batch_w), target_ratio, pad_w, pad_h, args)
+	return results
+
+def is_strip(img: np.ndarray) -> bool :
+	return max(img.shape[: 2]) > STRIP_ASPECT_RATIO * min(img.shape[: 2])
+
+def strip_windows(short_side: int, long_side: int, detect_size: int) :
+	"""
+	Long side of the windows a strip is detected in and the scale they are detected at.
+	Windows are at native scale unless the short side is larger than detect_size, a strip shorter than that is one window scaled up to detect_size like any page.
+	"""
+	window = min(long_side, int(detect_size / min(1.0, detect_size / short_side)))
+	# run_default_batch scales every window to detect_size on its long side
+	return window, detect_size / max(window, short_side)
+
+def filter_size(img: np.ndarray, detect_size: int) -> int :
+	"""
+	Long side img_filtered needs for detection, detect_size or the whole strip at its detection scale for long strips
+	"""
+	if not is_strip(img) :
+		return detect_size
+	_, ratio = strip_windows(min(img.shape[: 2]), max(img.shape[: 2]), detect_size)
+	return max(detect_size, int(round(max(img.shape[: 2]) * ratio)))
+
+def quadrilateral_from_points(pts: np.ndarray) -> Quadrilateral :
+	"""
+	Min area rectangle around pts, with corners ordered like detected textlines
+	"""
+	(cx, cy), (w, h), angle = cv2.minAreaRect(pts.astype(np.float32))
+	box = dbnet_utils.SegDetectorRepresenter.rect_points(np.array([[cx, cy]]), np.array([[w, h]]), np.array([angle]))
+	box = dbnet_utils.SegDetectorRepresenter.order_points(box)[0]
+	box = np.roll(box, -box.sum(axis = 1).argmin(), 0)
+	return Quadrilateral(np.round(box).astype(int), '', 0)
+
+def merge_window_textlines(window_textlines: List[List[Quadrilateral]], spans: List[tuple], axis: int, margin: int) -> List[Quadrilateral] :
+	"""
+	Combine textlines of overlapping windows along axis (1 for a vertical strip), spans are the windows' (start, end) on that axis.
+	A textline is kept from the first window that sees it whole. Textlines longer than the overlap are cut in both windows, their two pieces touching the shared window edges are joined.
+	"""
+	textlines = []
+	# pieces cut by the end of their window, waiting to be joined with pieces of the next window
+	open_pieces = []
+	for i, (txtlns, (start, end)) in enumerate(zip(window_textlines, spans)) :
+		has_prev, has_next = i > 0, i + 1 < len(spans)
+		pieces = []
+		for txtln in txtlns :
+			lo, hi = txtln.pts[:, axis].min(), txtln.pts[:, axis].max()
+			cut_start = has_prev and lo <= start + margin
+			cut_end = has_next and hi >= end - margin
+			if has_prev and hi < spans[i - 1][1] - margin :
+				# the previous window saw all of it
+				continue
+			if cut_end and lo >= spans[i + 1][0] + margin :
+				# the next window sees all of it
+				continue
+			pts = txtln.pts
+			if cut_start :
+				cross_lo, cross_hi = pts[:, 1 - axis].min(), pts[:, 1 - axis].max()
+				for j, (prev_pts, prev_lo, prev_hi) in enumerate(open_pieces) :
+					if prev_pts is not None and min(cross_hi, prev_hi) - max(cross_lo, prev_lo) > 0.5 * min(cross_hi - cross_lo, prev_hi - prev_lo) :
+						pts = np.concatenate([prev_pts, pts])
+						open_pieces[j] = (None, 0, 0)
+			if cut_end :
+				pieces.append((pts, pts[:, 1 - axis].min(), pts[:, 1 - axis].max()))
+			elif pts is txtln.pts :
+				textlines.append(txtln)
+			else :
+				textlines.append(quadrilateral_from_points(pts))
+		# pieces of the previous window nothing continued
+		textlines.extend(quadrilateral_from_points(pts) for pts, _, _ in open_pieces if pts is not None)
+		open_pieces = pieces
+	textlines.extend(quadrilateral_from_points(pts) for pts, _, _ in open_pieces if pts is not None)
+	return textlines
+
+async def run_default_strip(img: np.ndarray, detect_size: int, cuda: bool, verbose: bool, args: dict, img_filtered: np.ndarray = None) :
+	"""
+	Detect text in a long strip (e.g. a webtoon) in overlapping windows along its long side, at native scale unless the short side is larger than detect_size.
+	Windows are detected STRIP_BATCH_SIZE at a time, so memory use depends on the window size instead of the strip length.
+	Windows are cropped from img_filtered, which is filtered here if it is not given or smaller than the detection scale needs.
+	Returns textlines and the stitched mask in page coordinates like run_default.
+	"""
+	height, width = img.shape[: 2]
+	vertical = height >= width
+	short_side, long_side = (width, height) if vertical else (height, width)
+	# every window is detected at the same ratio, its overlap with the next one must hold a whole textline
+	window, ratio = strip_windows(short_side, long_side, detect_size)
+	overlap = window // 4
+	starts = list(range(0, long_side - window, window - overlap)) + [long_side - window]
+	windows = [(0, s, width, s + window) if vertical else (s, 0, s + window, height) for s in starts]
+	if verbose :
+		print(f'Strip detection: {len(windows)} windows of {windows[0][2] - windows[0][0]}x{windows[0][3] - windows[0][1]}, scale {ratio:.2f}')
+	if img_filtered is None or max(img_filtered.shape[: 2]) + 1 < min(ratio, 1.0) * long_side :
+		img_filtered = bilateral_filter_resized(img, int(round(long_side * ratio)))
+	fy, fx = img_filtered.shape[0] / height, img_filtered.shape[1] / width
+	mask = np.zeros((int(round(height * ratio)), int(round(width * ratio))), dtype = np.uint8)
+	window_textlines = []
+	for i in range(0, len(windows), STRIP_BATCH_SIZE) :
+		chunk = windows[i : i + STRIP_BATCH_SIZE]
+		crops = [img_filtered[int(round(y0 * fy)) : int(round(y1 * fy)), int(round(x0 * fx)) : int(round(x1 * fx))] for x0, y0, x1, y1 in chunk]
+		results = await run_default_batch([img[y0 : y1, x0 : x1] for x0, y0, x1, y1 in chunk], detect_size, cuda, verbose, args, crops)
+		for (x0, y0, _, _), (textlines, window_mask) in zip(chunk, results) :
+			window_textlines.append(QuadrilateralBatch(np.array([txtln.pts for txtln in textlines]).reshape(-1, 4, 2) + np.array([x0, y0])).to_list())
+			mx, my = int(round(x0 * ratio)), int(round(y0 * ratio))
+			mh, mw = min(window_mask.shape[0], mask.shape[0] - my), min(window_mask.shape[1], mask.shape[1] - mx)
+			np.maximum(mask[my : my + mh, mx : mx + mw], window_mask[: mh, : mw], out = mask[my : my + mh, mx : mx + mw])
+	spans = [(y0, y1) if vertical else (x0, x1) for x0, y0, x1, y1 in windows]
+	return merge_window_textlines(window_textlines, spans, 1 if vertical else 0, max(int(2 / ratio), 2)), mask
+
+async def dispatch(img: np.ndarray, detect_size: int, cuda: bool, args: dict, model_name: str = 'default', verbose: bool = False, img_filtered: np.ndarray = None) -> List[Quadrilateral] :
 	print(' -- Running text detection')
 	if model_name == 'default' :
 		global DEFAULT_MODEL
 		if DEFAULT_MODEL is None :
 			load_model(cuda, 'default')
-		return await run_default(img, detect_size, cuda, verbose, args)
+		if is_strip(img) :
+			return await run_default_strip(img, detect_size, cuda, verbose, args, img_filtered)
+		return await run_default(img, detect_size, cuda, verbose, args, img_filtered)
 
+
+async def dispatch_batch(imgs: List[np.ndarray], detect_size: int, cuda: bool, args: dict, model_name: str = 'default', verbose: bool = False, imgs_filtered: List[np.ndarray] = None) -> List[tuple] :
+	"""
+	Detect text in several images with one forward pass per padded shape, returns a (textlines, mask) pair for each image
+	Long strips are detected one at a time in windows
+	"""
+	print(f' -- Running text detection on {len(imgs)} images')
+	if model_name == 'default' :
+		if DEFAULT_MODEL is None :
+			load_model(cuda, 'default')
+		if imgs_filtered is None :
+			imgs_filtered = [None] * len(imgs)
+		pages = [i for i, img in enumerate(imgs) if not is_strip(img)]
+		results = [None] * len(imgs)
+		for i, result in zip(pages, await run_default_batch([imgs[i] for i in pages], detect_size, cuda, verbose, args, [imgs_filtered[i] for i in pages])) :
+			results[i] = result
+		for i, img in enumerate(imgs) :
+			if results[i] is None :
+				results[i] = await run_default_strip(img, detect_size, cuda, verbose, args, imgs_filtered[i])
+		return results
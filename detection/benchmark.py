@@ -0,0 +1,103 @@
+"""
+Time of bilateral filtering the page before detection and mask refinement, filtering at full resolution against bilateral_filter_resized and each stage filtering by itself against sharing one filtered page, run from the repository root:
+python -m detection.benchmark [--scales 1 1.5] [--detect-size 1536] [--method fit_text] [demo/original1.jpg ...]
+Mask refinement runs on synthetic textlines drawn onto the page, no model is needed.
+"""
+
+import argparse
+import asyncio
+import glob
+import time
+import cv2
+import numpy as np
+
+import text_mask
+from detection import preprocess_default, filter_size, imgproc
+from utils import Quadrilateral, bilateral_filter_resized
+
+parser = argparse.ArgumentParser(description = 'Benchmark bilateral filtering for detection and mask refinement on the demo images')
+parser.add_argument('images', nargs = '*', type = str, help = 'images to benchmark on, demo/original*.jpg by default')
+parser.add_argument('--scales', nargs = '+', default = [1, 1.5], type = float, help = 'scale images by these factors')
+parser.add_argument('--detect-size', default = 1536, type = int, help = 'size of image used for detection')
+parser.add_argument('--textlines', default = 40, type = int, help = 'synthetic textlines per page')
+parser.add_argument('--method', default = 'fit_text', type = str, help = 'mask refinement method, fit_text, fast or fill')
+parser.add_argument('--repeat', default = 3, type = int, help = 'runs per image, the fastest one counts')
+parser.add_argument('--seed', default = 0, type = int, help = 'random seed')
+
+def filter_full_then_resize(img: np.ndarray, detect_size: int) -> np.ndarray :
+	# what detection did before, filter the whole page with a 17px diameter and resize afterwards
+	img_filtered = cv2.bilateralFilter(img, 17, 80, 80)
+	ratio = min(float(detect_size) / max(img.shape[: 2]), 1.0)
+	return cv2.resize(img_filtered, (round(img.shape[1] * ratio), round(img.shape[0] * ratio)), interpolation = cv2.INTER_LINEAR)
+
+def preprocess_full_resolution(img: np.ndarray, detect_size: int) :
+	# what preprocess_default did before
+	img_resized, target_ratio, _, pad_w, pad_h = imgproc.resize_aspect_ratio(cv2.bilateralFilter(img, 17, 80, 80), detect_size, cv2.INTER_LINEAR, mag_ratio = 1)
+	return img_resized, target_ratio, pad_w, pad_h
+
+def filter_page(img: np.ndarray, detect_size: int) -> np.ndarray :
+	# same as translate_demo.filter_page, one filtered page for both stages
+	return bilateral_filter_resized(img, max(filter_size(img, detect_size), max(img.shape[: 2]) // 2))
+
+def draw_textlines(img: np.ndarray, count: int, rng: np.random.Generator) :
+	"""
+	Vertical textlines of dark character blobs drawn onto a copy of img, with the raw mask detection would give for them
+	"""
+	img = np.copy(img)
+	height, width = img.shape[: 2]
+	size = max(min(height, width) // 60, 8)
+	mask = np.zeros((height, width), dtype = np.uint8)
+	textlines = []
+	for _ in range(count) :
+		chars = int(rng.integers(3, 12))
+		w, h = size, size * chars
+		x, y = int(rng.integers(0, width - w)), int(rng.integers(0, max(height - h, 1)))
+		for c in range(chars) :
+			center = (x + w // 2, y + size // 2 + size * c)
+			axes = (int(rng.integers(size // 4, size // 2)), int(rng.integers(size // 4, size // 2)))
+			cv2.ellipse(img, center, axes, 0, 0, 360, (20, 20, 20), -1)
+			cv2.ellipse(mask, center, axes, 0, 0, 360, 255, -1)
+		textlines.append(Quadrilateral(np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]]), '', 1.0))
+	return img, cv2.dilate(mask, np.ones((3, 3), dtype = np.uint8)), textlines
+
+def measure(fn, repeat: int) :
+	best = None
+	for _ in range(repeat) :
+		start = time.perf_counter()
+		result = fn()
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best[1] :
+			best = (result, elapsed)
+	return best
+
+def iou(a: np.ndarray, b: np.ndarray) -> float :
+	union = np.count_nonzero((a > 0) | (b > 0))
+	return np.count_nonzero((a > 0) & (b > 0)) / union if union else 1.0
+
+def benchmark(args) :
+	rng = np.random.default_rng(args.seed)
+	cv2.setNumThreads(1)
+	images = []
+	for path in args.images or sorted(glob.glob('demo/original*.jpg')) :
+		img = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+		for scale in args.scales :
+			images.append(cv2.resize(img, None, fx = scale, fy = scale, interpolation = cv2.INTER_LINEAR) if scale != 1 else img)
+	print(f'{len(images)} images, detect size {args.detect_size}, {args.textlines} textlines per page, {args.method} refinement, one OpenCV thread:')
+	for img in images :
+		img, raw_mask, textlines = draw_textlines(img, args.textlines, rng)
+		print(f'{img.shape[1]}x{img.shape[0]}:')
+		full, elapsed_full = measure(lambda: filter_full_then_resize(img, args.detect_size), args.repeat)
+		resized, elapsed_resized = measure(lambda: bilateral_filter_resized(img, args.detect_size), args.repeat)
+		print(f'  {"filter":>18}: full resolution then resize {elapsed_full * 1000:7.1f}ms, bilateral_filter_resized {elapsed_resized * 1000:7.1f}ms, {cv2.PSNR(full, resized):.1f}dB PSNR')
+		img_filtered, elapsed_page = measure(lambda: filter_page(img, args.detect_size), args.repeat)
+		print(f'  {"shared filtering":>18}: {elapsed_page * 1000:7.1f}ms, {img_filtered.shape[1]}x{img_filtered.shape[0]}')
+		(old, old_ratio, _, _), elapsed_old = measure(lambda: preprocess_full_resolution(img, args.detect_size), args.repeat)
+		(own, _, _, _), elapsed_own = measure(lambda: preprocess_default(img, args.detect_size), args.repeat)
+		(shared, shared_ratio, _, _), elapsed_shared = measure(lambda: preprocess_default(img, args.detect_size, img_filtered), args.repeat)
+		print(f'  {"detection":>18}: full resolution {elapsed_old * 1000:7.1f}ms, without img_filtered {elapsed_own * 1000:7.1f}ms, with img_filtered {elapsed_shared * 1000:7.1f}ms, {cv2.PSNR(old, shared):.1f}dB PSNR, ratio {old_ratio:.4f} -> {shared_ratio:.4f}')
+		own_mask, elapsed_own = measure(lambda: asyncio.run(text_mask.dispatch(img, raw_mask, textlines, args.method)), args.repeat)
+		shared_mask, elapsed_shared = measure(lambda: asyncio.run(text_mask.dispatch(img, raw_mask, textlines, args.method, img_filtered = img_filtered)), args.repeat)
+		print(f'  {"mask refinement":>18}: without img_filtered {elapsed_own * 1000:7.1f}ms, with img_filtered {elapsed_shared * 1000:7.1f}ms, {iou(own_mask, shared_mask):.3f} IoU')
+
+if __name__ == '__main__' :
+	benchmark(parser.parse_args())
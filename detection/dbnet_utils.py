@@ -96,47 +96,82 @@ class SegDetectorRepresenter():
 		'''
 		_bitmap: single map with shape (H, W),
 			whose values are binarized as {0, 1}
+		Every 8-connected region of _bitmap is a candidate, all of them are scored from one label image
+		and their boxes are expanded in closed form.
 		'''
 
 		assert len(_bitmap.shape) == 2
-		bitmap = _bitmap.cpu().numpy()  # The first channel
+		bitmap = _bitmap.cpu().numpy().astype(np.uint8)  # The first channel
 		pred = pred.cpu().detach().numpy()
 		height, width = bitmap.shape
-		try :
-			contours, _ = cv2.findContours((bitmap * 255).astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-		except ValueError :
-			return [], []
-		num_contours = min(len(contours), self.max_candidates)
-		boxes = np.zeros((num_contours, 4, 2), dtype=np.int16)
-		scores = np.zeros((num_contours,), dtype=np.float32)
-
-		for index in range(num_contours):
-			contour = contours[index].squeeze(1)
-			points, sside = self.get_mini_boxes(contour)
-			if sside < self.min_size:
-				continue
-			points = np.array(points)
-			score = self.box_score_fast(pred, contour)
-			if self.box_thresh > score:
-				continue
-
-			box = self.unclip(points, unclip_ratio=self.unclip_ratio).reshape(-1, 1, 2)
-			box, sside = self.get_mini_boxes(box)
-			if sside < self.min_size + 2:
-				continue
-			box = np.array(box)
-			if not isinstance(dest_width, int):
-				dest_width = dest_width.item()
-				dest_height = dest_height.item()
+		empty = np.zeros((0, 4, 2), dtype=np.int16), np.zeros((0,), dtype=np.float32)
+		num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(bitmap, connectivity=8)
+		if num_labels <= 1 :
+			return empty
+
+		# mean prediction inside each region from its pixels only, label 0 is the background
+		foreground = np.flatnonzero(bitmap)
+		label_scores = np.bincount(labels.ravel()[foreground], weights=pred.ravel()[foreground], minlength=num_labels) / np.maximum(stats[:, cv2.CC_STAT_AREA], 1)
+		contours, _ = cv2.findContours(bitmap, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+		contour_labels = np.array([labels[contour[0, 0, 1], contour[0, 0, 0]] for contour in contours])
+		keep = (contour_labels <= self.max_candidates) & (label_scores[contour_labels] >= self.box_thresh)
+		if not keep.any() :
+			return empty
+		contours = [contour for contour, kept in zip(contours, keep) if kept]
+		scores = label_scores[contour_labels[keep]].astype(np.float32)
+		rects = [cv2.minAreaRect(contour) for contour in contours]
+		centers = np.array([rect[0] for rect in rects], dtype=np.float64)
+		sizes = np.array([rect[1] for rect in rects], dtype=np.float64)
+		angles = np.array([rect[2] for rect in rects], dtype=np.float64)
+
+		valid = sizes.min(axis=1) >= self.min_size
+		centers, sizes, angles, scores = centers[valid], sizes[valid], angles[valid], scores[valid]
+		sizes = self.unclip_rects(sizes, unclip_ratio=self.unclip_ratio)
+		valid = sizes.min(axis=1) >= self.min_size + 2
+		if not valid.any() :
+			return empty
+		box = self.order_points(self.rect_points(centers[valid], sizes[valid], angles[valid]))
+		if not isinstance(dest_width, int):
+			dest_width = dest_width.item()
+			dest_height = dest_height.item()
+
+		box[:, :, 0] = np.clip(np.round(box[:, :, 0] / width * dest_width), 0, dest_width)
+		box[:, :, 1] = np.clip(np.round(box[:, :, 1] / height * dest_height), 0, dest_height)
+		startidx = box.sum(axis=2).argmin(axis=1)
+		box = np.take_along_axis(box, ((np.arange(4)[None, :] + startidx[:, None]) % 4)[:, :, None], axis=1)
+		return box.astype(np.int16), scores[valid]
+
+	def unclip_rects(self, sizes, unclip_ratio=1.8):
+		'''
+		Closed form of unclip followed by get_mini_boxes for rectangles, sizes is (N, 2) width and height.
+		Offsetting a rectangle by the distance unclip uses gives a rounded rectangle whose min area rect is the rectangle grown by that distance on every side.
+		'''
+		distance = sizes.prod(axis=1) * unclip_ratio / (2 * sizes.sum(axis=1))
+		return sizes + 2 * distance[:, None]
 
-			box[:, 0] = np.clip(np.round(box[:, 0] / width * dest_width), 0, dest_width)
-			box[:, 1] = np.clip(np.round(box[:, 1] / height * dest_height), 0, dest_height)
-			startidx = box.sum(axis=1).argmin()
-			box = np.roll(box, 4-startidx, 0)
-			box = np.array(box)
-			boxes[index, :, :] = box.astype(np.int16)
-			scores[index] = score
-		return boxes, scores
+	@staticmethod
+	def rect_points(centers, sizes, angles):
+		'''
+		Corners of (N,) rotated rects in the order cv2.boxPoints returns them
+		'''
+		angles = np.deg2rad(angles)
+		b = np.cos(angles) * 0.5
+		a = np.sin(angles) * 0.5
+		w, h = sizes[:, 0], sizes[:, 1]
+		p0 = np.stack([centers[:, 0] - a * h - b * w, centers[:, 1] + b * h - a * w], axis=1)
+		p1 = np.stack([centers[:, 0] + a * h - b * w, centers[:, 1] - b * h - a * w], axis=1)
+		return np.stack([p0, p1, 2 * centers - p0, 2 * centers - p1], axis=1)
+
+	@staticmethod
+	def order_points(points):
+		'''
+		Order (N, 4, 2) corners the same way get_mini_boxes does
+		'''
+		points = np.take_along_axis(points, np.argsort(points[:, :, 0], axis=1, kind='stable')[:, :, None], axis=1)
+		rows = np.arange(points.shape[0])
+		index_1 = np.where(points[:, 1, 1] > points[:, 0, 1], 0, 1)
+		index_2 = np.where(points[:, 3, 1] > points[:, 2, 1], 2, 3)
+		return np.stack([points[rows, index_1], points[rows, index_2], points[rows, 5 - index_2], points[rows, 1 - index_1]], axis=1)
 
 	def unclip(self, box, unclip_ratio=1.8):
 		poly = Polygon(box)
@@ -49,6 +49,7 @@ def resize_aspect_ratio(img, square_size, interpolation, mag_ratio=1):
     target_h, target_w = int(round(height * ratio)), int(round(width * ratio))
     proc = cv2.resize(img, (target_w, target_h), interpolation = interpolation)
 
+    # the default detector halves the input 8 times and concatenates skip connections, so both sides must be multiples of 256
     MULT = 256
 
     # make canvas and paste image
@@ -1,4 +1,6 @@
 
+from collections import Counter
+from typing import List
 import torch
 import cv2
 import numpy as np
@@ -20,19 +22,7 @@ def load_model(cuda: bool, model_name: str = 'default') :
 			model = model.cuda()
 		DEFAULT_MODEL = model
 
-async def dispatch(use_inpainting: bool, use_poisson_blending: bool, cuda: bool, img: np.ndarray, mask: np.ndarray, inpainting_size: int = 1024, model_name: str = 'default', verbose: bool = False) -> np.ndarray :
-	img_original = np.copy(img)
-	mask_original = np.copy(mask)
-	mask_original[mask_original < 127] = 0
-	mask_original[mask_original >= 127] = 1
-	mask_original = mask_original[:, :, None]
-	if not use_inpainting :
-		img = np.copy(img)
-		img[mask > 0] = np.array([255, 255, 255], np.uint8)
-		if verbose :
-			return img, img
-		else :
-			return img
+def inpaint_whole(img: np.ndarray, mask: np.ndarray, inpainting_size: int, cuda: bool, verbose: bool = False) :
 	height, width, c = img.shape
 	if max(img.shape[0: 2]) > inpainting_size :
 		img = resize_keep_aspect(img, inpainting_size)
@@ -62,13 +52,148 @@ async def dispatch(use_inpainting: bool, use_poisson_blending: bool, cuda: bool,
 	with torch.no_grad() :
 		img_torch *= (1 - mask_torch)
 		img_inpainted_torch = DEFAULT_MODEL(img_torch, mask_torch)
+	# returned at inpainting resolution, only the masked boxes are scaled back up by paste_inpainted
 	img_inpainted = ((img_inpainted_torch.cpu().squeeze_(0).permute(1, 2, 0).numpy() + 1.0) * 127.5).astype(np.uint8)
-	if new_h != height or new_w != width :
-		img_inpainted = cv2.resize(img_inpainted, (width, height), interpolation = cv2.INTER_LINEAR)
+	return img_inpainted, (img_torch.cpu() * 127.5 + 127.5).squeeze_(0).permute(1, 2, 0).numpy()
+
+def paste_inpainted(dst: np.ndarray, img_inpainted: np.ndarray, mask_bin: np.ndarray) :
+	"""
+	Copy masked pixels of img_inpainted into dst in place, scaling img_inpainted to the size of dst only inside the bounding boxes of the mask
+	"""
+	height, width = dst.shape[: 2]
+	h, w = img_inpainted.shape[: 2]
+	scale_x, scale_y = w / width, h / height
+	_, _, stats, _ = cv2.connectedComponentsWithStats(mask_bin, connectivity = 8)
+	for x0, y0, bw, bh, _ in stats[1:] :
+		if h == height and w == width :
+			region = img_inpainted[y0: y0 + bh, x0: x0 + bw]
+		else :
+			# same pixel mapping as cv2.resize of the whole image, evaluated for this box only
+			M = np.array([[scale_x, 0, scale_x * (x0 + 0.5) - 0.5], [0, scale_y, scale_y * (y0 + 0.5) - 0.5]], dtype = np.float64)
+			region = cv2.warpAffine(img_inpainted, M, (int(bw), int(bh)), flags = cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode = cv2.BORDER_REPLICATE)
+		np.copyto(dst[y0: y0 + bh, x0: x0 + bw], region, where = mask_bin[y0: y0 + bh, x0: x0 + bw, None].astype(bool))
+
+TILE_BATCH_SIZE = 4
+
+def window_starts(start: int, length: int, size: int, limit: int, overlap: int) -> List[int] :
+	"""
+	Start offsets of windows of the given size covering [start, start + length), clamped to [0, limit - size]
+	"""
+	if length <= size :
+		# one window centered on the region
+		return [min(max(start + length // 2 - size // 2, 0), limit - size)]
+	stride = size - overlap
+	starts = list(range(start, start + length - size, stride)) + [start + length - size]
+	return [min(max(s, 0), limit - size) for s in starts]
+
+def feather_weight(y: int, x: int, th: int, tw: int, height: int, width: int, ramp: int) -> np.ndarray :
+	"""
+	Blend weight of a tile, ramping down towards tile edges that are inside the page so neighbouring tiles fade into each other
+	"""
+	def ramp_1d(start, size, limit) :
+		pos = np.arange(size, dtype = np.float32)
+		near = np.full(size, np.inf, dtype = np.float32)
+		if start > 0 :
+			near = np.minimum(near, pos)
+		if start + size < limit :
+			near = np.minimum(near, size - 1 - pos)
+		return np.minimum((near + 1) / (ramp + 1), 1)
+	return ramp_1d(y, th, height)[:, None] * ramp_1d(x, tw, width)[None, :]
+
+def inpaint_tiled(img: np.ndarray, mask_bin: np.ndarray, tile_size: int, cuda: bool, dst: np.ndarray, verbose: bool = False) :
+	"""
+	Inpaint at native resolution in tiles around connected mask regions instead of the whole downscaled page.
+	Memory is bounded by the tile size and time scales with the masked area, inpainted mask pixels are written to dst in place.
+	"""
+	height, width, c = img.shape
+	# tiles need sides divisible by 4, like the whole page path
+	tile_size = max(tile_size - tile_size % 4, 4)
+	th = min(tile_size, height - height % 4)
+	tw = min(tile_size, width - width % 4)
+	margin = tile_size // 8
+	overlap = tile_size // 4
+	# mask pixels closer than margin share a region, each region also gets margin pixels of context
+	grown = cv2.dilate(mask_bin, cv2.getStructuringElement(cv2.MORPH_RECT, (2 * margin + 1, 2 * margin + 1)))
+	num_regions, labels, stats, _ = cv2.connectedComponentsWithStats(grown, connectivity = 8)
+	tiles = []
+	for label in range(1, num_regions) :
+		x0, y0, w, h, _ = stats[label]
+		# small regions get smaller tiles, rounded up to a multiple of 64 so tiles of similar regions can be batched
+		rth = min(th, (h + 63) // 64 * 64)
+		rtw = min(tw, (w + 63) // 64 * 64)
+		for y in window_starts(y0, h, rth, height, overlap) :
+			for x in window_starts(x0, w, rtw, width, overlap) :
+				tiles.append((rth, rtw, label, y, x))
+	tiles.sort(key = lambda tile: tile[: 2])
+	if verbose :
+		print(f'Inpainting {len(tiles)} tiles covering {sum(rth * rtw for rth, rtw, _, _, _ in tiles) / (height * width):.1%} of the page for {num_regions - 1} mask regions')
+	remaining = Counter(label for _, _, label, _, _ in tiles)
+	accumulated = {}
+	batches = []
+	for tile in tiles :
+		if not batches or len(batches[-1]) == TILE_BATCH_SIZE or batches[-1][0][: 2] != tile[: 2] :
+			batches.append([])
+		batches[-1].append(tile)
+	for batch in batches :
+		bh, bw = batch[0][: 2]
+		img_batch = np.stack([img[y: y + bh, x: x + bw] for _, _, _, y, x in batch])
+		mask_batch = np.stack([mask_bin[y: y + bh, x: x + bw] for _, _, _, y, x in batch])
+		img_torch = torch.from_numpy(img_batch).permute(0, 3, 1, 2).float() / 127.5 - 1.0
+		mask_torch = torch.from_numpy(mask_batch).unsqueeze_(1).float()
+		if cuda :
+			img_torch = img_torch.cuda()
+			mask_torch = mask_torch.cuda()
+		with torch.no_grad() :
+			img_torch *= (1 - mask_torch)
+			inpainted_torch = DEFAULT_MODEL(img_torch, mask_torch)
+		inpainted_batch = np.clip((inpainted_torch.cpu().permute(0, 2, 3, 1).numpy() + 1.0) * 127.5, 0, 255)
+		for (_, _, label, y, x), inpainted in zip(batch, inpainted_batch) :
+			x0, y0, w, h, _ = stats[label]
+			if label not in accumulated :
+				accumulated[label] = (np.zeros((h, w, c), dtype = np.float32), np.zeros((h, w), dtype = np.float32))
+			acc, weight_sum = accumulated[label]
+			# part of the tile inside the region's bounding box, in tile and in box coordinates
+			ty0, ty1 = max(y0 - y, 0), min(y0 + h - y, bh)
+			tx0, tx1 = max(x0 - x, 0), min(x0 + w - x, bw)
+			by0, bx0 = y + ty0 - y0, x + tx0 - x0
+			weight = feather_weight(y, x, bh, bw, height, width, overlap // 2)[ty0: ty1, tx0: tx1]
+			acc[by0: by0 + ty1 - ty0, bx0: bx0 + tx1 - tx0] += inpainted[ty0: ty1, tx0: tx1] * weight[:, :, None]
+			weight_sum[by0: by0 + ty1 - ty0, bx0: bx0 + tx1 - tx0] += weight
+			remaining[label] -= 1
+			if remaining[label] == 0 :
+				# region done, write its pixels back and drop its buffers
+				acc, weight_sum = accumulated.pop(label)
+				selected = (labels[y0: y0 + h, x0: x0 + w] == label) & (mask_bin[y0: y0 + h, x0: x0 + w] > 0) & (weight_sum > 0)
+				region = dst[y0: y0 + h, x0: x0 + w]
+				region[selected] = (acc[selected] / weight_sum[selected][:, None] + 0.5).astype(np.uint8)
+
+async def dispatch(use_inpainting: bool, use_poisson_blending: bool, cuda: bool, img: np.ndarray, mask: np.ndarray, inpainting_size: int = 1024, model_name: str = 'default', verbose: bool = False, tile_size: int = 0) -> np.ndarray :
+	"""
+	Inpaint masked pixels of img, with tile_size > 0 inpainting runs on native resolution tiles around mask regions instead of the whole page downscaled to inpainting_size
+	"""
+	if not use_inpainting :
+		img = np.copy(img)
+		img[mask > 0] = np.array([255, 255, 255], np.uint8)
+		if verbose :
+			return img, img
+		else :
+			return img
 	if use_poisson_blending :
 		raise NotImplemented
+	mask_bin = (mask >= 127).astype(np.uint8)
+	ans = np.copy(img)
+	if not mask_bin.any() :
+		# nothing to inpaint
+		if verbose :
+			return ans, np.copy(img)
+		return ans
+	if tile_size > 0 :
+		inpaint_tiled(img, mask_bin, tile_size, cuda, ans, verbose)
+		if verbose :
+			inpaint_input = img * (1 - mask_bin[:, :, None])
 	else :
-		ans = img_inpainted * mask_original + img_original * (1 - mask_original)
+		img_inpainted, inpaint_input = inpaint_whole(img, mask, inpainting_size, cuda, verbose)
+		paste_inpainted(ans, img_inpainted, mask_bin)
 	if verbose :
-		return ans, (img_torch.cpu() * 127.5 + 127.5).squeeze_(0).permute(1, 2, 0).numpy()
+		return ans, inpaint_input
 	return ans
@@ -0,0 +1,99 @@
+"""
+Time and peak allocations per megapixel of inpainting.dispatch against upscaling and blending the whole inpainted frame, run from the repository root:
+python -m inpainting.benchmark [--scale 2] [--mask-fractions 0 0.02 0.1] [demo/original1.jpg ...]
+A cheap stand-in replaces the inpainting network unless --use-model is given, so the numbers show pre and post-processing only.
+"""
+
+import argparse
+import asyncio
+import glob
+import time
+import tracemalloc
+import cv2
+import numpy as np
+import torch
+
+import inpainting
+from inpainting import inpaint_whole
+
+parser = argparse.ArgumentParser(description = 'Benchmark inpainting post-processing on the demo images')
+parser.add_argument('images', nargs = '*', type = str, help = 'images to benchmark on, demo/original*.jpg by default')
+parser.add_argument('--scale', default = 2, type = float, help = 'scale images by this factor first, pages larger than --inpainting-size go through the upscale path')
+parser.add_argument('--inpainting-size', default = 2048, type = int, help = 'size of image used for inpainting')
+parser.add_argument('--mask-fractions', nargs = '+', default = [0, 0.02, 0.1], type = float, help = 'fractions of the page covered by the synthetic text mask')
+parser.add_argument('--repeat', default = 3, type = int, help = 'runs per image, the fastest one counts')
+parser.add_argument('--use-model', action = 'store_true', help = 'run the real inpainting model (inpainting.ckpt) instead of the stand-in')
+parser.add_argument('--seed', default = 0, type = int, help = 'random seed')
+
+class StandInModel(torch.nn.Module) :
+	def forward(self, img, mask) :
+		return torch.tanh(img * 0.7 + mask * 0.5)
+
+async def dispatch_full_frame(img: np.ndarray, mask: np.ndarray, inpainting_size: int) -> np.ndarray :
+	# what inpainting.dispatch did before, resize the whole inpainted frame back and blend it over the whole page
+	height, width = img.shape[: 2]
+	img_original = np.copy(img)
+	mask_original = np.copy(mask)
+	mask_original[mask_original < 127] = 0
+	mask_original[mask_original >= 127] = 1
+	mask_original = mask_original[:, :, None]
+	img_inpainted, _ = inpaint_whole(img, mask, inpainting_size, False)
+	if img_inpainted.shape[: 2] != (height, width) :
+		img_inpainted = cv2.resize(img_inpainted, (width, height), interpolation = cv2.INTER_LINEAR)
+	return img_inpainted * mask_original + img_original * (1 - mask_original)
+
+def text_mask(height: int, width: int, fraction: float, rng: np.random.Generator) -> np.ndarray :
+	"""
+	Columns of vertical textline boxes until fraction of the page is masked
+	"""
+	mask = np.zeros((height, width), dtype = np.uint8)
+	while np.count_nonzero(mask) < fraction * height * width :
+		x, y = int(rng.integers(0, width - 160)), int(rng.integers(0, height - 200))
+		for k in range(int(rng.integers(2, 6))) :
+			cv2.rectangle(mask, (x + k * 30, y), (x + k * 30 + 18, y + int(rng.integers(60, 200))), 255, -1)
+	return mask
+
+def measure(dispatch_fn, repeat: int) :
+	best = None
+	for _ in range(repeat) :
+		tracemalloc.start()
+		start = time.perf_counter()
+		result = asyncio.run(dispatch_fn())
+		elapsed = time.perf_counter() - start
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+		if best is None or elapsed < best[1] :
+			best = (result, elapsed, peak)
+	return best
+
+def benchmark(args) :
+	rng = np.random.default_rng(args.seed)
+	if args.use_model :
+		inpainting.load_model(False)
+	else :
+		inpainting.DEFAULT_MODEL = StandInModel()
+	images = []
+	for path in args.images or sorted(glob.glob('demo/original*.jpg')) :
+		img = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+		images.append(cv2.resize(img, None, fx = args.scale, fy = args.scale, interpolation = cv2.INTER_LINEAR))
+	megapixels = sum(img.shape[0] * img.shape[1] for img in images) / 1e6
+	print(f'{len(images)} images, {megapixels:.1f} megapixels, inpainting size {args.inpainting_size}:')
+	for fraction in args.mask_fractions :
+		totals = {'full frame': [0.0, 0], 'mask boxes': [0.0, 0]}
+		max_diff = 0
+		for img in images :
+			mask = text_mask(img.shape[0], img.shape[1], fraction, rng)
+			full, elapsed, peak = measure(lambda: dispatch_full_frame(img, mask, args.inpainting_size), args.repeat)
+			totals['full frame'][0] += elapsed
+			totals['full frame'][1] += peak
+			boxes, elapsed, peak = measure(lambda: inpainting.dispatch(True, False, False, img, mask, args.inpainting_size), args.repeat)
+			totals['mask boxes'][0] += elapsed
+			totals['mask boxes'][1] += peak
+			max_diff = max(max_diff, int(np.abs(full.astype(np.int16) - boxes.astype(np.int16)).max()))
+		print(f'  mask {fraction:.0%}:')
+		for name, (elapsed, peak) in totals.items() :
+			print(f'    {name:>10}: {elapsed / megapixels * 1000:6.1f}ms/MP, peak allocation {peak / 2 ** 20 / megapixels:5.1f}MB/MP')
+		print(f'    max difference {max_diff}')
+
+if __name__ == '__main__' :
+	benchmark(parser.parse_args())
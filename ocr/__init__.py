@@ -1,8 +1,8 @@
 
 from collections import Counter
-import itertools
+import time
 from typing import List, Tuple
-from utils import Quadrilateral, quadrilateral_can_merge_region
+from utils import Quadrilateral, quadrilateral_can_merge_region, candidate_pairs
 import torch
 import cv2
 import numpy as np
@@ -11,12 +11,14 @@ import networkx as nx
 
 from .model_32px import OCR as OCR_32px
 from .model_48px import OCR as OCR_48px
+from .model_48px_ctc import OCR as OCR_48px_ctc
 
 MODEL_32PX = None
+MODEL_48PX_CTC = None
 
 def load_model(dictionary, cuda: bool, model_name: str = '32px') :
-	global MODEL_32PX
-	if model_name not in ['32px'] :
+	global MODEL_32PX, MODEL_48PX_CTC
+	if model_name not in ['32px', 'ctc'] :
 		raise Exception
 	if model_name == '32px' and MODEL_32PX is None :
 		model = OCR_32px(dictionary, 768)
@@ -26,32 +28,106 @@ def load_model(dictionary, cuda: bool, model_name: str = '32px') :
 		if cuda :
 			model = model.cuda()
 		MODEL_32PX = model
+	if model_name == 'ctc' and MODEL_48PX_CTC is None :
+		model = OCR_48px_ctc(dictionary, 768)
+		sd = torch.load('ocr-ctc.ckpt', map_location = 'cpu')
+		model.load_state_dict(sd['model'] if 'model' in sd else sd)
+		model.eval()
+		if cuda :
+			model = model.cuda()
+		MODEL_48PX_CTC = model
 
-def ocr_infer_bacth(img, model, widths) :
+def ocr_infer_bacth(img, model, widths, beams_k = 5) :
 	with torch.no_grad() :
-		return model.infer_beam_batch(img, widths, beams_k = 5, max_seq_length = 255)
+		return model.infer_beam_batch(img, widths, beams_k = beams_k, max_seq_length = 255)
 
 def chunks(lst, n):
 	"""Yield successive n-sized chunks from lst."""
 	for i in range(0, len(lst), n):
 		yield lst[i:i + n]
 
-def run_ocr_32px(img: np.ndarray, cuda: bool, quadrilaterals: List[Tuple[Quadrilateral, str]], config, verbose: bool = False) :
-	text_height = 32
-	regions = [q.get_transformed_region(img, d, text_height) for q, d in quadrilaterals]
-	out_regions = []
-	perm = sorted(range(len(regions)), key = lambda x: regions[x].shape[1])
+def width_buckets(widths: List[int], max_chunk_size: int) :
+	"""
+	Group crops of similar width into batches of at most max_chunk_size.
+	Neighbours in width order are batched together so every crop is padded to a width close to its own.
+	"""
+	perm = sorted(range(len(widths)), key = lambda x: widths[x])
+	return list(chunks(perm, max_chunk_size))
+
+def infer_chunk_32px(images: torch.Tensor, widths: List[int], config) :
+	ret = ocr_infer_bacth(images, MODEL_32PX, widths, config.beams_k)
+	results = []
+	for pred_chars_index, prob, fr, fg, fb, br, bg, bb in ret :
+		if prob < config.prob_threshold :
+			results.append(None)
+			continue
+		fr = (torch.clip(fr.view(-1), 0, 1).mean() * 255).long().item()
+		fg = (torch.clip(fg.view(-1), 0, 1).mean() * 255).long().item()
+		fb = (torch.clip(fb.view(-1), 0, 1).mean() * 255).long().item()
+		br = (torch.clip(br.view(-1), 0, 1).mean() * 255).long().item()
+		bg = (torch.clip(bg.view(-1), 0, 1).mean() * 255).long().item()
+		bb = (torch.clip(bb.view(-1), 0, 1).mean() * 255).long().item()
+		seq = []
+		for chid in pred_chars_index :
+			ch = MODEL_32PX.dictionary[chid]
+			if ch == '<S>' :
+				continue
+			if ch == '</S>' :
+				break
+			if ch == '<SP>' :
+				ch = ' '
+			seq.append(ch)
+		txt = ''.join(seq)
+		results.append((txt, prob, (fr, fg, fb), (br, bg, bb)))
+	return results
+
+def infer_chunk_48px_ctc(images: torch.Tensor, widths: List[int], config) :
+	with torch.no_grad() :
+		lines = MODEL_48PX_CTC.decode(images, widths, 0)
+	results = []
+	for line in lines :
+		if not line :
+			results.append(None)
+			continue
+		chids, logprobs, fr, fg, fb, br, bg, bb = zip(*line)
+		prob = float(np.exp(np.mean(logprobs)))
+		if prob < config.prob_threshold :
+			results.append(None)
+			continue
+		txt = ''.join(' ' if ch == '<SP>' else ch for ch in (MODEL_48PX_CTC.dictionary[chid] for chid in chids))
+		fg = tuple(int(np.clip(np.mean(c), 0, 1) * 255) for c in (fr, fg, fb))
+		bg = tuple(int(np.clip(np.mean(c), 0, 1) * 255) for c in (br, bg, bb))
+		results.append((txt, prob, fg, bg))
+	return results
+
+# text height of the crops and the function recognizing a padded batch of them
+OCR_ENGINES = {
+	'32px': (32, infer_chunk_32px),
+	'ctc': (48, infer_chunk_48px_ctc),
+}
+
+def infer_regions(regions: List[np.ndarray], directions: List[str], cuda: bool, config, model_name: str = '32px', verbose: bool = False) :
+	"""
+	Run OCR on textline crops, returns (index, text, prob, fg, bg) for each crop in crop width order, crops under prob_threshold are left out
+	"""
+	text_height, infer_chunk = OCR_ENGINES[model_name]
+	results = []
+	used_columns = 0
+	padded_columns = 0
+	start = time.time()
 	ix = 0
-	for indices in chunks(perm, config.max_chunk_size) :
+	for indices in width_buckets([r.shape[1] for r in regions], config.max_chunk_size) :
 		N = len(indices)
 		widths = [regions[i].shape[1] for i in indices]
 		max_width = 4 * (max(widths) + 7) // 4
+		used_columns += sum(widths)
+		padded_columns += N * max_width
 		region = np.zeros((N, text_height, max_width, 3), dtype = np.uint8)
 		for i, idx in enumerate(indices) :
 			W = regions[idx].shape[1]
 			region[i, :, : W, :] = regions[idx]
 			if verbose :
-				if quadrilaterals[idx][1] == 'v' :
+				if directions[idx] == 'v' :
 					cv2.imwrite(f'ocrs/{ix}.png', cv2.rotate(cv2.cvtColor(region[i, :, :, :], cv2.COLOR_RGB2BGR), cv2.ROTATE_90_CLOCKWISE))
 				else :
 					cv2.imwrite(f'ocrs/{ix}.png', cv2.cvtColor(region[i, :, :, :], cv2.COLOR_RGB2BGR))
@@ -60,46 +136,55 @@ def run_ocr_32px(img: np.ndarray, cuda: bool, quadrilaterals: List[Tuple[Quadril
 		images = einops.rearrange(images, 'N H W C -> N C H W')
 		if cuda :
 			images = images.cuda()
-		ret = ocr_infer_bacth(images, MODEL_32PX, widths)
-		for i, (pred_chars_index, prob, fr, fg, fb, br, bg, bb) in enumerate(ret) :
-			if prob < config.prob_threshold :
+		for i, ret in enumerate(infer_chunk(images, widths, config)) :
+			if ret is None :
 				continue
-			fr = (torch.clip(fr.view(-1), 0, 1).mean() * 255).long().item()
-			fg = (torch.clip(fg.view(-1), 0, 1).mean() * 255).long().item()
-			fb = (torch.clip(fb.view(-1), 0, 1).mean() * 255).long().item()
-			br = (torch.clip(br.view(-1), 0, 1).mean() * 255).long().item()
-			bg = (torch.clip(bg.view(-1), 0, 1).mean() * 255).long().item()
-			bb = (torch.clip(bb.view(-1), 0, 1).mean() * 255).long().item()
-			seq = []
-			for chid in pred_chars_index :
-				ch = MODEL_32PX.dictionary[chid]
-				if ch == '<S>' :
-					continue
-				if ch == '</S>' :
-					break
-				if ch == '<SP>' :
-					ch = ' '
-				seq.append(ch)
-			txt = ''.join(seq)
-			print(prob, txt, f'fg: ({fr}, {fg}, {fb})', f'bg: ({br}, {bg}, {bb})')
-			cur_region = quadrilaterals[indices[i]][0]
-			cur_region.text = txt
-			cur_region.prob = prob
-			cur_region.fg_r = fr
-			cur_region.fg_g = fg
-			cur_region.fg_b = fb
-			cur_region.bg_r = br
-			cur_region.bg_g = bg
-			cur_region.bg_b = bb
-			out_regions.append(cur_region)
+			txt, prob, fg, bg = ret
+			print(prob, txt, f'fg: {fg}', f'bg: {bg}')
+			results.append((indices[i], txt, prob, fg, bg))
+	if regions :
+		elapsed = max(time.time() - start, 1e-6)
+		print(f' -- OCR: {len(regions)} lines in {elapsed:.2f}s ({len(regions) / elapsed:.1f} lines/s), padding efficiency {used_columns / padded_columns:.1%}')
+	return results
+
+def set_region_result(region: Quadrilateral, txt: str, prob: float, fg: Tuple[int, int, int], bg: Tuple[int, int, int]) :
+	region.text = txt
+	region.prob = prob
+	region.fg_r, region.fg_g, region.fg_b = fg
+	region.bg_r, region.bg_g, region.bg_b = bg
+	return region
+
+def run_ocr(img: np.ndarray, cuda: bool, quadrilaterals: List[Tuple[Quadrilateral, str]], config, model_name: str = '32px', verbose: bool = False) :
+	text_height, _ = OCR_ENGINES[model_name]
+	regions = [q.get_transformed_region(img, d, text_height) for q, d in quadrilaterals]
+	results = infer_regions(regions, [d for _, d in quadrilaterals], cuda, config, model_name, verbose)
+	return [set_region_result(quadrilaterals[idx][0], txt, prob, fg, bg) for idx, txt, prob, fg, bg in results]
+
+def run_ocr_batch(imgs: List[np.ndarray], cuda: bool, quadrilaterals_list: List[List[Tuple[Quadrilateral, str]]], config, model_name: str = '32px', verbose: bool = False) :
+	"""
+	OCR textlines of many pages together so every batch is full and made of crops of similar width
+	"""
+	text_height, _ = OCR_ENGINES[model_name]
+	regions = []
+	owners = []
+	for page, (img, quadrilaterals) in enumerate(zip(imgs, quadrilaterals_list)) :
+		for q, d in quadrilaterals :
+			regions.append(q.get_transformed_region(img, d, text_height))
+			owners.append((page, q, d))
+	results = infer_regions(regions, [d for _, _, d in owners], cuda, config, model_name, verbose)
+	out_regions = [[] for _ in imgs]
+	for idx, txt, prob, fg, bg in results :
+		page, q, _ = owners[idx]
+		out_regions[page].append(set_region_result(q, txt, prob, fg, bg))
 	return out_regions
 
 def generate_text_direction(bboxes: List[Quadrilateral]) :
 	G = nx.Graph()
 	for i, box in enumerate(bboxes) :
 		G.add_node(i, box = box)
-	for ((u, ubox), (v, vbox)) in itertools.combinations(enumerate(bboxes), 2) :
-		if quadrilateral_can_merge_region(ubox, vbox) :
+	# only pairs within the discard_connection_gap of quadrilateral_can_merge_region can pass it
+	for (u, v) in candidate_pairs(bboxes, 5) :
+		if quadrilateral_can_merge_region(bboxes[u], bboxes[v]) :
 			G.add_edge(u, v)
 	for node_set in nx.algorithms.components.connected_components(G) :
 		nodes = list(node_set)
@@ -117,5 +202,13 @@ def generate_text_direction(bboxes: List[Quadrilateral]) :
 
 async def dispatch(img: np.ndarray, textlines: List[Quadrilateral], cuda: bool, args: dict, config, model_name: str = '32px', verbose: bool = False) -> List[Quadrilateral] :
 	print(' -- Running OCR')
-	if model_name == '32px' :
-		return run_ocr_32px(img, cuda, list(generate_text_direction(textlines)), config)
+	if model_name in OCR_ENGINES :
+		return run_ocr(img, cuda, list(generate_text_direction(textlines)), config, model_name, verbose)
+
+async def dispatch_batch(imgs: List[np.ndarray], textlines_list: List[List[Quadrilateral]], cuda: bool, args: dict, config, model_name: str = '32px', verbose: bool = False) -> List[List[Quadrilateral]] :
+	"""
+	OCR several pages at once, returns the recognized textlines of each page
+	"""
+	print(f' -- Running OCR on {len(imgs)} images')
+	if model_name in OCR_ENGINES :
+		return run_ocr_batch(imgs, cuda, [list(generate_text_direction(textlines)) for textlines in textlines_list], config, model_name, verbose)
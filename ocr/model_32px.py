@@ -1,5 +1,4 @@
 
-from collections import defaultdict
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -239,100 +238,42 @@ class Beam :
 			torch.cat([self.logprobs, logprob.unsqueeze(0)], dim = -1),
 		)
 
-DECODE_BLOCK_LENGTH = 8
-
-class Hypothesis :
-	def __init__(self, device, start_tok: int, end_tok: int, padding_tok: int, memory_idx: int, num_layers: int, embd_dim: int) :
-		self.device = device
-		self.start_tok = start_tok
-		self.end_tok = end_tok
-		self.padding_tok = padding_tok
-		self.memory_idx = memory_idx
-		self.embd_size = embd_dim
-		self.num_layers = num_layers
-		# L, 1, E
-		self.cached_activations = [torch.zeros(0, 1, self.embd_size).to(self.device)] * (num_layers + 1)
-		self.out_idx = torch.LongTensor([start_tok]).to(self.device)
-		self.out_logprobs = torch.FloatTensor([0]).to(self.device)
-		self.length = 0
-
-	def seq_end(self) :
-		return self.out_idx.view(-1)[-1] == self.end_tok
-
-	def logprob(self) :
-		return self.out_logprobs.mean().item()
-
-	def sort_key(self) :
-		return -self.logprob()
-
-	def prob(self) :
-		return self.out_logprobs.mean().exp().item()
-
-	def __len__(self) :
-		return self.length
-
-	def extend(self, idx, logprob) :
-		ret = Hypothesis(self.device, self.start_tok, self.end_tok, self.padding_tok, self.memory_idx, self.num_layers, self.embd_size)
-		ret.cached_activations = [item.clone() for item in self.cached_activations]
-		ret.length = self.length + 1
-		ret.out_idx = torch.cat([self.out_idx, torch.LongTensor([idx]).to(self.device)], dim = 0)
-		ret.out_logprobs = torch.cat([self.out_logprobs, torch.FloatTensor([logprob]).to(self.device)], dim = 0)
-		return ret
-
-	def output(self) :
-		return self.cached_activations[-1]
-
-def next_token_batch(
-	hyps: List[Hypothesis],
-	memory: torch.Tensor, # S, K, E
-	memory_mask: torch.BoolTensor,
-	decoders: nn.TransformerDecoder,
-	pe: PositionalEncoding,
-	embd: nn.Embedding
+def beam_decode_step(
+	x: torch.FloatTensor, # B, E
+	t: int,
+	self_k: torch.FloatTensor, # num_layers, B, L, E
+	self_v: torch.FloatTensor, # num_layers, B, L, E
+	memory_k: List[torch.FloatTensor], # num_layers * [N, H, S, D]
+	memory_v: List[torch.FloatTensor], # num_layers * [N, H, S, D]
+	memory_mask: torch.FloatTensor, # N, 1, 1, S
+	decoders: nn.TransformerDecoder
 	) :
+	"""
+	Run one decoding step of all beams, keys and values of earlier steps are read from self_k and self_v and this step's are written to position t
+	"""
 	layer: nn.TransformerDecoderLayer
-	N = len(hyps)
-
-	# N
-	last_toks = torch.stack([item.out_idx[-1] for item in hyps], dim = 0)
-	# 1, N, E
-	tgt: torch.FloatTensor = pe(embd(last_toks).unsqueeze_(0), offset = len(hyps[0]))
-
-	# # L, N
-	# out_idxs = torch.stack([item.out_idx for item in hyps], dim = 0).permute(1, 0)
-	# # L, N, E
-	# tgt2: torch.FloatTensor = pe(embd(out_idxs))
-	# # 1, N, E
-	# tgt_v2 = tgt2[-1, :, :].unsqueeze_(0)
-	# print(((tgt_v1 - tgt_v2) ** 2).sum())
-
-	# tgt = tgt_v2
-
-	# S, N, E
-	memory = torch.stack([memory[:, idx, :] for idx in [item.memory_idx for item in hyps]], dim = 1)
+	B, E = x.shape
+	N = memory_mask.size(0)
+	H = decoders.layers[0].self_attn.num_heads
+	D = E // H
+	scale = D ** -0.5
 	for l, layer in enumerate(decoders.layers) :
-		# TODO: keys and values are recomputed everytime
-		# L - 1, N, E
-		combined_activations = torch.cat([item.cached_activations[l] for item in hyps], dim = 1)
-		# L, N, E
-		combined_activations = torch.cat([combined_activations, tgt], dim = 0)
-		for i in range(N) :
-			hyps[i].cached_activations[l] = combined_activations[:, i: i + 1, :]
-		tgt2 = layer.self_attn(tgt, combined_activations, combined_activations)[0]
-		tgt = tgt + layer.dropout1(tgt2)
-		tgt = layer.norm1(tgt)
-		tgt2 = layer.multihead_attn(tgt, memory, memory, key_padding_mask = memory_mask)[0]
-		tgt = tgt + layer.dropout2(tgt2)
-		tgt = layer.norm2(tgt)
-		tgt2 = layer.linear2(layer.dropout(layer.activation(layer.linear1(tgt))))
-		tgt = tgt + layer.dropout3(tgt2)
-		# 1, N, E
-		tgt = layer.norm3(tgt)
-	#print(tgt[0, 0, 0])
-	for i in range(N) :
-		hyps[i].cached_activations[decoders.num_layers] = torch.cat([hyps[i].cached_activations[decoders.num_layers], tgt[:, i: i + 1, :]], dim = 0)
-	# N, E
-	return tgt.squeeze_(0)
+		q, k, v = F.linear(x, layer.self_attn.in_proj_weight, layer.self_attn.in_proj_bias).chunk(3, dim = -1)
+		self_k[l, :, t] = k
+		self_v[l, :, t] = v
+		# B, H, t + 1
+		attn = torch.einsum('bhd,bthd->bht', q.view(B, H, D) * scale, self_k[l, :, : t + 1].view(B, t + 1, H, D)).softmax(-1)
+		x2 = torch.einsum('bht,bthd->bhd', attn, self_v[l, :, : t + 1].view(B, t + 1, H, D)).reshape(B, E)
+		x = layer.norm1(x + layer.dropout1(layer.self_attn.out_proj(x2)))
+		# beams of one sample are next to each other, so every sample's k beams attend to its memory together
+		q = F.linear(x, layer.multihead_attn.in_proj_weight[: E], layer.multihead_attn.in_proj_bias[: E])
+		q = einops.rearrange(q * scale, '(n k) (h d) -> n h k d', n = N, h = H)
+		attn = (torch.matmul(q, memory_k[l].transpose(-1, -2)) + memory_mask).softmax(-1)
+		x2 = einops.rearrange(torch.matmul(attn, memory_v[l]), 'n h k d -> (n k) (h d)')
+		x = layer.norm2(x + layer.dropout2(layer.multihead_attn.out_proj(x2)))
+		x2 = layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+		x = layer.norm3(x + layer.dropout3(x2))
+	return x
 
 class OCR(nn.Module) :
 	def __init__(self, dictionary, max_len):
@@ -396,64 +337,110 @@ class OCR(nn.Module) :
 			input_mask[i, l:] = True
 		feats = self.pe(feats)
 		memory = self.encoders(feats, src_key_padding_mask = input_mask)
-		hypos = [Hypothesis(img.device, start_tok, end_tok, pad_tok, i, self.decoders.num_layers, 320) for i in range(N)]
-		# N, E
-		decoded = next_token_batch(hypos, memory, input_mask, self.decoders, self.pe, self.embd)
-		# N, n_chars
-		pred_char_logprob = self.pred(self.pred1(decoded)).log_softmax(-1)
-		# N, k
-		pred_chars_values, pred_chars_index = torch.topk(pred_char_logprob, beams_k, dim = 1)
-		new_hypos = []
-		finished_hypos = defaultdict(list)
-		for i in range(N) :
-			for k in range(beams_k) :
-				new_hypos.append(hypos[i].extend(pred_chars_index[i, k], pred_chars_values[i, k]))
-		hypos = new_hypos
-		for _ in range(max_seq_length) :
-			# N * k, E
-			decoded = next_token_batch(hypos, memory, torch.stack([input_mask[hyp.memory_idx] for hyp in hypos]) , self.decoders, self.pe, self.embd)
-			# N * k, n_chars
-			pred_char_logprob = self.pred(self.pred1(decoded)).log_softmax(-1)
-			# N * k, k
-			pred_chars_values, pred_chars_index = torch.topk(pred_char_logprob, beams_k, dim = 1)
-			hypos_per_sample = defaultdict(list)
-			h: Hypothesis
-			for i, h in enumerate(hypos) :
-				for k in range(beams_k) :
-					hypos_per_sample[h.memory_idx].append(h.extend(pred_chars_index[i, k], pred_chars_values[i, k]))
-			hypos = []
-			# hypos_per_sample now contains N * k^2 hypos
-			for i in hypos_per_sample.keys() :
-				cur_hypos: List[Hypothesis] = hypos_per_sample[i]
-				cur_hypos = sorted(cur_hypos, key = lambda a: a.sort_key())[: beams_k + 1]
-				#print(cur_hypos[0].out_idx[-1])
-				to_added_hypos = []
-				sample_done = False
-				for h in cur_hypos :
-					if h.seq_end() :
-						finished_hypos[i].append(h)
-						if len(finished_hypos[i]) >= max_finished_hypos :
-							sample_done = True
-							break
-					else :
-						if len(to_added_hypos) < beams_k :
-							to_added_hypos.append(h)
-				if not sample_done :
-					hypos.extend(to_added_hypos)
-			if len(hypos) == 0 :
+		device = img.device
+		S, _, E = memory.shape
+		K = beams_k
+		B = N * K
+		L = max_seq_length + 1
+		num_layers = self.decoders.num_layers
+		num_heads = self.decoders.layers[0].multihead_attn.num_heads
+		# keys and values of the memory are the same at every step, project them once
+		memory_k, memory_v = [], []
+		for layer in self.decoders.layers :
+			_, wk, wv = layer.multihead_attn.in_proj_weight.chunk(3)
+			_, bk, bv = layer.multihead_attn.in_proj_bias.chunk(3)
+			memory_k.append(einops.rearrange(F.linear(memory, wk, bk), 's n (h d) -> n h s d', h = num_heads))
+			memory_v.append(einops.rearrange(F.linear(memory, wv, bv), 's n (h d) -> n h s d', h = num_heads))
+		memory_mask = torch.zeros(N, 1, 1, S, device = device).masked_fill_(input_mask[:, None, None, :], float('-inf'))
+		# beam b belongs to sample b // K, every beam has its own slot in the caches below
+		self_k = torch.zeros(num_layers, B, L, E, device = device)
+		self_v = torch.zeros(num_layers, B, L, E, device = device)
+		outputs = torch.zeros(B, L, E, device = device)
+		tokens = torch.full((B, L + 1), pad_tok, dtype = torch.long, device = device)
+		tokens[:, 0] = start_tok
+		# sum of logprobs of each beam, -inf marks an empty slot
+		scores = torch.zeros(B, device = device)
+		# finished hypotheses, up to max_finished_hypos per sample
+		finished_count = torch.zeros(N, dtype = torch.long, device = device)
+		finished_tokens = torch.full((N, max_finished_hypos, L + 1), pad_tok, dtype = torch.long, device = device)
+		finished_outputs = torch.zeros(N, max_finished_hypos, L, E, device = device)
+		finished_length = torch.zeros(N, max_finished_hypos, dtype = torch.long, device = device)
+		finished_logprob = torch.full((N, max_finished_hypos), float('-inf'), device = device)
+		done = torch.zeros(N, dtype = torch.bool, device = device)
+		sample_idx = torch.arange(N, device = device)
+		def decode(t) :
+			x = self.pe(self.embd(tokens[:, t]).unsqueeze_(0), offset = t).squeeze_(0)
+			x = beam_decode_step(x, t, self_k, self_v, memory_k, memory_v, memory_mask, self.decoders)
+			outputs[:, t] = x
+			# B, n_chars
+			return self.pred(self.pred1(x)).log_softmax(-1)
+		# all K slots of a sample start as copies of the start token, the first step expands only one of them
+		pred_char_logprob = decode(0)
+		pred_chars_values, pred_chars_index = torch.topk(pred_char_logprob.view(N, K, -1)[:, 0], K, dim = 1)
+		tokens[:, 1] = pred_chars_index.reshape(-1)
+		scores = pred_chars_values.reshape(-1)
+		t = 0
+		for t in range(1, max_seq_length + 1) :
+			pred_char_logprob = decode(t)
+			# B, K
+			pred_chars_values, pred_chars_index = torch.topk(pred_char_logprob, K, dim = 1)
+			# N, K * K candidates, every hypothesis has the same length so the sum ranks them like the mean
+			cand_scores = (scores.unsqueeze(1) + pred_chars_values).view(N, K * K)
+			cand_tokens = pred_chars_index.view(N, K * K)
+			top_scores, top_pos = torch.topk(cand_scores, min(K + 1, K * K), dim = 1)
+			top_tokens = cand_tokens.gather(1, top_pos)
+			top_parents = sample_idx.unsqueeze(1) * K + top_pos // K
+			new_parents = torch.arange(B, device = device)
+			new_tokens = torch.full((B, ), pad_tok, dtype = torch.long, device = device)
+			new_scores = torch.full((B, ), float('-inf'), device = device)
+			kept = torch.zeros(N, dtype = torch.long, device = device)
+			for r in range(top_pos.size(1)) :
+				valid = torch.isfinite(top_scores[:, r]) & ~done
+				ended = top_tokens[:, r] == end_tok
+				finish = valid & ended
+				if finish.any() :
+					rows = finish.nonzero(as_tuple = True)[0]
+					slots = finished_count[rows]
+					parents = top_parents[rows, r]
+					finished_tokens[rows, slots, : t + 1] = tokens[parents, : t + 1]
+					finished_tokens[rows, slots, t + 1] = end_tok
+					finished_outputs[rows, slots, : t + 1] = outputs[parents, : t + 1]
+					finished_length[rows, slots] = t + 1
+					# mean over the t + 1 chars and the start token's logprob of 0
+					finished_logprob[rows, slots] = top_scores[rows, r] / (t + 2)
+					finished_count += finish
+					done |= finished_count >= max_finished_hypos
+				keep = valid & ~ended & (kept < K)
+				rows = keep.nonzero(as_tuple = True)[0]
+				slots = rows * K + kept[rows]
+				new_parents[slots] = top_parents[rows, r]
+				new_tokens[slots] = top_tokens[rows, r]
+				new_scores[slots] = top_scores[rows, r]
+				kept += keep
+			new_scores.masked_fill_(done.repeat_interleave(K), float('-inf'))
+			# move every kept hypothesis into its slot
+			self_k[:, :, : t + 1] = self_k[:, new_parents, : t + 1]
+			self_v[:, :, : t + 1] = self_v[:, new_parents, : t + 1]
+			outputs[:, : t + 1] = outputs[new_parents, : t + 1]
+			tokens[:, : t + 1] = tokens[new_parents, : t + 1]
+			tokens[:, t + 1] = new_tokens
+			scores = new_scores
+			if not torch.isfinite(scores).any() :
 				break
-		# add remaining hypos to finished
-		for i in range(N) :
-			if i not in finished_hypos :
-				cur_hypos: List[Hypothesis] = hypos_per_sample[i]
-				cur_hypo = sorted(cur_hypos, key = lambda a: a.sort_key())[0]
-				finished_hypos[i].append(cur_hypo)
-		assert len(finished_hypos) == N
 		result = []
 		for i in range(N) :
-			cur_hypos = finished_hypos[i]
-			cur_hypo = sorted(cur_hypos, key = lambda a: a.sort_key())[0]
-			decoded = cur_hypo.output()
+			if finished_count[i] > 0 :
+				best = finished_logprob[i].argmax()
+				out_idx = finished_tokens[i, best, : finished_length[i, best] + 1]
+				decoded = finished_outputs[i, best, : finished_length[i, best]]
+				logprob = finished_logprob[i, best]
+			else :
+				# nothing finished, slot 0 holds the best unfinished hypothesis
+				out_idx = tokens[i * K, : t + 2]
+				decoded = outputs[i * K, : t + 1]
+				logprob = scores[i * K] / (t + 2)
+			# L, 1, E
+			decoded = decoded.unsqueeze(1)
 			color_feats = self.color_pred1(decoded)
 			fg_r, fg_g, fg_b, bg_r, bg_g, bg_b = self.fg_r_pred(color_feats), \
 				self.fg_g_pred(color_feats), \
@@ -461,7 +448,7 @@ class OCR(nn.Module) :
 				self.bg_r_pred(color_feats), \
 				self.bg_g_pred(color_feats), \
 				self.bg_b_pred(color_feats)
-			result.append((cur_hypo.out_idx, cur_hypo.prob(), fg_r, fg_g, fg_b, bg_r, bg_g, bg_b))
+			result.append((out_idx, logprob.exp().item(), fg_r, fg_g, fg_b, bg_r, bg_g, bg_b))
 		return result
 
 	def infer_beam(self, img: torch.FloatTensor, beams_k: int = 5, start_tok = 1, end_tok = 2, pad_tok = 0, max_seq_length = 384) :
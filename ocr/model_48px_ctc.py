@@ -221,38 +221,22 @@ class OCR(nn.Module) :
 		return self.decode_ctc_top1(pred_char_logits, pred_color_values, blank)
 
 	def decode_ctc_top1(self, pred_char_logits, pred_color_values, blank) -> List[List[Tuple[str, float, int, int, int, int, int, int]]] :
-		pred_chars: List[List[Tuple[str, float, int, int, int, int, int, int]]] = []
-		for _ in range(pred_char_logits.size(0)) :
-			pred_chars.append([])
 		logprobs = pred_char_logits.log_softmax(2)
-		_, preds_index = logprobs.max(2)
+		preds_logprob, preds_index = logprobs.max(2)
+		# collapse repeats and drop blanks, a char is kept where it differs from the previous timestep and is not blank
+		prev_index = torch.cat([torch.full_like(preds_index[:, : 1], blank), preds_index[:, : -1]], dim = 1)
+		keep = (preds_index != prev_index) & (preds_index != blank)
+		for b, t in (keep & (preds_logprob < math.log(0.96))).nonzero().tolist() :
+			top5 = torch.topk(logprobs[b, t], 5)
+			print(''.join(f'{self.dictionary[idx]}: {math.exp(val)}, ' for idx, val in zip(top5.indices.tolist(), top5.values.tolist())))
+		keep = keep.cpu()
 		preds_index = preds_index.cpu()
+		preds_logprob = preds_logprob.cpu()
 		pred_color_values = pred_color_values.cpu()
+		pred_chars: List[List[Tuple[str, float, int, int, int, int, int, int]]] = []
 		for b in range(pred_char_logits.size(0)) :
-			last_ch = blank
-			for t in range(pred_char_logits.size(1)) :
-				pred_ch = preds_index[b, t]
-				if pred_ch != last_ch and pred_ch != blank :
-					lp = logprobs[b, t, pred_ch].item()
-					if lp < math.log(0.96) :
-						top5 = torch.topk(logprobs[b, t], 5)
-						top5_idx = top5.indices
-						top5_val = top5.values
-						r = ''
-						for i in range(5) :
-							r += f'{self.dictionary[top5_idx[i]]}: {math.exp(top5_val[i])}, '
-						print(r)
-					pred_chars[b].append((
-						pred_ch,
-						lp,
-						pred_color_values[b, t][0].item(),
-						pred_color_values[b, t][1].item(),
-						pred_color_values[b, t][2].item(),
-						pred_color_values[b, t][3].item(),
-						pred_color_values[b, t][4].item(),
-						pred_color_values[b, t][5].item()
-					))
-				last_ch = pred_ch
+			colors = pred_color_values[b][keep[b]].tolist()
+			pred_chars.append([(ch, lp, *color) for ch, lp, color in zip(preds_index[b][keep[b]].tolist(), preds_logprob[b][keep[b]].tolist(), colors)])
 		return pred_chars
 
 	def eval_ocr(self, input_lengths, target_lengths, pred_char_logits, pred_color_values, gt_char_index, gt_color_values, blank, blank1) :
@@ -5,12 +5,22 @@ from utils import Quadrilateral
 import cv2
 import numpy as np
 
-from .text_mask_utils import complete_mask_fill, filter_masks, complete_mask
+from .text_mask_utils import complete_mask_fill, filter_masks, complete_mask, refine_mask, refine_mask_fast
 
-async def dispatch(raw_image: np.ndarray, raw_mask: np.ndarray, textlines: List[Quadrilateral], method: str = 'fit_text', verbose: bool = False) -> np.ndarray :
+METHODS = ['fit_text', 'fast', 'fill']
+
+async def dispatch(raw_image: np.ndarray, raw_mask: np.ndarray, textlines: List[Quadrilateral], method: str = 'fit_text', verbose: bool = False, img_filtered: np.ndarray = None) -> np.ndarray :
+	"""
+	method is fit_text (CRF refinement), fast (guided filter refinement, no CRF) or fill (whole textline boxes)
+	img_filtered is raw_image bilateral filtered at any resolution, e.g. the one shared with detection, refinement filters the image itself if it is not given
+	"""
+	if method not in METHODS :
+		raise Exception(f'Unknown mask refinement method {method}')
 	mask_resized = cv2.resize(raw_mask, (raw_image.shape[1] // 2, raw_image.shape[0] // 2), interpolation = cv2.INTER_LINEAR)
 	img_resized_2 = cv2.resize(raw_image, (raw_image.shape[1] // 2, raw_image.shape[0] // 2), interpolation = cv2.INTER_LINEAR)
 	mask_resized[mask_resized > 0] = 255
+	if img_filtered is not None :
+		img_filtered = cv2.resize(img_filtered, (img_resized_2.shape[1], img_resized_2.shape[0]), interpolation = cv2.INTER_LINEAR)
 	text_lines = [(a.aabb.x // 2, a.aabb.y // 2, a.aabb.w // 2, a.aabb.h // 2) for a in textlines]
 	mask_ccs, cc2textline_assignment = filter_masks(mask_resized, text_lines)
 	if mask_ccs :
@@ -18,7 +28,9 @@ async def dispatch(raw_image: np.ndarray, raw_mask: np.ndarray, textlines: List[
 		#cv2.imwrite(f'result/{task_id}/mask_filtered.png', mask_filtered)
 		#cv2.imwrite(f'result/{task_id}/mask_filtered_img.png', overlay_mask(img_resized_2, mask_filtered))
 		if method == 'fit_text' :
-			final_mask = complete_mask(img_resized_2, mask_ccs, text_lines, cc2textline_assignment)
+			final_mask = complete_mask(img_resized_2, mask_ccs, text_lines, cc2textline_assignment, refine_mask, img_filtered)
+		elif method == 'fast' :
+			final_mask = complete_mask(img_resized_2, mask_ccs, text_lines, cc2textline_assignment, refine_mask_fast, img_filtered)
 		else :
 			final_mask = complete_mask_fill(img_resized_2, mask_ccs, text_lines, cc2textline_assignment)
 		#cv2.imwrite(f'result/{task_id}/mask.png', final_mask)
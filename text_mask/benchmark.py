@@ -0,0 +1,134 @@
+"""
+Time and peak allocations of filter_masks on synthetic dense pages against the per-component version it replaced, run from the repository root:
+python -m text_mask.benchmark [--pages 768x1024x60 1400x2048x120] [--reference-limit 1000]
+"""
+
+import argparse
+import math
+import time
+import tracemalloc
+from typing import List, Tuple
+import cv2
+import numpy as np
+
+from text_mask.text_mask_utils import filter_masks
+
+parser = argparse.ArgumentParser(description = 'Benchmark connected component filtering on synthetic dense pages')
+parser.add_argument('--pages', nargs = '+', default = ['768x1024x60', '1400x2048x120'], type = str, help = 'pages as WIDTHxHEIGHTxTEXTLINES')
+parser.add_argument('--chars', default = 10, type = int, help = 'characters per textline')
+parser.add_argument('--reference-limit', default = 1000, type = int, help = 'only run the per-component version on pages with at most this many components, it holds a full page copy of each')
+parser.add_argument('--seed', default = 0, type = int, help = 'random seed')
+
+def rect_distance(x1, y1, x1b, y1b, x2, y2, x2b, y2b) :
+	left = x2b < x1
+	right = x1b < x2
+	bottom = y2b < y1
+	top = y1b < y2
+	if top and left :
+		return math.hypot(x1 - x2b, y1b - y2)
+	elif left and bottom :
+		return math.hypot(x1 - x2b, y1 - y2b)
+	elif bottom and right :
+		return math.hypot(x1b - x2, y1 - y2b)
+	elif right and top :
+		return math.hypot(x1b - x2, y1b - y2)
+	elif left :
+		return x1 - x2b
+	elif right :
+		return x2 - x1b
+	elif bottom :
+		return y1 - y2b
+	elif top :
+		return y2 - y1b
+	return 0.
+
+def filter_masks_per_component(mask_img: np.ndarray, text_lines: List[Tuple[int, int, int, int]], keep_threshold = 1e-2) :
+	# what filter_masks did before, a full page mask per component and a Python loop over textlines, with the distance unit of the nearest textline
+	mask_img = mask_img.copy()
+	for (x, y, w, h) in text_lines :
+		cv2.rectangle(mask_img, (x, y), (x + w, y + h), (0), 1)
+	if len(text_lines) == 0 :
+		return [], []
+	num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask_img)
+	cc2textline_assignment = []
+	result = []
+	M = len(text_lines)
+	ratio_mat = np.zeros(shape = (num_labels, M), dtype = np.float32)
+	dist_mat = np.zeros(shape = (num_labels, M), dtype = np.float32)
+	for i in range(1, num_labels) :
+		if stats[i, cv2.CC_STAT_AREA] <= 9 :
+			continue
+		cc = np.zeros_like(mask_img)
+		cc[labels == i] = 255
+		x1, y1, w1, h1 = cv2.boundingRect(cc)
+		for j in range(M) :
+			x2, y2, w2, h2 = text_lines[j]
+			overlap = max(0, min(x1 + w1, x2 + w2) - max(x1, x2)) * max(0, min(y1 + h1, y2 + h2) - max(y1, y2))
+			ratio_mat[i, j] = overlap / min(w1 * h1, w2 * h2)
+			dist_mat[i, j] = rect_distance(x1, y1, x1 + w1, y1 + h1, x2, y2, x2 + w2, y2 + h2)
+		j = np.argmax(ratio_mat[i])
+		if ratio_mat[i, j] > keep_threshold :
+			cc2textline_assignment.append(j)
+			result.append(np.copy(cc))
+		else :
+			j = np.argmin(dist_mat[i])
+			# the old version took w2 and h2 of the last textline in the loop, use the nearest one like filter_masks so results compare
+			_, _, w2, h2 = text_lines[j]
+			unit = min([h1, w1, h2, w2])
+			if dist_mat[i, j] < 0.5 * unit :
+				cc2textline_assignment.append(j)
+				result.append(np.copy(cc))
+	return result, cc2textline_assignment
+
+def dense_page(width: int, height: int, lines: int, chars: int, rng: np.random.Generator) :
+	"""
+	Vertical textlines of small character blobs, and as many noise blobs away from them
+	"""
+	mask = np.zeros((height, width), dtype = np.uint8)
+	text_lines = []
+	for _ in range(lines) :
+		x, y = int(rng.integers(0, width - 30)), int(rng.integers(0, height - 30 * chars))
+		text_lines.append((x, y, 24, 26 * chars))
+		for c in range(chars) :
+			cv2.ellipse(mask, (x + 12, y + 13 + 26 * c), (int(rng.integers(4, 10)), int(rng.integers(4, 10))), 0, 0, 360, 255, -1)
+	for _ in range(lines) :
+		cv2.circle(mask, (int(rng.integers(0, width)), int(rng.integers(0, height))), int(rng.integers(2, 6)), 255, -1)
+	return mask, text_lines
+
+def measure(fn, mask: np.ndarray, text_lines) :
+	start = time.perf_counter()
+	result = fn(mask, text_lines)
+	elapsed = time.perf_counter() - start
+	tracemalloc.start()
+	fn(mask, text_lines)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return result, elapsed, peak
+
+def benchmark(args) :
+	rng = np.random.default_rng(args.seed)
+	for page in args.pages :
+		width, height, lines = [int(v) for v in page.split('x')]
+		mask, text_lines = dense_page(width, height, lines, args.chars, rng)
+		# filter_masks cuts components along textline borders first, count them the same way
+		cut = mask.copy()
+		for (x, y, w, h) in text_lines :
+			cv2.rectangle(cut, (x, y), (x + w, y + h), (0), 1)
+		num_components = cv2.connectedComponents(cut)[0] - 1
+		(ccs, assignment), elapsed, peak = measure(filter_masks, mask, text_lines)
+		print(f'{width}x{height}, {lines} textlines, {num_components} components, {len(ccs)} kept:')
+		print(f'  {"vectorized":>14}: {elapsed * 1000:9.1f}ms, peak allocation {peak / 2 ** 20:7.1f}MB')
+		if num_components > args.reference_limit :
+			print(f'  {"per component":>14}: skipped, more than {args.reference_limit} components')
+			continue
+		(reference, reference_assignment), elapsed, peak = measure(filter_masks_per_component, mask, text_lines)
+		kept = []
+		for x, y, cc in ccs :
+			full = np.zeros_like(mask)
+			full[y: y + cc.shape[0], x: x + cc.shape[1]] = cc
+			kept.append(full)
+		same = len(kept) == len(reference) and all((a == b).all() for a, b in zip(kept, reference)) and list(assignment) == [int(j) for j in reference_assignment]
+		print(f'  {"per component":>14}: {elapsed * 1000:9.1f}ms, peak allocation {peak / 2 ** 20:7.1f}MB, {"same" if same else "DIFFERENT"} components and assignments')
+
+if __name__ == '__main__' :
+	benchmark(parser.parse_args())
@@ -0,0 +1,48 @@
+"""
+Compare mask refinement methods against the CRF (fit_text) mask, run from the repository root:
+python -m text_mask.compare_methods [--use-cuda] [--size 1536] demo/original1.jpg demo/original2.jpg ...
+"""
+
+import argparse
+import asyncio
+import time
+import cv2
+import numpy as np
+
+from detection import dispatch as dispatch_detection
+from text_mask import dispatch as dispatch_mask_refinement, METHODS
+
+parser = argparse.ArgumentParser(description = 'Compare speed and quality of mask refinement methods')
+parser.add_argument('images', nargs = '+', type = str, help = 'images to compare on')
+parser.add_argument('--size', default = 1536, type = int, help = 'image square size used for text detection')
+parser.add_argument('--use-cuda', action = 'store_true', help = 'run text detection with cuda')
+parser.add_argument('--unclip-ratio', default = 2.3, type = float, help = 'How much to extend text skeleton to form bounding box')
+parser.add_argument('--box-threshold', default = 0.7, type = float, help = 'threshold for bbox generation')
+parser.add_argument('--text-threshold', default = 0.5, type = float, help = 'threshold for text detection')
+
+def mask_iou(a: np.ndarray, b: np.ndarray) :
+	a, b = a > 0, b > 0
+	union = np.count_nonzero(a | b)
+	return np.count_nonzero(a & b) / union if union else 1.0
+
+async def compare(args) :
+	totals = {method: [0.0, 0.0] for method in METHODS}
+	for path in args.images :
+		img = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+		textlines, mask = await dispatch_detection(img, args.size, args.use_cuda, args)
+		print(f'{path}: {img.shape[1]}x{img.shape[0]}, {len(textlines)} textlines')
+		masks = {}
+		for method in METHODS :
+			start = time.perf_counter()
+			masks[method] = await dispatch_mask_refinement(img, mask, textlines, method)
+			elapsed = time.perf_counter() - start
+			iou = mask_iou(masks[method], masks['fit_text'])
+			totals[method][0] += elapsed
+			totals[method][1] += iou
+			print(f'  {method:>8}: {elapsed * 1000:8.1f}ms, IoU with fit_text {iou:.3f}, {np.count_nonzero(masks[method]) / masks[method].size * 100:.2f}% of page masked')
+	print(f'Average over {len(args.images)} images:')
+	for method, (elapsed, iou) in totals.items() :
+		print(f'  {method:>8}: {elapsed / len(args.images) * 1000:8.1f}ms, IoU with fit_text {iou / len(args.images):.3f}')
+
+if __name__ == '__main__' :
+	asyncio.run(compare(parser.parse_args()))
@@ -2,9 +2,9 @@
 from typing import Tuple, List
 import numpy as np
 import cv2
-import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 
-from tqdm import tqdm
 from sklearn.mixture import BayesianGaussianMixture
 from functools import reduce
 from collections import defaultdict
@@ -18,39 +18,11 @@ def save_rgb(fn, img) :
 	else :
 		cv2.imwrite(fn, img)
 
-def area(x1, y1, w1, h1, x2, y2, w2, h2):  # returns None if rectangles don't intersect
-	x_overlap = max(0, min(x1 + w1, x2 + w2) - max(x1, x2))
-	y_overlap = max(0, min(y1 + h1, y2 + h2) - max(y1, y2))
-	return x_overlap * y_overlap
-
-def dist(x1, y1, x2, y2) :
-	return math.sqrt((x1 - x2) * (x1 - x2) + (y1 - y2) * (y1 - y2))
-
-def rect_distance(x1, y1, x1b, y1b, x2, y2, x2b, y2b):
-	left = x2b < x1
-	right = x1b < x2
-	bottom = y2b < y1
-	top = y1b < y2
-	if top and left:
-		return dist(x1, y1b, x2b, y2)
-	elif left and bottom:
-		return dist(x1, y1, x2b, y2b)
-	elif bottom and right:
-		return dist(x1b, y1, x2, y2b)
-	elif right and top:
-		return dist(x1b, y1b, x2, y2)
-	elif left:
-		return x1 - x2b
-	elif right:
-		return x2 - x1b
-	elif bottom:
-		return y1 - y2b
-	elif top:
-		return y2 - y1b
-	else:             # rectangles intersect
-		return 0
-
 def filter_masks(mask_img: np.ndarray, text_lines: List[Tuple[int, int, int, int]], keep_threshold = 1e-2) :
+	"""
+	Keep connected components of mask_img that overlap or are close to a textline.
+	Returns the kept components as (x, y, cc) where cc is the component's mask cropped to its bounding box at (x, y), and the textline each one is assigned to.
+	"""
 	mask_img = mask_img.copy()
 	for (x, y, w, h) in text_lines :
 		cv2.rectangle(mask_img, (x, y), (x + w, y + h), (0), 1)
@@ -58,37 +30,35 @@ def filter_masks(mask_img: np.ndarray, text_lines: List[Tuple[int, int, int, int
 		return [], []
 	num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask_img)
 
+	# K components that are not too small, against M textlines
+	cc_idx = np.nonzero(stats[1:, cv2.CC_STAT_AREA] > 9)[0] + 1
+	if len(cc_idx) == 0 :
+		return [], []
+	x1, y1, w1, h1 = [stats[cc_idx, k][:, None].astype(np.int64) for k in (cv2.CC_STAT_LEFT, cv2.CC_STAT_TOP, cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT)]
+	x2, y2, w2, h2 = [col[None, :] for col in np.array(text_lines, dtype = np.int64).reshape(-1, 4).T]
+	# K, M
+	x_overlap = np.maximum(0, np.minimum(x1 + w1, x2 + w2) - np.maximum(x1, x2))
+	y_overlap = np.maximum(0, np.minimum(y1 + h1, y2 + h2) - np.maximum(y1, y2))
+	ratio_mat = (x_overlap * y_overlap) / np.maximum(np.minimum(w1 * h1, w2 * h2), 1)
+	# gap between the rectangles along each axis, 0 if they overlap on that axis
+	dx = np.maximum(0, np.maximum(x1 - (x2 + w2), x2 - (x1 + w1)))
+	dy = np.maximum(0, np.maximum(y1 - (y2 + h2), y2 - (y1 + h1)))
+	dist_mat = np.sqrt(dx * dx + dy * dy)
+	best_ratio = np.argmax(ratio_mat, axis = 1)
+	nearest = np.argmin(dist_mat, axis = 1)
+	rows = np.arange(len(cc_idx))
+	overlapping = ratio_mat[rows, best_ratio] > keep_threshold
+	unit = np.minimum(np.minimum(w1[:, 0], h1[:, 0]), np.minimum(w2[0, nearest], h2[0, nearest]))
+	close = dist_mat[rows, nearest] < 0.5 * unit
+	assignment = np.where(overlapping, best_ratio, nearest)
+
 	cc2textline_assignment = []
 	result = []
-	M = len(text_lines)
-	ratio_mat = np.zeros(shape = (num_labels, M), dtype = np.float32)
-	dist_mat = np.zeros(shape = (num_labels, M), dtype = np.float32)
-	for i in range(1, num_labels) :
-		if stats[i, cv2.CC_STAT_AREA] <= 9 :
-			continue # skip area too small
-		cc = np.zeros_like(mask_img)
-		cc[labels == i] = 255
-		x1, y1, w1, h1 = cv2.boundingRect(cc)
-		area1 = w1 * h1
-		for j in range(M) :
-			x2, y2, w2, h2 = text_lines[j]
-			area2 = w2 * h2
-			overlapping_area = area(x1, y1, w1, h1, x2, y2, w2, h2)
-			ratio_mat[i, j] = overlapping_area / min(area1, area2)
-			dist_mat[i, j] = rect_distance(x1, y1, x1 + w1, y1 + h1, x2, y2, x2 + w2, y2 + h2)
-		j = np.argmax(ratio_mat[i])
-		unit = min([h1, w1, h2, w2])
-		if ratio_mat[i, j] > keep_threshold :
-			cc2textline_assignment.append(j)
-			result.append(np.copy(cc))
-		else :
-			j = np.argmin(dist_mat[i])
-			if dist_mat[i, j] < 0.5 * unit :
-				cc2textline_assignment.append(j)
-				result.append(np.copy(cc))
-			else :
-				# discard
-				pass
+	for k in np.nonzero(overlapping | close)[0] :
+		x, y, w, h = stats[cc_idx[k], : 4]
+		cc = (labels[y: y + h, x: x + w] == cc_idx[k]).astype(np.uint8) * 255
+		result.append((int(x), int(y), cc))
+		cc2textline_assignment.append(int(assignment[k]))
 	return result, cc2textline_assignment
 
 from pydensecrf.utils import compute_unary, unary_from_softmax
@@ -119,46 +89,98 @@ def refine_mask(rgbim, rawmask) :
 	crf_mask = np.array(res * 255, dtype=np.uint8)
 	return crf_mask
 
-def complete_mask_fill(img_np: np.ndarray, ccs: List[np.ndarray], text_lines: List[Tuple[int, int, int, int]], cc2textline_assignment) :
+def guided_filter(guide: np.ndarray, src: np.ndarray, radius: int, eps: float) :
+	"""
+	Edge preserving smoothing of src following the edges of guide, both float32 single channel
+	"""
+	ksize = (2 * radius + 1, 2 * radius + 1)
+	mean_i = cv2.boxFilter(guide, cv2.CV_32F, ksize)
+	mean_p = cv2.boxFilter(src, cv2.CV_32F, ksize)
+	var_i = cv2.boxFilter(guide * guide, cv2.CV_32F, ksize) - mean_i * mean_i
+	cov_ip = cv2.boxFilter(guide * src, cv2.CV_32F, ksize) - mean_i * mean_p
+	a = cov_ip / (var_i + eps)
+	b = mean_p - a * mean_i
+	return cv2.boxFilter(a, cv2.CV_32F, ksize) * guide + cv2.boxFilter(b, cv2.CV_32F, ksize)
+
+def refine_mask_fast(rgbim, rawmask) :
+	"""
+	CRF-free replacement of refine_mask, snaps rawmask to the edges of rgbim with a guided filter
+	"""
+	gray = cv2.cvtColor(rgbim, cv2.COLOR_RGB2GRAY).astype(np.float32) / 255.0
+	mask = rawmask.astype(np.float32) / 255.0
+	smoothed = guided_filter(gray, mask, max(min(rawmask.shape[: 2]) // 3, 2), 1e-3)
+	refined = np.array((smoothed > 0.5) * 255, dtype = np.uint8)
+	kern = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+	return cv2.morphologyEx(refined, cv2.MORPH_CLOSE, kern)
+
+def complete_mask_fill(img_np: np.ndarray, ccs: List[Tuple[int, int, np.ndarray]], text_lines: List[Tuple[int, int, int, int]], cc2textline_assignment) :
 	if len(ccs) == 0 :
 		return
+	final_mask = np.zeros(img_np.shape[: 2], dtype = np.uint8)
+	for x, y, cc in ccs :
+		final_mask[y: y + cc.shape[0], x: x + cc.shape[1]] |= cc
 	for (x, y, w, h) in text_lines :
 		final_mask = cv2.rectangle(final_mask, (x, y), (x + w, y + h), (255), -1)
 	return final_mask
 
-def complete_mask(img_np: np.ndarray, ccs: List[np.ndarray], text_lines: List[Tuple[int, int, int, int]], cc2textline_assignment) :
+def refine_textline_mask(img_np: np.ndarray, ccs: List[Tuple[int, int, np.ndarray]], refine = refine_mask, img_filtered: np.ndarray = None) :
+	"""
+	Refine the mask of one textline from its connected components with refine, working on a crop around them only.
+	img_filtered is img_np already bilateral filtered, the crop is filtered here if it is not given.
+	Returns (x, y, mask) where mask is the dilated refined mask of the crop at (x, y)
+	"""
+	height, width = img_np.shape[: 2]
+	x1 = min(x for x, _, _ in ccs)
+	y1 = min(y for _, y, _ in ccs)
+	x2 = max(x + cc.shape[1] for x, _, cc in ccs)
+	y2 = max(y + cc.shape[0] for _, y, cc in ccs)
+	w1, h1 = x2 - x1, y2 - y1
+	text_size = min(w1, h1)
+	extend_size = int(text_size * 0.1)
+	dilate_size = max((int(text_size * 0.3) // 2) * 2 + 1, 3)
+	# crop holding the components, the region refined around them and room for the dilation, clamped to the page
+	pad = extend_size + dilate_size // 2 + 1
+	rx1, ry1 = max(x1 - pad, 0), max(y1 - pad, 0)
+	rx2, ry2 = min(x2 + pad, width), min(y2 + pad, height)
+	cc = np.zeros((ry2 - ry1, rx2 - rx1), dtype = np.uint8)
+	for x, y, cc_crop in ccs :
+		cc[y - ry1: y - ry1 + cc_crop.shape[0], x - rx1: x - rx1 + cc_crop.shape[1]] |= cc_crop
+	x1 = max(x1 - extend_size, 0)
+	y1 = max(y1 - extend_size, 0)
+	w1 += extend_size * 2
+	h1 += extend_size * 2
+	w1 = min(w1, width - x1 - 1)
+	h1 = min(h1, height - y1 - 1)
+	if w1 <= 0 or h1 <= 0 :
+		return None
+	if img_filtered is None :
+		# bilateral filter needs 8 pixels of context on each side to match filtering the whole page
+		fx1, fy1 = max(x1 - 8, 0), max(y1 - 8, 0)
+		fx2, fy2 = min(x1 + w1 + 8, width), min(y1 + h1 + 8, height)
+		img_region = cv2.bilateralFilter(np.ascontiguousarray(img_np[fy1: fy2, fx1: fx2]), 17, 80, 80)
+		img_region = np.ascontiguousarray(img_region[y1 - fy1: y1 - fy1 + h1, x1 - fx1: x1 - fx1 + w1])
+	else :
+		img_region = np.ascontiguousarray(img_filtered[y1: y1 + h1, x1: x1 + w1])
+	cc_region = np.ascontiguousarray(cc[y1 - ry1: y1 - ry1 + h1, x1 - rx1: x1 - rx1 + w1])
+	cc[y1 - ry1: y1 - ry1 + h1, x1 - rx1: x1 - rx1 + w1] = refine(img_region, cc_region)
+	kern = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (dilate_size, dilate_size))
+	return rx1, ry1, cv2.dilate(cc, kern)
+
+def complete_mask(img_np: np.ndarray, ccs: List[Tuple[int, int, np.ndarray]], text_lines: List[Tuple[int, int, int, int]], cc2textline_assignment, refine = refine_mask, img_filtered: np.ndarray = None) :
 	if len(ccs) == 0 :
 		return
-	textline_ccs = [np.zeros_like(ccs[0]) for _ in range(len(text_lines))]
+	textline_ccs = [[] for _ in range(len(text_lines))]
 	for i, cc in enumerate(ccs) :
-		txtline = cc2textline_assignment[i]
-		textline_ccs[txtline] = cv2.bitwise_or(textline_ccs[txtline], cc)
-	final_mask = np.zeros_like(ccs[0])
-	img_np = cv2.bilateralFilter(img_np, 17, 80, 80)
-	for i, cc in enumerate(tqdm(textline_ccs)) :
-		x1, y1, w1, h1 = cv2.boundingRect(cc)
-		text_size = min(w1, h1)
-		extend_size = int(text_size * 0.1)
-		x1 = max(x1 - extend_size, 0)
-		y1 = max(y1 - extend_size, 0)
-		w1 += extend_size * 2
-		h1 += extend_size * 2
-		w1 = min(w1, img_np.shape[1] - x1 - 1)
-		h1 = min(h1, img_np.shape[0] - y1 - 1)
-		dilate_size = max((int(text_size * 0.3) // 2) * 2 + 1, 3)
-		kern = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (dilate_size, dilate_size))
-		cc_region = np.ascontiguousarray(cc[y1: y1 + h1, x1: x1 + w1])
-		if cc_region.size == 0 :
-			continue
-		#cv2.imshow('cc before', image_resize(cc_region, width = 256))
-		img_region = np.ascontiguousarray(img_np[y1: y1 + h1, x1: x1 + w1])
-		#cv2.imshow('img', image_resize(img_region, width = 256))
-		cc_region = refine_mask(img_region, cc_region)
-		#cv2.imshow('cc after', image_resize(cc_region, width = 256))
-		#cv2.waitKey(0)
-		cc[y1: y1 + h1, x1: x1 + w1] = cc_region
-		cc = cv2.dilate(cc, kern)
-		final_mask = cv2.bitwise_or(final_mask, cc)
+		textline_ccs[cc2textline_assignment[i]].append(cc)
+	textline_ccs = [item for item in textline_ccs if item]
+	final_mask = np.zeros(img_np.shape[: 2], dtype = np.uint8)
+	# textlines are independent, refine them in parallel and merge the crops afterwards
+	with ThreadPoolExecutor(max_workers = min(len(textline_ccs), os.cpu_count() or 1)) as executor :
+		for result in executor.map(lambda item: refine_textline_mask(img_np, item, refine, img_filtered), textline_ccs) :
+			if result is None :
+				continue
+			x, y, cc = result
+			final_mask[y: y + cc.shape[0], x: x + cc.shape[1]] |= cc
 	kern = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
 	# for (x, y, w, h) in text_lines :
 	# 	final_mask = cv2.rectangle(final_mask, (x, y), (x + w, y + h), (255), -1)
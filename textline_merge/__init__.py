@@ -1,11 +1,10 @@
 
 from collections import Counter
-import itertools
 from typing import List, Set, Tuple
 import unicodedata
 
 import cv2
-from utils import Quadrilateral, quadrilateral_can_merge_region_coarse
+from utils import Quadrilateral, QuadrilateralBatch, quadrilateral_can_merge_region_coarse, candidate_pairs
 import numpy as np
 import networkx as nx
 
@@ -53,7 +52,73 @@ def _is_punctuation(ch):
 def count_valuable_text(text) :
     return sum([1 for ch in text if not _is_punctuation(ch) and not _is_control(ch) and not _is_whitespace(ch)])
 
-def split_text_region(bboxes: List[Quadrilateral], region_indices: Set[int], gamma = 0.5, sigma = 2, std_threshold = 6.0, verbose: bool = False) -> List[Set[int]] :
+def textline_distances(bboxes: List[Quadrilateral], rho = 0.5) -> np.ndarray :
+    """
+    Matrix of Quadrilateral.distance between every pair of bboxes.
+    The convex hulls of 4 points are only needed for their areas, which are half the summed area of the 4 triangles the points form.
+    """
+    n = len(bboxes)
+    batch = QuadrilateralBatch(np.array([box.pts for box in bboxes]))
+    pts = batch.pts.astype(np.float64)
+    mid = batch.structure.astype(np.float64)
+    u, v = np.triu_indices(n, 1)
+    fs = np.maximum(batch.font_size[u], batch.font_size[v]).astype(np.float64)
+
+    def hull_area(a, b, c, d) :
+        def triangle(p, q, r) :
+            return np.abs((q[:, 0] - p[:, 0]) * (r[:, 1] - p[:, 1]) - (r[:, 0] - p[:, 0]) * (q[:, 1] - p[:, 1])) / 2
+        return (triangle(a, b, c) + triangle(a, b, d) + triangle(a, c, d) + triangle(b, c, d)) / 2
+
+    def point_distance(a, b) :
+        return np.sqrt(((a - b) ** 2).sum(axis = 1))
+
+    horizontal = np.array([box.assigned_direction == 'h' for box in bboxes], dtype = bool)[u]
+    with np.errstate(divide = 'ignore', invalid = 'ignore') :
+        # 'h': left corners, right corners or middle of the left edges, whichever pair is closest to being on one line
+        dist1 = hull_area(pts[u, 0], pts[u, 3], pts[v, 0], pts[v, 3]) / fs
+        dist2 = hull_area(pts[u, 2], pts[u, 1], pts[v, 2], pts[v, 1]) / fs
+        dist3 = hull_area(mid[u, 0], mid[u, 1], mid[v, 0], mid[v, 1]) / fs
+        h_right = (dist2 < fs * rho) & (dist2 < dist1)
+        h_middle = (dist3 < fs * rho) & (dist3 < dist1) & (dist3 < dist2)
+        h_dist = np.where(h_middle, point_distance(mid[u, 0], mid[v, 0]), np.where(h_right, point_distance(pts[u, 1], pts[v, 1]), point_distance(pts[u, 0], pts[v, 0])))
+        # 'v': top corners or bottom corners
+        dist1 = hull_area(pts[u, 0], pts[u, 1], pts[v, 0], pts[v, 1]) / fs
+        dist2 = hull_area(pts[u, 2], pts[u, 3], pts[v, 2], pts[v, 3]) / fs
+        v_bottom = (dist2 < fs * rho) & (dist2 < dist1)
+        v_dist = np.where(v_bottom, point_distance(pts[u, 2], pts[v, 2]), point_distance(pts[u, 0], pts[v, 0]))
+    distances = np.zeros((n, n))
+    distances[u, v] = distances[v, u] = np.where(horizontal, h_dist, v_dist)
+    return distances
+
+def minimum_spanning_edges(distances: np.ndarray) -> List[Tuple[int, int, float]] :
+    """
+    Prim's algorithm on a distance matrix, returns (i, j, weight) with i < j sorted by decreasing weight.
+    Equal weights are ordered by (i, j) like networkx's Kruskal over itertools.combinations edges, so ties pick the same tree.
+    """
+    n = distances.shape[0]
+    # rank of edge (i, j) in itertools.combinations(range(n), 2)
+    i, j = np.minimum.outer(np.arange(n), np.arange(n)), np.maximum.outer(np.arange(n), np.arange(n))
+    ranks = i * (2 * n - i - 1) // 2 + (j - i - 1)
+    in_tree = np.zeros(n, dtype = bool)
+    in_tree[0] = True
+    best_weight, best_rank, best_from = distances[0].copy(), ranks[0].copy(), np.zeros(n, dtype = np.int64)
+    edges = []
+    for _ in range(n - 1) :
+        candidates = np.flatnonzero(~in_tree)
+        weights = best_weight[candidates]
+        tied = candidates[weights == weights.min()]
+        k = tied[np.argmin(best_rank[tied])]
+        edges.append((min(best_from[k], k), max(best_from[k], k), best_weight[k], best_rank[k]))
+        in_tree[k] = True
+        better = ~in_tree & ((distances[k] < best_weight) | ((distances[k] == best_weight) & (ranks[k] < best_rank)))
+        best_weight[better], best_rank[better], best_from[better] = distances[k, better], ranks[k, better], k
+    edges.sort(key = lambda e: (-e[2], e[3]))
+    return [(int(u), int(v), w) for (u, v, w, _) in edges]
+
+def split_text_region(bboxes: List[Quadrilateral], region_indices: Set[int], gamma = 0.5, sigma = 2, std_threshold = 6.0, verbose: bool = False, distances: np.ndarray = None, rows: dict = None) -> List[Set[int]] :
+    """
+    distances and rows are the textline_distances of the outermost call and the row of each bbox index in it, shared by the recursion
+    """
     region_indices = list(region_indices)
         
     # case #1
@@ -73,14 +138,13 @@ def split_text_region(bboxes: List[Quadrilateral], region_indices: Set[int], gam
             return [set([region_indices[0]]), set([region_indices[1]])]
         
     # case 3
-    G = nx.Graph()
-    for idx in region_indices :
-        G.add_node(idx)
-    for (u, v) in itertools.combinations(region_indices, 2) :
-        G.add_edge(u, v, weight = bboxes[u].distance(bboxes[v]))
-    edges = nx.algorithms.tree.minimum_spanning_edges(G, algorithm = "kruskal", data = True)
-    edges = sorted(edges, key = lambda a: a[2]['weight'], reverse = True)
-    edge_weights = [a[2]['weight'] for a in edges]
+    if distances is None :
+        distances = textline_distances([bboxes[idx] for idx in region_indices])
+        rows = {idx: row for row, idx in enumerate(region_indices)}
+    region_rows = [rows[idx] for idx in region_indices]
+    edges = minimum_spanning_edges(distances[np.ix_(region_rows, region_rows)])
+    edges = [(region_indices[i], region_indices[j], w) for (i, j, w) in edges]
+    edge_weights = [w for (_, _, w) in edges]
     fontsize = np.mean([bboxes[idx].font_size for idx in region_indices])
     std = np.std(edge_weights)
     mean = np.mean(edge_weights)
@@ -102,7 +166,7 @@ def split_text_region(bboxes: List[Quadrilateral], region_indices: Set[int], gam
             G.add_edge(edge[0], edge[1])
         ans = []
         for node_set in nx.algorithms.components.connected_components(G) :
-            ans.extend(split_text_region(bboxes, node_set, gamma, sigma, std_threshold, verbose = verbose))
+            ans.extend(split_text_region(bboxes, node_set, gamma, sigma, std_threshold, verbose = verbose, distances = distances, rows = rows))
         return ans
     pass
 
@@ -138,9 +202,10 @@ def merge_bboxes_text_region(bboxes: List[Quadrilateral], width, height, config,
         bboxes[i].assigned_index = i
         
     # step 1: roughly divide into multiple text region candidates
-    for ((u, ubox), (v, vbox)) in itertools.combinations(enumerate(bboxes), 2) :
+    # only pairs within the discard_connection_gap of quadrilateral_can_merge_region_coarse can pass it
+    for (u, v) in candidate_pairs(bboxes, 3) :
         # check whether the two bboxes can be merged tgt
-        if quadrilateral_can_merge_region_coarse(ubox, vbox) :
+        if quadrilateral_can_merge_region_coarse(bboxes[u], bboxes[v]) :
             G.add_edge(u, v)
 
     region_indices: List[Set[int]] = []
@@ -196,7 +261,9 @@ def merge_bboxes_text_region(bboxes: List[Quadrilateral], width, height, config,
         yield bbox, nodes, majority_dir, fg_r, fg_g, fg_b, bg_r, bg_g, bg_b
 
 async def dispatch(textlines: List[Quadrilateral], width: int, height: int, config, verbose: bool = False) -> Tuple[List[Quadrilateral], List[Quadrilateral]] :
-    text_regions: List[Quadrilateral] = []
+    # columns of the kept regions, turned into Quadrilaterals in one QuadrilateralBatch at the end
+    region_pts, region_texts, region_probs, region_fg, region_bg = [], [], [], [], []
+    region_textline_indices, region_dirs = [], []
     new_textlines = []
     for (poly_regions, textline_indices, majority_dir, fg_r, fg_g, fg_b, bg_r, bg_g, bg_b) in merge_bboxes_text_region(textlines, width, height, config, verbose) :
         text = ''
@@ -222,13 +289,19 @@ async def dispatch(textlines: List[Quadrilateral], width: int, height: int, conf
         total_logprobs /= sum([x[1] for x in logprob_lengths])
         # filter text region without characters
         if vc > 1 :
-            region = Quadrilateral(poly_regions, text, np.exp(total_logprobs), fg_r, fg_g, fg_b, bg_r, bg_g, bg_b)
-            region.clip(width, height)
-            region.textline_indices = []
-            region.majority_dir = majority_dir
-            text_regions.append(region)
-            for textline_idx in textline_indices :
-                region.textline_indices.append(len(new_textlines))
-                new_textlines.append(textlines[textline_idx])
-                
+            region_pts.append(poly_regions)
+            region_texts.append(text)
+            region_probs.append(np.exp(total_logprobs))
+            region_fg.append((fg_r, fg_g, fg_b))
+            region_bg.append((bg_r, bg_g, bg_b))
+            region_dirs.append(majority_dir)
+            region_textline_indices.append(list(range(len(new_textlines), len(new_textlines) + len(textline_indices))))
+            new_textlines.extend(textlines[textline_idx] for textline_idx in textline_indices)
+
+    regions = QuadrilateralBatch(np.array(region_pts).reshape(-1, 4, 2), region_texts, region_probs, region_fg, region_bg)
+    regions.clip(width, height)
+    text_regions: List[Quadrilateral] = regions.to_list()
+    for region, indices, majority_dir in zip(text_regions, region_textline_indices, region_dirs) :
+        region.textline_indices = indices
+        region.majority_dir = majority_dir
     return text_regions, new_textlines
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""
+Time candidate pair search for textline grouping against testing every pair, run from the repository root:
+python -m textline_merge.benchmark [--counts 50 500 5000] [--brute-force-limit 1000]
+"""
+
+import argparse
+import itertools
+import time
+from typing import List
+import numpy as np
+
+from utils import Quadrilateral, quadrilateral_can_merge_region, quadrilateral_can_merge_region_coarse, candidate_pairs
+
+parser = argparse.ArgumentParser(description = 'Benchmark candidate pair search on synthetic textlines')
+parser.add_argument('--counts', nargs = '+', default = [50, 500, 5000], type = int, help = 'numbers of textlines to benchmark')
+parser.add_argument('--brute-force-limit', default = 1000, type = int, help = 'above this many textlines testing every pair is timed on a sample and extrapolated')
+parser.add_argument('--seed', default = 0, type = int, help = 'random seed')
+
+# roughly one textline per this many square pixels, so pages grow with the textline count like real manga pages do
+AREA_PER_TEXTLINE = 250 * 250
+
+def synthetic_textlines(n: int, rng: np.random.Generator) -> List[Quadrilateral] :
+    """
+    n textlines in columns and rows of text bubbles at constant density, with a few slightly rotated
+    """
+    side = np.sqrt(n * AREA_PER_TEXTLINE)
+    textlines = []
+    while len(textlines) < n :
+        # a bubble of a few parallel lines with the same font size
+        font_size = rng.uniform(16, 40)
+        vertical = rng.random() < 0.7
+        angle = rng.normal(0, 0.1) if rng.random() < 0.2 else 0.0
+        cx, cy = rng.uniform(0, side, 2)
+        for i in range(min(int(rng.integers(1, 6)), n - len(textlines))) :
+            length = font_size * rng.uniform(2, 10)
+            offset = i * font_size * 1.3
+            if vertical :
+                corners = np.array([[0, 0], [font_size, 0], [font_size, length], [0, length]]) - [offset, 0]
+            else :
+                corners = np.array([[0, 0], [length, 0], [length, font_size], [0, font_size]]) + [0, offset]
+            rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+            pts = (corners @ rotation.T + [cx, cy]).round().astype(np.int64)
+            textline = Quadrilateral(pts, '', 1.0)
+            textline.assigned_direction = 'v' if vertical else 'h'
+            textlines.append(textline)
+    return textlines
+
+def copy_textlines(textlines: List[Quadrilateral]) -> List[Quadrilateral] :
+    """
+    Fresh textlines, so cached properties computed by one run do not speed up the next
+    """
+    copies = []
+    for textline in textlines :
+        copy = Quadrilateral(textline.pts.copy(), textline.text, textline.prob)
+        copy.assigned_direction = textline.assigned_direction
+        copies.append(copy)
+    return copies
+
+def edges_all_pairs(textlines, can_merge, pairs = None) :
+    if pairs is None :
+        pairs = itertools.combinations(range(len(textlines)), 2)
+    return [(u, v) for (u, v) in pairs if can_merge(textlines[u], textlines[v])]
+
+def benchmark(args) :
+    rng = np.random.default_rng(args.seed)
+    checks = [('ocr direction', quadrilateral_can_merge_region, 5), ('textline_merge', quadrilateral_can_merge_region_coarse, 3)]
+    # warm up numpy and shapely so the first count is not charged for it
+    for _, can_merge, discard_connection_gap in checks :
+        boxes = synthetic_textlines(20, rng)
+        edges_all_pairs(boxes, can_merge, candidate_pairs(boxes, discard_connection_gap))
+    for n in args.counts :
+        textlines = synthetic_textlines(n, rng)
+        total_pairs = n * (n - 1) // 2
+        print(f'{n} textlines, {total_pairs} pairs:')
+        for name, can_merge, discard_connection_gap in checks :
+            boxes = copy_textlines(textlines)
+            start = time.perf_counter()
+            candidates = candidate_pairs(boxes, discard_connection_gap)
+            search_time = time.perf_counter() - start
+            edges = [(u, v) for (u, v) in candidates if can_merge(boxes[u], boxes[v])]
+            indexed_time = time.perf_counter() - start
+
+            boxes = copy_textlines(textlines)
+            if n <= args.brute_force_limit :
+                start = time.perf_counter()
+                all_edges = edges_all_pairs(boxes, can_merge)
+                all_pairs_time = time.perf_counter() - start
+                same = 'same edges' if all_edges == edges else 'DIFFERENT EDGES'
+            else :
+                sample = rng.choice(total_pairs, size = min(total_pairs, 200000), replace = False)
+                # unrank pair indices into (u, v), u < v
+                u = (n - 2 - np.floor(np.sqrt(-8 * sample + 4 * n * (n - 1) - 7) / 2 - 0.5)).astype(np.int64)
+                v = (sample + u + 1 - n * (n - 1) // 2 + (n - u) * ((n - u) - 1) // 2).astype(np.int64)
+                start = time.perf_counter()
+                edges_all_pairs(boxes, can_merge, zip(u.tolist(), v.tolist()))
+                all_pairs_time = (time.perf_counter() - start) * total_pairs / len(sample)
+                same = f'estimated from {len(sample)} sampled pairs'
+            print(f'  {name:>14}: all pairs {all_pairs_time * 1000:10.1f}ms, candidate pairs {indexed_time * 1000:8.1f}ms '
+                  f'({search_time * 1000:.1f}ms search, {len(candidates)} candidates, {len(edges)} edges), '
+                  f'{all_pairs_time / indexed_time:.1f}x, {same}')
+
+if __name__ == '__main__' :
+    benchmark(parser.parse_args())
@@ -9,12 +9,14 @@ import cv2
 import numpy as np
 import requests
 import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 from oscrypto import util as crypto_utils
 
 NON_ALPHABET_LANG = ["CHS", "CHT", "KOR", "JPN"]
 
 parser = argparse.ArgumentParser(description='Generate text bboxes given a image file')
-parser.add_argument('--mode', default='demo', type=str, help='Run demo in either single image demo mode (demo), web service mode (web) or batch translation mode (batch)')
+parser.add_argument('--mode', default='demo', type=str, help='Run demo in either single image demo mode (demo), web service mode (web) or batch translation mode (batch), web-worker is used internally by web mode')
 parser.add_argument('--image', default='', type=str, help='Image file if using demo mode or Image folder name if using batch mode')
 parser.add_argument('--image-dst', default='', type=str, help='Destination folder for translated images in batch mode')
 parser.add_argument('--size', default=1536, type=int, help='image square size')
@@ -22,13 +24,27 @@ parser.add_argument('--use-inpainting', action='store_true', help='turn on/off i
 parser.add_argument('--use-cuda', action='store_true', help='turn on/off cuda')
 parser.add_argument('--force-horizontal', action='store_true', help='force texts rendered horizontally')
 parser.add_argument('--inpainting-size', default=2048, type=int, help='size of image used for inpainting (too large will result in OOM)')
+parser.add_argument('--inpainting-tile-size', default=0, type=int, help='inpaint native resolution tiles of this size around masked regions instead of the whole page resized to --inpainting-size, 0 disables tiling')
 parser.add_argument('--unclip-ratio', default=2.3, type=float, help='How much to extend text skeleton to form bounding box')
 parser.add_argument('--box-threshold', default=0.7, type=float, help='threshold for bbox generation')
 parser.add_argument('--text-threshold', default=0.5, type=float, help='threshold for text detection')
+parser.add_argument('--mask-refinement', default='fit_text', type=str, choices=['fit_text', 'fast', 'fill'], help='text mask refinement, CRF based (fit_text), CRF-free guided filter (fast) or whole textline boxes (fill)')
+parser.add_argument('--ocr-model', default='32px', type=str, choices=['32px', 'ctc'], help='OCR engine, 32px beam search model (ocr.ckpt) or faster 48px CTC model (ocr-ctc.ckpt)')
 parser.add_argument('--text-mag-ratio', default=1, type=int, help='text rendering magnification ratio, larger means higher quality')
 parser.add_argument('--translator', default='google', type=str, help='language translator')
 parser.add_argument('--target-lang', default='ENG', type=str, help='destination language')
+parser.add_argument('--translation-memory', default='translation_memory.db', type=str, help='SQLite file remembering past translations so repeated texts are not sent to the translator again, empty keeps them in memory for this run only')
 parser.add_argument('--verbose', action='store_true', help='print debug info and save intermediate images')
+parser.add_argument('--web-broker', default='inprocess', type=str, choices=['inprocess', 'subprocess'], help='How web mode hands tasks to the inference worker: asyncio queue shared with an in-process web server (inprocess) or web_main.py subprocess polled over HTTP (subprocess)')
+parser.add_argument('--web-workers', default=1, type=int, help='Number of inference worker processes in web mode, each loads its own models')
+parser.add_argument('--web-worker-tasks', default=2, type=int, help='Max number of tasks a web worker runs at the same time, more than 1 lets a worker start the next page while waiting for translation')
+parser.add_argument('--web-max-queue', default=0, type=int, help='Max number of tasks waiting in web mode queue, new tasks are rejected when full, 0 means unlimited')
+parser.add_argument('--batch-workers', default='', type=str, help='Worker count of batch mode pipeline stages, e.g. ocr=2,inpainting=2. Stages are decode, preprocess, detection, ocr, textline_merge, translation, mask_refinement, inpainting, rendering and write')
+parser.add_argument('--batch-queue-size', default=4, type=int, help='Max number of pages waiting between two batch mode pipeline stages')
+parser.add_argument('--batch-detect-size', default=4, type=int, help='Max number of pages batch mode runs text detection on together, pages of the same padded shape share one forward pass')
+parser.add_argument('--batch-ocr-size', default=4, type=int, help='Max number of pages whose textlines batch mode runs OCR on together')
+parser.add_argument('--nonce', default='', type=str, help='Nonce of the web server, used by web-worker mode')
+parser.add_argument('--worker-id', default='0', type=str, help='Worker id reported to the web server, used by web-worker mode')
 args = parser.parse_args()
 print(args)
 
@@ -45,17 +61,49 @@ def overlay_mask(img, mask) :
 
 from text_rendering import text_render
 
-def update_state(task_id, nonce, state) :
-    requests.post('http://127.0.0.1:5003/task-update-internal', json = {'task_id': task_id, 'nonce': nonce, 'state': state})
+class NonceTaskBroker :
+    """
+    Hands tasks to the inference worker through the nonce protected internal HTTP endpoints of a web_main.py subprocess
+    """
+    def __init__(self, nonce) :
+        self.nonce = nonce
 
-def get_task(nonce) :
-    try :
-        rjson = requests.get(f'http://127.0.0.1:5003/task-internal?nonce={nonce}').json()
-        if 'task_id' in rjson :
-            return rjson['task_id']
-        else :
-            return None
-    except :
+    async def get_task(self, worker_id = '0') :
+        loop = asyncio.get_event_loop()
+        while True :
+            try :
+                # long polling, run in executor so other tasks of this worker keep going
+                rjson = (await loop.run_in_executor(None, lambda: requests.get(f'http://127.0.0.1:5003/task-internal?nonce={self.nonce}&worker={worker_id}&wait=30', timeout = 40))).json()
+                if 'task_id' in rjson :
+                    return rjson['task_id']
+            except :
+                await asyncio.sleep(0.1)
+
+    def update_state(self, task_id, state) :
+        requests.post('http://127.0.0.1:5003/task-update-internal', json = {'task_id': task_id, 'nonce': self.nonce, 'state': state}, timeout = 5)
+
+    def request_translation(self, task_id, texts) :
+        requests.post('http://127.0.0.1:5003/request-translation-internal', json = {'task_id': task_id, 'nonce': self.nonce, 'texts': texts}, timeout = 5)
+
+    def report_health(self, worker_id, health) :
+        try :
+            requests.post('http://127.0.0.1:5003/worker-health-internal', json = {'worker_id': worker_id, 'nonce': self.nonce, 'health': health}, timeout = 5)
+        except requests.RequestException :
+            # a slow server must not stop the heartbeat, the next one is sent anyway
+            pass
+
+    async def get_translation_result(self, task_id) :
+        loop = asyncio.get_event_loop()
+        # wait for at most 1 hour
+        for _ in range(36000) :
+            try :
+                # in the executor so other tasks of this worker keep going
+                ret = (await loop.run_in_executor(None, lambda: requests.post('http://127.0.0.1:5003/get-translation-result-internal', json = {'task_id': task_id, 'nonce': self.nonce}, timeout = 5))).json()
+                if 'result' in ret :
+                    return ret['result']
+            except requests.RequestException :
+                pass
+            await asyncio.sleep(0.1)
         return None
 
 def fix_punctuation_spacing(translated_sentences):
@@ -65,18 +113,27 @@ def fix_punctuation_spacing(translated_sentences):
         
     return translated_sentences
         
-from detection import dispatch as dispatch_detection, load_model as load_detection_model
-from ocr import dispatch as dispatch_ocr, load_model as load_ocr_model
+from detection import dispatch as dispatch_detection, dispatch_batch as dispatch_detection_batch, load_model as load_detection_model, filter_size as detection_filter_size
+from ocr import dispatch as dispatch_ocr, dispatch_batch as dispatch_ocr_batch, load_model as load_ocr_model
 from inpainting import dispatch as dispatch_inpainting, load_model as load_inpainting_model
 from text_mask import dispatch as dispatch_mask_refinement
 from textline_merge import dispatch as dispatch_textline_merge
 from text_rendering import dispatch as dispatch_rendering
 from text_rendering import dispatch_non_char as dispatch_rendering_non_char
+from utils import bilateral_filter_resized
+
+def load_config() :
+    spec = importlib.util.spec_from_file_location('config', './config/config.py')
+    if spec is None:
+        parser.error('Config file not found.')
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    return config
 
 async def infer(
     img,
     mode,
-    nonce,
+    broker = None,
     task_id = ''
     ) :
     img_detect_size = args.size
@@ -93,16 +150,12 @@ async def infer(
         print(f' -- Detection size {size_ind}, resolution {img_detect_size}')
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
-    # import config
-    spec = importlib.util.spec_from_file_location('config', './config/config.py')
-    if spec is None:
-        parser.error('Config file not found.')
-    config = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(config)
+    config = load_config()
     
     if mode == 'web' and task_id :
-        update_state(task_id, nonce, 'detection')
-    textlines, mask = await dispatch_detection(img, img_detect_size, args.use_cuda, args, verbose = args.verbose)
+        broker.update_state(task_id, 'detection')
+    img_filtered = filter_page(img, img_detect_size)
+    textlines, mask = await dispatch_detection(img, img_detect_size, args.use_cuda, args, verbose = args.verbose, img_filtered = img_filtered)
 
     if args.verbose :
         img_bbox_raw = np.copy(img)
@@ -112,10 +165,10 @@ async def infer(
         cv2.imwrite(f'result/{task_id}/mask_raw.png', mask)
 
     if mode == 'web' and task_id :
-        update_state(task_id, nonce, 'ocr')
+        broker.update_state(task_id, 'ocr')
         
     ocrParamConfig = config.OCRConfig()
-    textlines = await dispatch_ocr(img, textlines, args.use_cuda, args, ocrParamConfig)
+    textlines = await dispatch_ocr(img, textlines, args.use_cuda, args, ocrParamConfig, args.ocr_model)
 
     print(' -- Check merge for bounding boxes')
     mergeParamConfig = config.TextlineMergeConfig()
@@ -129,45 +182,42 @@ async def infer(
             img_bbox = cv2.polylines(img_bbox, [region.pts], True, color = (0, 0, 255), thickness = 3)
         cv2.imwrite(f'result/{task_id}/bbox.png', cv2.cvtColor(img_bbox, cv2.COLOR_RGB2BGR))
 
+    # translation only waits on the network, start it now and run mask refinement and inpainting on a thread meanwhile
+    print(' -- Translating')
     if mode == 'web' and task_id :
-        print(' -- Translating')
-        update_state(task_id, nonce, 'translating')
-        # in web mode, we can start translation task async
-        requests.post('http://127.0.0.1:5003/request-translation-internal', json = {'task_id': task_id, 'nonce': nonce, 'texts': [r.text for r in text_regions]})
+        broker.update_state(task_id, 'translating')
+        broker.request_translation(task_id, [r.text for r in text_regions])
+        translation = asyncio.ensure_future(broker.get_translation_result(task_id))
+    else :
+        from translators import dispatch as run_translation
+        translation = asyncio.ensure_future(run_translation(args.translator, 'auto', args.target_lang, [r.text for r in text_regions]))
+    loop = asyncio.get_event_loop()
 
-    print(' -- Generating text mask')
-    if mode == 'web' and task_id :
-        update_state(task_id, nonce, 'mask_generation')
-    # create mask
-    final_mask = await dispatch_mask_refinement(img, mask, textlines)
+    try :
+        print(' -- Generating text mask')
+        if mode == 'web' and task_id :
+            broker.update_state(task_id, 'mask_generation')
+        # create mask
+        final_mask = await loop.run_in_executor(CPU_EXECUTOR, run_sync, dispatch_mask_refinement(img, mask, textlines, args.mask_refinement, img_filtered = img_filtered))
 
-    print(' -- Running inpainting')
-    if mode == 'web' and task_id :
-        update_state(task_id, nonce, 'inpainting')
-    # run inpainting
-    img_inpainted = await dispatch_inpainting(args.use_inpainting, False, args.use_cuda, img, final_mask, args.inpainting_size, verbose = args.verbose)
-    if args.verbose :
-        img_inpainted, inpaint_input = img_inpainted
-        cv2.imwrite(f'result/{task_id}/inpaint_input.png', cv2.cvtColor(inpaint_input, cv2.COLOR_RGB2BGR))
-        cv2.imwrite(f'result/{task_id}/inpainted.png', cv2.cvtColor(img_inpainted, cv2.COLOR_RGB2BGR))
-        cv2.imwrite(f'result/{task_id}/mask_final.png', final_mask)
-
-    # translate text region texts
-    if mode != 'web' :
-        print(' -- Translating')
-        from translators import dispatch as run_translation
-        translated_sentences = await run_translation(args.translator, 'auto', args.target_lang, [r.text for r in text_regions])
-    else :
-        # wait for at most 1 hour
-        translated_sentences = None
-        for _ in range(36000) :
-            ret = requests.post('http://127.0.0.1:5003/get-translation-result-internal', json = {'task_id': task_id, 'nonce': nonce}).json()
-            if 'result' in ret :
-                translated_sentences = ret['result']
-                break
-            await asyncio.sleep(0.1)
+        print(' -- Running inpainting')
+        if mode == 'web' and task_id :
+            broker.update_state(task_id, 'inpainting')
+        # run inpainting
+        img_inpainted = await loop.run_in_executor(CPU_EXECUTOR, run_sync, dispatch_inpainting(args.use_inpainting, False, args.use_cuda, img, final_mask, args.inpainting_size, verbose = args.verbose, tile_size = args.inpainting_tile_size))
+        if args.verbose :
+            img_inpainted, inpaint_input = img_inpainted
+            cv2.imwrite(f'result/{task_id}/inpaint_input.png', cv2.cvtColor(inpaint_input, cv2.COLOR_RGB2BGR))
+            cv2.imwrite(f'result/{task_id}/inpainted.png', cv2.cvtColor(img_inpainted, cv2.COLOR_RGB2BGR))
+            cv2.imwrite(f'result/{task_id}/mask_final.png', final_mask)
+
+        # wait for the translation started after textline merge
+        translated_sentences = await translation
+    finally :
+        cancel_translation(translation)
     if not translated_sentences and text_regions :
-        update_state(task_id, nonce, 'error')
+        if mode == 'web' and task_id :
+            broker.update_state(task_id, 'error')
         return
     
     # fix puncutation spacing issue for non alphabet-based langs
@@ -175,7 +225,7 @@ async def infer(
 
     print(' -- Rendering translated text')
     if mode == 'web' and task_id :
-        update_state(task_id, nonce, 'render')
+        broker.update_state(task_id, 'render')
     # render translated texts
     renderParamConfig = config.TextRendererConfig()
     if args.target_lang in NON_ALPHABET_LANG:
@@ -189,24 +239,311 @@ async def infer(
     cv2.imwrite(f'result/{task_id}/final.png', cv2.cvtColor(output, cv2.COLOR_RGB2BGR))
 
     if mode == 'web' and task_id :
-        update_state(task_id, nonce, 'finished')
+        broker.update_state(task_id, 'finished')
+
+def filter_page(img: np.ndarray, detect_size: int) :
+	# detection works at detect_size, or native scale for long strips, and mask refinement at half the page size, filter once at the larger of the two and let both resize from it
+	return bilateral_filter_resized(img, max(detection_filter_size(img, detect_size), max(img.shape[: 2]) // 2))
+
+def cancel_translation(translation: asyncio.Future) :
+	# a translation started early whose page failed is never awaited, stop it and retrieve its error if it already has one so asyncio does not warn about it
+	if not translation.cancel() and not translation.cancelled() :
+		translation.exception()
 
 def replace_prefix(s: str, old: str, new: str) :
 	if s.startswith(old) :
 		s = new + s[len(old):]
 	return s
 
-async def main(mode = 'demo') :
-	print(' -- Loading models')
+class BatchPage :
+	def __init__(self, src: str, dst: str) :
+		self.src = src
+		self.dst = dst
+		self.img = None
+		self.img_filtered = None
+		self.textlines = None
+		self.mask = None
+		self.text_regions = None
+		self.translation = None
+		self.translated_sentences = None
+		self.final_mask = None
+		self.img_inpainted = None
+		self.output = None
+
+def run_sync(coro) :
+	# stages are coroutines that never yield while computing, run them to completion on a stage worker thread
+	return asyncio.run(coro)
+
+# infer runs mask refinement and inpainting here so translation can progress on the event loop, one at a time like on the loop before
+CPU_EXECUTOR = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'infer')
+
+async def run_batch_pipeline(pages: List[BatchPage]) :
+	"""
+	Translate pages through a pipeline of stages connected by bounded queues.
+	Every stage works on a different page at the same time, so throughput is limited by the slowest stage instead of the sum of all stages.
+	"""
+	import time
+	import traceback
+	from translators import dispatch as run_translation, TRANSLATION_MEMORY, SCHEDULER
+	config = load_config()
+	ocr_config = config.OCRConfig()
+	merge_config = config.TextlineMergeConfig()
+	render_config = config.TextRendererConfig()
+	alphabet = args.target_lang not in NON_ALPHABET_LANG
+
+	async def decode(page) :
+		img = cv2.imread(page.src)
+		if img is None :
+			# not an image or unreadable, report it with the other failures
+			failed.append(page.src)
+			return None
+		page.img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+		return page
+
+	async def preprocess(page) :
+		page.img_filtered = filter_page(page.img, args.size)
+		return page
+
+	async def detection(batch) :
+		results = await dispatch_detection_batch([page.img for page in batch], args.size, args.use_cuda, args, imgs_filtered = [page.img_filtered for page in batch])
+		for page, (textlines, mask) in zip(batch, results) :
+			page.textlines, page.mask = textlines, mask
+		return batch
+
+	async def ocr(batch) :
+		results = await dispatch_ocr_batch([page.img for page in batch], [page.textlines for page in batch], args.use_cuda, args, ocr_config, args.ocr_model)
+		for page, textlines in zip(batch, results) :
+			page.textlines = textlines
+		return batch
+
+	async def textline_merge(page) :
+		page.text_regions, page.textlines = await dispatch_textline_merge(page.textlines, page.img.shape[1], page.img.shape[0], merge_config)
+		return page
+
+	async def translate(page) :
+		start = time.time()
+		try :
+			return await run_translation(args.translator, 'auto', args.target_lang, [r.text for r in page.text_regions])
+		finally :
+			busy_time['translation'] += time.time() - start
+
+	async def translation(page) :
+		# only start translating, the page goes on to mask refinement and inpainting while waiting for it
+		page.translation = asyncio.ensure_future(translate(page))
+		return page
+
+	async def mask_refinement(page) :
+		page.final_mask = await dispatch_mask_refinement(page.img, page.mask, page.textlines, args.mask_refinement, img_filtered = page.img_filtered)
+		page.img_filtered = None
+		return page
+
+	async def inpainting(page) :
+		page.img_inpainted = await dispatch_inpainting(args.use_inpainting, False, args.use_cuda, page.img, page.final_mask, args.inpainting_size, tile_size = args.inpainting_tile_size)
+		return page
+
+	async def rendering(page) :
+		start = time.time()
+		page.translated_sentences = await page.translation
+		page.translation = None
+		translation_wait[0] += time.time() - start
+		if not page.translated_sentences and page.text_regions :
+			print(f'Translation failed for {page.src}')
+			return None
+		page.translated_sentences = fix_punctuation_spacing(page.translated_sentences)
+		page.output = await loop.run_in_executor(None, run_sync, dispatch_rendering(np.copy(page.img_inpainted), args.text_mag_ratio, page.translated_sentences, page.textlines, page.text_regions, args.force_horizontal, render_config, alphabet))
+		return page
+
+	async def write(page) :
+		cv2.imwrite(page.dst, cv2.cvtColor(page.output, cv2.COLOR_RGB2BGR))
+		print('Translated', page.src, '->', page.dst)
+		translated.append(page.src)
+		return page
+
+	# translation only waits on the network, so it runs on the event loop instead of a thread and overlaps mask refinement and inpainting of the same page
+	# rendering waits for that translation on the event loop before rendering on a thread, its busy time includes any wait left
+	# and is reported separately, two workers by default so a page still waiting does not hold up the next one
+	# detection and ocr take whatever pages are already waiting, up to --batch-detect-size and --batch-ocr-size, as one batch
+	stages = [
+		('decode', decode, True),
+		('preprocess', preprocess, True),
+		('detection', detection, True),
+		('ocr', ocr, True),
+		('textline_merge', textline_merge, True),
+		('translation', translation, False),
+		('mask_refinement', mask_refinement, True),
+		('inpainting', inpainting, True),
+		('rendering', rendering, False),
+		('write', write, True),
+	]
+	batch_size = {'detection': max(1, args.batch_detect_size), 'ocr': max(1, args.batch_ocr_size)}
+	workers = {name: 1 for name, _, _ in stages}
+	workers['decode'] = 2
+	workers['translation'] = 4
+	workers['rendering'] = 2
+	workers['write'] = 2
+	for item in filter(None, args.batch_workers.split(',')) :
+		name, count = item.split('=')
+		if name not in workers :
+			parser.error(f'Unknown batch stage {name}')
+		workers[name] = max(1, int(count))
+	print(' -- Batch pipeline workers: ' + ', '.join(f'{name}={count}' for name, count in workers.items()))
+
+	loop = asyncio.get_event_loop()
+	queues = [asyncio.Queue(maxsize = args.batch_queue_size) for _ in range(len(stages))]
+	busy_time = {name: 0.0 for name, _, _ in stages}
+	translation_wait = [0.0]
+	translated = []
+	failed = []
+
+	async def run_stage(i) :
+		name, fn, threaded = stages[i]
+		batched = name in batch_size
+		executor = ThreadPoolExecutor(max_workers = workers[name], thread_name_prefix = name) if threaded else None
+		async def worker() :
+			finished = False
+			while not finished :
+				page = await queues[i].get()
+				if page is None :
+					return
+				batch = [page]
+				while batched and len(batch) < batch_size[name] and not queues[i].empty() :
+					page = queues[i].get_nowait()
+					if page is None :
+						# this worker's end marker, finish the pages already taken first
+						finished = True
+						break
+					batch.append(page)
+				start = time.time()
+				try :
+					arg = batch if batched else batch[0]
+					if threaded :
+						result = await loop.run_in_executor(executor, run_sync, fn(arg))
+					else :
+						result = await fn(arg)
+					results = result if batched else [result]
+				except Exception :
+					traceback.print_exc()
+					failed.extend(page.src for page in batch)
+					for page in batch :
+						if page.translation is not None :
+							cancel_translation(page.translation)
+							page.translation = None
+					results = []
+				busy_time[name] += time.time() - start
+				for page in results :
+					if page is not None and i + 1 < len(stages) :
+						await queues[i + 1].put(page)
+		await asyncio.gather(*[worker() for _ in range(workers[name])])
+		if executor is not None :
+			executor.shutdown()
+		if i + 1 < len(stages) :
+			# tell every worker of the next stage there is nothing left
+			for _ in range(workers[stages[i + 1][0]]) :
+				await queues[i + 1].put(None)
+
+	async def feed() :
+		for page in pages :
+			await queues[0].put(page)
+		for _ in range(workers[stages[0][0]]) :
+			await queues[0].put(None)
+
+	start = time.time()
+	await asyncio.gather(feed(), *[run_stage(i) for i in range(len(stages))])
+	total = time.time() - start
+	print(f' -- Translated {len(translated)}/{len(pages)} files in {total:.1f}s')
+	for name, _, _ in stages :
+		print(f'    {name}: {busy_time[name]:.1f}s busy over {workers[name]} worker(s)' + (f', {translation_wait[0]:.1f}s of it waiting for translation' if name == 'rendering' else ''))
+	print(f'    translation memory: {TRANSLATION_MEMORY.stats()}')
+	print(f'    translator: {SCHEDULER.stats()}')
+	for src in failed :
+		print(f'    failed: {src}')
+
+async def web_worker(broker, worker_id = '0') :
 	import os
-	os.makedirs('result', exist_ok = True)
+	import time
+	import threading
+	import traceback
+	health = {'pid': os.getpid(), 'started': time.time(), 'running': [], 'processed': 0, 'failed': 0}
+	def heartbeat() :
+		# runs on its own thread so a worker busy with a long page still reports in
+		while True :
+			try :
+				broker.report_health(worker_id, dict(health, running = list(health['running'])))
+			except Exception :
+				pass
+			time.sleep(5)
+	threading.Thread(target = heartbeat, daemon = True).start()
+	slots = asyncio.Semaphore(args.web_worker_tasks)
+	async def run(task_id) :
+		try :
+			img = cv2.imread(f'result/{task_id}/input.png')
+			await infer(img, 'web', broker, task_id)
+			health['processed'] += 1
+		except Exception :
+			traceback.print_exc()
+			health['failed'] += 1
+			broker.update_state(task_id, 'error')
+		finally :
+			health['running'].remove(task_id)
+			slots.release()
+	while True :
+		# only take a task from the shared queue when there is room for it
+		await slots.acquire()
+		task_id = await broker.get_task(worker_id)
+		print(f' -- Processing task {task_id}')
+		health['running'].append(task_id)
+		asyncio.create_task(run(task_id))
+
+async def web_worker_pool(nonce) :
+	import sys
+	import subprocess
+	from web_main import WORKER_TIMEOUT
+	def spawn(worker_id) :
+		return subprocess.Popen([sys.executable, sys.argv[0]] + sys.argv[1:] + ['--mode', 'web-worker', '--nonce', nonce, '--worker-id', str(worker_id)])
+	def worker_health() :
+		# heartbeats the web server received, seconds since the last one in last_seen
+		try :
+			return {worker['id']: worker for worker in requests.get('http://127.0.0.1:5003/workers', timeout = 5).json()['workers']}
+		except Exception :
+			return {}
+	loop = asyncio.get_event_loop()
+	workers = {i: spawn(i) for i in range(args.web_workers)}
+	while True :
+		await asyncio.sleep(1)
+		health = await loop.run_in_executor(None, worker_health)
+		for i, proc in workers.items() :
+			if proc.poll() is not None :
+				print(f' -- Worker {i} exited with code {proc.returncode}, restarting')
+				workers[i] = spawn(i)
+			elif health.get(str(i), {}).get('pid') == proc.pid and health[str(i)]['last_seen'] > WORKER_TIMEOUT :
+				# the web server fails its tasks when the heartbeat of the restarted worker comes in
+				print(f' -- Worker {i} stopped responding, restarting')
+				proc.kill()
+				proc.wait()
+				workers[i] = spawn(i)
+
+def load_models() :
+	print(' -- Loading models')
 	text_render.prepare_renderer()
 	with open('alphabet-all-v5.txt', 'r', encoding = 'utf-8') as fp :
 		dictionary = [s[:-1] for s in fp.readlines()]
-	load_ocr_model(dictionary, args.use_cuda)
+	load_ocr_model(dictionary, args.use_cuda, args.ocr_model)
 	load_detection_model(args.use_cuda)
 	load_inpainting_model(args.use_cuda)
 
+async def main(mode = 'demo') :
+	import os
+	os.makedirs('result', exist_ok = True)
+	if mode == 'web-worker' :
+		# share CPU cores between worker processes instead of oversubscribing them
+		torch.set_num_threads(max(1, (os.cpu_count() or 1) // max(1, args.web_workers)))
+	if mode != 'web' or args.web_workers <= 1 :
+		load_models()
+	# web workers leave translation to the web server, which opens the memory itself when it runs in a subprocess
+	if args.translation_memory and mode != 'web-worker' and not (mode == 'web' and args.web_broker != 'inprocess') :
+		from translators import TRANSLATION_MEMORY
+		TRANSLATION_MEMORY.open(args.translation_memory)
+
 	if mode == 'demo' :
 		print(' -- Running in single image demo mode')
 		if not args.image :
@@ -214,28 +551,39 @@ async def main(mode = 'demo') :
 			parser.print_usage()
 			return
 		img = cv2.imread(args.image)
-		await infer(img, mode, '')
+		await infer(img, mode)
+		from translators import close as close_translators
+		await close_translators()
 	elif mode == 'web' :
 		print(' -- Running in web service mode')
 		print(' -- Waiting for translation tasks')
 		nonce = crypto_utils.rand_bytes(16).hex()
-		import subprocess
-		import sys
-		subprocess.Popen([sys.executable, 'web_main.py', nonce, '5003'])
-		while True :
-			task_id = get_task(nonce)
-			if task_id :
-				print(f' -- Processing task {task_id}')
-				img = cv2.imread(f'result/{task_id}/input.png')
-				try :
-					infer_task = asyncio.create_task(infer(img, mode, nonce, task_id))
-					asyncio.gather(infer_task)
-				except :
-					import traceback
-					traceback.print_exc()
-					update_state(task_id, nonce, 'error')
+		runner = None
+		if args.web_broker == 'inprocess' :
+			import web_main
+			web_main.MAX_QUEUE_SIZE = args.web_max_queue
+			runner, _ = await web_main.start_async_app(nonce, 5003)
+		else :
+			import subprocess
+			import sys
+			subprocess.Popen([sys.executable, 'web_main.py', nonce, '5003', str(args.web_max_queue), args.translation_memory])
+		try :
+			if args.web_workers > 1 :
+				print(f' -- Starting {args.web_workers} worker processes')
+				await web_worker_pool(nonce)
+			elif args.web_broker == 'inprocess' :
+				broker = web_main.InProcessTaskBroker(asyncio.get_event_loop())
+				# run inference on its own thread and event loop so model calls don't block the web server
+				await asyncio.get_event_loop().run_in_executor(None, asyncio.run, web_worker(broker))
 			else :
-				await asyncio.sleep(0.1)
+				await web_worker(NonceTaskBroker(nonce))
+		finally :
+			if runner is not None :
+				# runs the app's on_cleanup, which closes the translators' connections
+				await runner.cleanup()
+	elif mode == 'web-worker' :
+		print(f' -- Running as web worker {args.worker_id}')
+		await web_worker(NonceTaskBroker(args.nonce), args.worker_id)
 	elif mode == 'batch' :
 		src = os.path.abspath(args.image)
 		if src[-1] == '\\' or src[-1] == '/' :
@@ -248,7 +596,7 @@ async def main(mode = 'demo') :
 			print(f'Destination directory `{dst}` already exists! Please specify another directory.')
 			return
 		print('Processing image in source directory')
-		files = []
+		pages = []
 		for root, subdirs, files in os.walk(src) :
 			dst_root = replace_prefix(root, src, dst)
 			os.makedirs(dst_root, exist_ok = True)
@@ -256,22 +604,18 @@ async def main(mode = 'demo') :
 				if f.lower() == '.thumb' :
 					continue
 				filename = os.path.join(root, f)
-				try :
-					img = cv2.imread(filename)
-					if img is None :
-						continue
-				except Exception :
-					pass
-				try :
-					dst_filename = replace_prefix(filename, src, dst)
-					print('Processing', filename, '->', dst_filename)
-					await infer(img, 'demo', '', dst_image_name = dst_filename)
-				except Exception :
-					import traceback
-					traceback.print_exc()
-					pass
+				pages.append(BatchPage(filename, replace_prefix(filename, src, dst)))
+		await run_batch_pipeline(pages)
+		from translators import close as close_translators
+		await close_translators()
 
 if __name__ == '__main__':
 	loop = asyncio.get_event_loop()
-	loop.run_until_complete(main(args.mode))
+	task = loop.create_task(main(args.mode))
+	try :
+		loop.run_until_complete(task)
+	except KeyboardInterrupt :
+		# let main run its cleanup, e.g. stopping the in-process web server
+		task.cancel()
+		loop.run_until_complete(asyncio.gather(task, return_exceptions = True))
 
@@ -1,6 +1,9 @@
 
 from typing import List
 from . import baidu, google, youdao, deepl
+from .memory import TranslationMemory, normalize_text
+from .sessions import SESSIONS
+from .scheduler import TranslationScheduler
 
 LANGUAGE_CODE_MAP = {}
 
@@ -109,29 +112,21 @@ LANGUAGE_CODE_MAP['deepl'] = {
     'TRK': 'NONE',
 }
 
-GOOGLE_CLIENT = google.Translator()
+GOOGLE_CLIENT = google.Translator(**SESSIONS.httpx_options())
 BAIDU_CLIENT = baidu.Translator()
 YOUDAO_CLIENT = youdao.Translator()
 DEEPL_CLIENT = deepl.Translator()
 
-async def dispatch(translator: str, src_lang: str, tgt_lang: str, texts: List[str], *args, **kwargs) -> List[str] :
-    if translator not in ['google', 'youdao', 'baidu', 'deepl', 'null'] :
-        raise Exception
-    if translator == 'null' :
-        return texts
-    if not texts :
-        return texts
-    if tgt_lang not in VALID_LANGUAGES :
-        raise Exception
-    if src_lang not in VALID_LANGUAGES and src_lang != 'auto' :
-        raise Exception
-    tgt_lang = LANGUAGE_CODE_MAP[translator][tgt_lang]
-    src_lang = LANGUAGE_CODE_MAP[translator][src_lang] if src_lang != 'auto' else 'auto'
-    if tgt_lang == 'NONE' or src_lang == 'NONE' :
-        raise Exception
+# translations already made, use TRANSLATION_MEMORY.open(path) to keep them across runs
+TRANSLATION_MEMORY = TranslationMemory()
+
+async def translate(translator: str, src_lang: str, tgt_lang: str, texts: List[str]) -> List[str] :
+    """
+    Send texts to the translator in one request, src_lang and tgt_lang are its own language codes
+    """
     if translator == 'google' :
         concat_texts = '\n'.join(texts)
-        result = await GOOGLE_CLIENT.translate(concat_texts, tgt_lang, src_lang, *args, **kwargs)
+        result = await GOOGLE_CLIENT.translate(concat_texts, tgt_lang, src_lang)
         if not isinstance(result, list) :
             result = result.text.split('\n')
     elif translator == 'baidu' :
@@ -143,17 +138,69 @@ async def dispatch(translator: str, src_lang: str, tgt_lang: str, texts: List[st
     elif translator == 'deepl' :
         concat_texts = '\n'.join(texts)
         result = await DEEPL_CLIENT.translate(src_lang, tgt_lang, concat_texts)
-    
-    translated_sentences = []
-    if len(result) < len(texts) :
-        translated_sentences.extend(result)
-        translated_sentences.extend([''] * (len(texts) - len(result)))
-    elif len(result) > len(texts) :
-        translated_sentences.extend(result[: len(texts)])
-    else :
-        translated_sentences.extend(result)
+    return result
+
+# max characters of one request, texts of concurrent dispatch calls are packed into requests up to this size
+MAX_CHUNK_CHARS = {
+    'google': 4000,
+    'baidu': 2000,
+    'youdao': 1000,
+    'deepl': 10000,
+}
+
+# (requests per second, burst) of each translator
+RATE_LIMITS = {
+    'google': (5, 5),
+    'baidu': (1, 1),
+    'youdao': (5, 5),
+    'deepl': (5, 5),
+}
+
+SCHEDULER = TranslationScheduler(translate, MAX_CHUNK_CHARS, RATE_LIMITS)
+
+async def dispatch(translator: str, src_lang: str, tgt_lang: str, texts: List[str]) -> List[str] :
+    if translator not in ['google', 'youdao', 'baidu', 'deepl', 'null'] :
+        raise Exception
+    if translator == 'null' :
+        return texts
+    if not texts :
+        return texts
+    if tgt_lang not in VALID_LANGUAGES :
+        raise Exception
+    if src_lang not in VALID_LANGUAGES and src_lang != 'auto' :
+        raise Exception
+    translator_tgt_lang = LANGUAGE_CODE_MAP[translator][tgt_lang]
+    translator_src_lang = LANGUAGE_CODE_MAP[translator][src_lang] if src_lang != 'auto' else 'auto'
+    if translator_tgt_lang == 'NONE' or translator_src_lang == 'NONE' :
+        raise Exception
+
+    # only texts the translation memory does not have are sent, once for all texts with the same key
+    translated_sentences = TRANSLATION_MEMORY.get(translator, src_lang, tgt_lang, texts)
+    missing = {}
+    for i, sentence in enumerate(translated_sentences) :
+        if sentence is None :
+            missing.setdefault(normalize_text(texts[i]), []).append(i)
+    if not missing :
+        return translated_sentences
+    # texts are sent joined by newlines, a newline inside a text would shift every later translation by one line
+    missing_texts = [' '.join(texts[indices[0]].splitlines()) for indices in missing.values()]
+    result = await SCHEDULER.translate(translator, translator_src_lang, translator_tgt_lang, missing_texts)
+
+    # empty translations are not worth keeping
+    kept = [(text, sentence) for text, sentence in zip(missing_texts, result) if sentence.strip()]
+    TRANSLATION_MEMORY.put(translator, src_lang, tgt_lang, [text for text, _ in kept], [sentence for _, sentence in kept])
+    for indices, sentence in zip(missing.values(), result) :
+        for i in indices :
+            translated_sentences[i] = sentence
     return translated_sentences
 
+async def close() :
+    """
+    Close the connections kept alive by the translators on the running loop, call before the loop exits
+    """
+    await SESSIONS.close()
+    await GOOGLE_CLIENT.client.aclose()
+
 async def test() :
     src = '测试'
     print(await dispatch('google', 'auto', 'ENG', [src]))
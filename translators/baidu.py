@@ -10,12 +10,12 @@ import json
 import time
 
 from .keys import APP_ID, SECRET_KEY
+from .sessions import SESSIONS
 
 # base api url
 BASE_URL = 'api.fanyi.baidu.com'
 API_URL = '/api/trans/vip/translate'
 
-import aiohttp
 
 class Translator(object):
 	def __init__(self):
@@ -23,9 +23,8 @@ class Translator(object):
 
 	async def translate(self, from_lang, to_lang, query_text):
 		url = self.get_url(from_lang, to_lang, query_text)
-		async with aiohttp.ClientSession() as session:
-			async with session.get('https://'+BASE_URL+url) as resp:
-				result = await resp.json()
+		async with SESSIONS.get().get('https://'+BASE_URL+url) as resp:
+			result = await resp.json()
 		result_list = []
 		for ret in result["trans_result"]:
 			for v in ret["dst"].split('\n') :
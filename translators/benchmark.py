@@ -0,0 +1,75 @@
+"""
+Compare a new aiohttp session per translation request with the shared SESSIONS pool against a local stand-in of the youdao API,
+run from the repository root:
+python -m translators.benchmark [--requests 200] [--concurrency 1 8]
+"""
+
+import argparse
+import asyncio
+import time
+
+import aiohttp
+from aiohttp import web
+
+from . import youdao
+from .sessions import SESSIONS
+
+parser = argparse.ArgumentParser(description = 'Benchmark translator connection reuse against a local stand-in server')
+parser.add_argument('--requests', default = 200, type = int, help = 'requests sent in each run')
+parser.add_argument('--concurrency', nargs = '+', default = [1, 8], type = int, help = 'requests in flight at the same time')
+parser.add_argument('--port', default = 5013, type = int, help = 'port of the stand-in server')
+
+class StandInServer(object) :
+    """
+    Answers like the youdao API and counts the connections it was reached over
+    """
+    def __init__(self) :
+        self.connections = set()
+
+    async def handle(self, request) :
+        self.connections.add(request.transport.get_extra_info('peername'))
+        data = await request.post()
+        return web.json_response({'translation': [data['q'].upper()]})
+
+async def request_new_session(data) :
+    # what youdao.do_request did before the shared pool
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    async with aiohttp.ClientSession() as session :
+        async with session.post(youdao.YOUDAO_URL, data = data, headers = headers) as resp :
+            return await resp.json()
+
+async def run(request_fn, count: int, concurrency: int) :
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    async def one(i) :
+        async with semaphore :
+            start = time.perf_counter()
+            await request_fn({'q': f'text {i}'})
+            latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(count)])
+    return time.perf_counter() - start, latencies
+
+async def benchmark(args) :
+    server = StandInServer()
+    app = web.Application()
+    app.router.add_post('/api', server.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port).start()
+    youdao.YOUDAO_URL = f'http://127.0.0.1:{args.port}/api'
+    try :
+        for concurrency in args.concurrency :
+            print(f'{args.requests} requests, {concurrency} at a time:')
+            for name, request_fn in [('new session', request_new_session), ('shared pool', youdao.do_request)] :
+                server.connections.clear()
+                total, latencies = await run(request_fn, args.requests, concurrency)
+                latencies.sort()
+                print(f'  {name:>11}: {total * 1000:8.1f}ms total, latency mean {sum(latencies) / len(latencies) * 1000:.2f}ms '
+                      f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:.2f}ms, {len(server.connections)} connections')
+            await SESSIONS.close()
+    finally :
+        await runner.cleanup()
+
+if __name__ == '__main__' :
+    asyncio.run(benchmark(parser.parse_args()))
@@ -48,6 +48,7 @@ class Translator:
     :param timeout: Definition of timeout for httpx library.
                     Will be used for every request.
     :type timeout: number or a double of numbers
+    :param pool_limits: connection limits of the httpx client.
     :param proxies: proxies configuration.
                     Dictionary mapping protocol or protocol and host to the URL of the proxy
                     For example ``{'http': 'foo.bar:3128', 'http://host.name': 'foo.bar:4012'}``
@@ -61,10 +62,14 @@ class Translator:
                  raise_exception=DEFAULT_RAISE_EXCEPTION,
                  proxies: typing.Dict[str, httpcore.AsyncHTTPTransport] = None,
                  timeout: Timeout = None,
+                 pool_limits: httpx.PoolLimits = None,
                  http2=True,
                  use_fallback=False):
 
-        self.client = httpx.AsyncClient(http2=http2)
+        if pool_limits is not None:
+            self.client = httpx.AsyncClient(http2=http2, pool_limits=pool_limits)
+        else:
+            self.client = httpx.AsyncClient(http2=http2)
         if proxies is not None:  # pragma: nocover
             self.client.proxies = proxies
 
@@ -0,0 +1,127 @@
+
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional
+
+def normalize_text(text: str) -> str :
+    """
+    Key of a text in the translation memory, NFKC folds full width punctuation and whitespace runs become one space
+    """
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+class TranslationMemory(object) :
+    """
+    Translations keyed by (translator, src_lang, tgt_lang, normalized text).
+    Recently used entries are kept in an in-process LRU, all entries are kept in an SQLite file if path is given.
+    Entries older than ttl seconds are misses, the file keeps at most max_entries of the most recently used entries.
+    """
+    def __init__(self, path: str = '', lru_size: int = 10000, max_entries: int = 1000000, ttl: float = 30 * 24 * 3600) :
+        self.lru_size = lru_size
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lru = OrderedDict()
+        self.lru_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.puts_since_evict = 0
+        self.db = None
+        if path :
+            self.open(path)
+
+    def open(self, path: str) :
+        if self.db is not None :
+            self.db.close()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS memory (translator TEXT, src_lang TEXT, tgt_lang TEXT, text TEXT, translation TEXT, created REAL, last_used REAL, PRIMARY KEY (translator, src_lang, tgt_lang, text))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS memory_last_used ON memory (last_used)')
+        self.db.commit()
+        self.evict()
+
+    def close(self) :
+        if self.db is not None :
+            self.db.close()
+            self.db = None
+
+    def evict(self) :
+        """
+        Drop expired entries and the least recently used ones above max_entries from the file
+        """
+        self.puts_since_evict = 0
+        if self.db is None :
+            return
+        self.db.execute('DELETE FROM memory WHERE created < ?', (time.time() - self.ttl, ))
+        count = self.db.execute('SELECT COUNT(*) FROM memory').fetchone()[0]
+        if count > self.max_entries :
+            self.db.execute('DELETE FROM memory WHERE rowid IN (SELECT rowid FROM memory ORDER BY last_used LIMIT ?)', (count - self.max_entries, ))
+        self.db.commit()
+
+    def _lru_put(self, key, translation: str, created: float) :
+        self.lru[key] = (translation, created)
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.lru_size :
+            self.lru.popitem(last = False)
+
+    def get(self, translator: str, src_lang: str, tgt_lang: str, texts: List[str]) -> List[Optional[str]] :
+        """
+        Translation of each text, None for misses
+        """
+        now = time.time()
+        result = [None] * len(texts)
+        db_lookup = {}
+        # texts whose last_used is updated in the file, LRU hits too so the file does not evict the entries used most
+        used = []
+        for i, text in enumerate(texts) :
+            key = (translator, src_lang, tgt_lang, normalize_text(text))
+            entry = self.lru.get(key)
+            if entry is not None and entry[1] >= now - self.ttl :
+                self.lru.move_to_end(key)
+                result[i] = entry[0]
+                self.lru_hits += 1
+                used.append(key[3])
+            else :
+                db_lookup.setdefault(key[3], []).append(i)
+        if db_lookup and self.db is not None :
+            keys = list(db_lookup.keys())
+            found = []
+            # stay below the default SQLite limit of 999 query parameters
+            for start in range(0, len(keys), 500) :
+                chunk = keys[start: start + 500]
+                found.extend(self.db.execute(
+                    f'SELECT text, translation, created FROM memory WHERE translator = ? AND src_lang = ? AND tgt_lang = ? AND created >= ? AND text IN ({",".join("?" * len(chunk))})',
+                    (translator, src_lang, tgt_lang, now - self.ttl, *chunk)
+                ).fetchall())
+            for text, translation, created in found :
+                self._lru_put((translator, src_lang, tgt_lang, text), translation, created)
+                for i in db_lookup.pop(text) :
+                    result[i] = translation
+                    self.db_hits += 1
+                used.append(text)
+        if used and self.db is not None :
+            self.db.executemany('UPDATE memory SET last_used = ? WHERE translator = ? AND src_lang = ? AND tgt_lang = ? AND text = ?', [(now, translator, src_lang, tgt_lang, text) for text in set(used)])
+            self.db.commit()
+        self.misses += sum(len(indices) for indices in db_lookup.values())
+        return result
+
+    def put(self, translator: str, src_lang: str, tgt_lang: str, texts: List[str], translations: List[str]) :
+        now = time.time()
+        rows = []
+        for text, translation in zip(texts, translations) :
+            key = (translator, src_lang, tgt_lang, normalize_text(text))
+            self._lru_put(key, translation, now)
+            rows.append((*key, translation, now, now))
+        if self.db is not None and rows :
+            self.db.executemany('INSERT OR REPLACE INTO memory VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.commit()
+            self.puts_since_evict += len(rows)
+            if self.puts_since_evict >= max(self.max_entries // 100, 1) :
+                self.evict()
+
+    @property
+    def hit_rate(self) -> float :
+        total = self.lru_hits + self.db_hits + self.misses
+        return (self.lru_hits + self.db_hits) / total if total else 0.0
+
+    def stats(self) -> str :
+        return f'{self.lru_hits} memory hits, {self.db_hits} file hits, {self.misses} misses, {self.hit_rate * 100:.1f}% hit rate'
@@ -0,0 +1,122 @@
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+class TokenBucket(object) :
+    """
+    Allows rate requests per second on average and bursts of up to burst requests
+    """
+    def __init__(self, rate: float, burst: int) :
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    async def acquire(self) :
+        while True :
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1 :
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class TranslationScheduler(object) :
+    """
+    Texts submitted for the same (translator, src_lang, tgt_lang) within coalesce_delay seconds of each other, by one or many callers,
+    are packed into chunks of at most max_chars characters. Chunks are sent concurrently, each translator limited by its token bucket.
+    A text that is already waiting or being translated is not sent again, its callers all wait for the same result.
+    send(translator, src_lang, tgt_lang, texts) translates texts joined by newlines and returns the translated lines.
+    """
+    def __init__(self, send: Callable[[str, str, str, List[str]], Awaitable[List[str]]], max_chars: Dict[str, int], rate_limits: Dict[str, Tuple[float, int]], coalesce_delay: float = 0.02) :
+        self.send = send
+        self.max_chars = max_chars
+        self.buckets = {translator: TokenBucket(rate, burst) for translator, (rate, burst) in rate_limits.items()}
+        self.coalesce_delay = coalesce_delay
+        # (loop, translator, src_lang, tgt_lang) -> [(text, future)] waiting for the next flush
+        self.pending = {}
+        # (loop, translator, src_lang, tgt_lang, text) -> future of every text waiting or being translated
+        self.in_flight = {}
+        # flushes in progress, asyncio only keeps weak references to tasks
+        self.flushes = set()
+        self.requests = 0
+        self.texts_sent = 0
+        self.texts_shared = 0
+
+    async def translate(self, translator: str, src_lang: str, tgt_lang: str, texts: List[str]) -> List[str] :
+        loop = asyncio.get_running_loop()
+        key = (loop, translator, src_lang, tgt_lang)
+        futures = []
+        for text in texts :
+            future = self.in_flight.get(key + (text, ))
+            if future is None :
+                future = loop.create_future()
+                self.in_flight[key + (text, )] = future
+                future.add_done_callback(lambda _, text_key = key + (text, ) : self.in_flight.pop(text_key, None))
+                if key not in self.pending :
+                    self.pending[key] = []
+                    loop.call_later(self.coalesce_delay, self.start_flush, key)
+                self.pending[key].append((text, future))
+            else :
+                self.texts_shared += 1
+            futures.append(future)
+        # a cancelled caller must not cancel the futures other callers wait for too
+        return list(await asyncio.gather(*[asyncio.shield(future) for future in futures]))
+
+    def chunks(self, translator: str, items: list) -> List[list] :
+        """
+        Split items into chunks whose texts joined by newlines are at most max_chars long, longer texts get a chunk of their own
+        """
+        max_chars = self.max_chars.get(translator, 2000)
+        chunks, size = [[]], 0
+        for item in items :
+            if chunks[-1] and size + 1 + len(item[0]) > max_chars :
+                chunks.append([])
+                size = 0
+            size += len(item[0]) + (1 if len(chunks[-1]) else 0)
+            chunks[-1].append(item)
+        return chunks
+
+    def start_flush(self, key) :
+        task = asyncio.ensure_future(self.flush(key))
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    async def flush(self, key) :
+        items = self.pending.pop(key)
+        _, translator, src_lang, tgt_lang = key
+        await asyncio.gather(*[self.send_chunk(translator, src_lang, tgt_lang, chunk) for chunk in self.chunks(translator, items)])
+
+    async def send_chunk(self, translator: str, src_lang: str, tgt_lang: str, chunk: list) :
+        if translator in self.buckets :
+            await self.buckets[translator].acquire()
+        self.requests += 1
+        self.texts_sent += len(chunk)
+        try :
+            result = await self.send(translator, src_lang, tgt_lang, [text for text, _ in chunk])
+        except Exception as ex :
+            if len(chunk) > 1 :
+                # the chunk may hold texts of several callers, only the texts that cause the error should fail
+                await self.send_one_by_one(translator, src_lang, tgt_lang, chunk)
+                return
+            for _, future in chunk :
+                if not future.done() :
+                    future.set_exception(ex)
+            return
+        if len(result) != len(chunk) :
+            if len(chunk) > 1 :
+                # translated lines can't be matched to texts when their counts differ
+                await self.send_one_by_one(translator, src_lang, tgt_lang, chunk)
+                return
+            result = [' '.join(result)]
+        for (_, future), sentence in zip(chunk, result) :
+            if not future.done() :
+                future.set_result(sentence)
+
+    async def send_one_by_one(self, translator: str, src_lang: str, tgt_lang: str, chunk: list) :
+        await asyncio.gather(*[self.send_chunk(translator, src_lang, tgt_lang, [item]) for item in chunk])
+
+    def stats(self) -> str :
+        return f'{self.requests} requests, {self.texts_sent} texts sent, {self.texts_shared} texts shared with requests already in flight'
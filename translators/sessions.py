@@ -0,0 +1,50 @@
+
+import asyncio
+
+import aiohttp
+import httpx
+
+class SessionPool(object) :
+    """
+    One long lived aiohttp.ClientSession per event loop shared by the translators, so connections are kept alive and reused across requests.
+    A session can only be used on the loop it was made on, web mode translates on a different loop than the batch and demo modes.
+    """
+    def __init__(self, limit_per_host: int = 8, keepalive_timeout: float = 30, total_timeout: float = 60, connect_timeout: float = 10) :
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.total_timeout = total_timeout
+        self.connect_timeout = connect_timeout
+        self.timeout = aiohttp.ClientTimeout(total = total_timeout, connect = connect_timeout)
+        self.sessions = {}
+
+    def get(self) -> aiohttp.ClientSession :
+        loop = asyncio.get_running_loop()
+        # sessions of loops that are gone can not be closed anymore, just forget them
+        for other in [other for other in self.sessions if other is not loop and other.is_closed()] :
+            del self.sessions[other]
+        session = self.sessions.get(loop)
+        if session is None or session.closed :
+            connector = aiohttp.TCPConnector(limit_per_host = self.limit_per_host, keepalive_timeout = self.keepalive_timeout)
+            session = aiohttp.ClientSession(connector = connector, timeout = self.timeout)
+            self.sessions[loop] = session
+        return session
+
+    def httpx_options(self) -> dict :
+        """
+        Limits and timeouts for translators that keep their own httpx.AsyncClient, httpx limits each phase of a request to total_timeout instead of the whole request
+        """
+        return {
+            'timeout': httpx.Timeout(self.total_timeout, connect_timeout = self.connect_timeout),
+            'pool_limits': httpx.PoolLimits(max_keepalive = self.limit_per_host, max_connections = self.limit_per_host),
+        }
+
+    async def close(self) :
+        """
+        Close the session of the running loop
+        """
+        session = self.sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None :
+            await session.close()
+
+# shared by all translators, configure the limits and timeouts here
+SESSIONS = SessionPool()
@@ -0,0 +1,95 @@
+"""
+Translation memory tests against a local fake translator, run from the repository root:
+python -m unittest translators.test_memory
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+import translators
+from .memory import TranslationMemory
+from .scheduler import TranslationScheduler
+
+class FakeTranslator(object) :
+    """
+    Stands in for TranslationScheduler.send, remembers every request it gets
+    """
+    def __init__(self) :
+        self.requests = []
+
+    async def send(self, translator: str, src_lang: str, tgt_lang: str, texts) :
+        self.requests.append(list(texts))
+        return [f'{tgt_lang}:{text}' for text in texts]
+
+class TranslationMemoryTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'memory.db')
+        self.fake = FakeTranslator()
+        self.saved = translators.TRANSLATION_MEMORY, translators.SCHEDULER
+        translators.TRANSLATION_MEMORY = TranslationMemory(self.path)
+        translators.SCHEDULER = TranslationScheduler(self.fake.send, {}, {})
+
+    def tearDown(self) :
+        translators.TRANSLATION_MEMORY.close()
+        translators.TRANSLATION_MEMORY, translators.SCHEDULER = self.saved
+        self.dir.cleanup()
+
+    def dispatch(self, texts, tgt_lang = 'ENG') :
+        return asyncio.run(translators.dispatch('google', 'auto', tgt_lang, texts))
+
+    def test_dedup_within_page(self) :
+        # full width punctuation and extra whitespace normalize to the same key
+        result = self.dispatch(['a', '!?', 'b', '！？', ' a '])
+        self.assertEqual(self.fake.requests, [['a', '!?', 'b']])
+        self.assertEqual(result, ['en:a', 'en:!?', 'en:b', 'en:!?', 'en:a'])
+
+    def test_second_page_sends_only_new_texts(self) :
+        self.dispatch(['a', 'b'])
+        result = self.dispatch(['b', 'c', 'a'])
+        self.assertEqual(self.fake.requests, [['a', 'b'], ['c']])
+        self.assertEqual(result, ['en:b', 'en:c', 'en:a'])
+        # another target language is another key
+        self.dispatch(['a'], 'CHS')
+        self.assertEqual(self.fake.requests[-1], ['a'])
+        self.assertEqual(translators.TRANSLATION_MEMORY.lru_hits, 2)
+
+    def test_file_round_trip(self) :
+        self.dispatch(['a', 'b'])
+        translators.TRANSLATION_MEMORY.close()
+        memory = TranslationMemory(self.path)
+        try :
+            self.assertEqual(memory.get('google', 'auto', 'ENG', ['b', 'a', 'c']), ['en:b', 'en:a', None])
+            self.assertEqual((memory.lru_hits, memory.db_hits, memory.misses), (0, 2, 1))
+            # served from the LRU the second time
+            memory.get('google', 'auto', 'ENG', ['a'])
+            self.assertEqual(memory.lru_hits, 1)
+        finally :
+            memory.close()
+
+    def test_ttl(self) :
+        memory = translators.TRANSLATION_MEMORY
+        memory.put('google', 'auto', 'ENG', ['a'], ['en:a'])
+        memory.ttl = 0.01
+        time.sleep(0.02)
+        self.assertEqual(memory.get('google', 'auto', 'ENG', ['a']), [None])
+        memory.evict()
+        self.assertEqual(memory.db.execute('SELECT COUNT(*) FROM memory').fetchone()[0], 0)
+
+    def test_max_entries_evicts_least_recently_used(self) :
+        memory = translators.TRANSLATION_MEMORY
+        for text in ['a', 'b', 'c'] :
+            memory.put('google', 'auto', 'ENG', [text], [f'en:{text}'])
+            time.sleep(0.01)
+        # an LRU hit counts as a use in the file too
+        self.assertEqual(memory.get('google', 'auto', 'ENG', ['a']), ['en:a'])
+        memory.max_entries = 2
+        memory.evict()
+        rows = memory.db.execute('SELECT text FROM memory ORDER BY text').fetchall()
+        self.assertEqual([text for text, in rows], ['a', 'c'])
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -4,11 +4,11 @@ import uuid
 import hashlib
 import time
 
-import aiohttp
 import time
 
 YOUDAO_URL = 'https://openapi.youdao.com/api'
 from .keys import APP_KEY, APP_SECRET
+from .sessions import SESSIONS
 
 def encrypt(signStr):
 	hash_algorithm = hashlib.sha256()
@@ -25,9 +25,8 @@ def truncate(q):
 
 async def do_request(data):
 	headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-	async with aiohttp.ClientSession() as session:
-		async with session.post(YOUDAO_URL, data=data, headers=headers) as resp:
-			return await resp.json()
+	async with SESSIONS.get().post(YOUDAO_URL, data=data, headers=headers) as resp:
+		return await resp.json()
 
 class Translator(object):
 	def __init__(self):
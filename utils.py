@@ -1,5 +1,5 @@
 
-from typing import List
+from typing import List, Tuple
 import numpy as np
 import cv2
 import functools
@@ -11,7 +11,18 @@ def resize_keep_aspect(img, size) :
     new_width = round(img.shape[1] * ratio)
     new_height = round(img.shape[0] * ratio)
     return cv2.resize(img, (new_width, new_height), interpolation = cv2.INTER_LINEAR_EXACT)
-    
+
+def bilateral_filter_resized(img, max_size) :
+    """
+    Shrink img so its longer side is at most max_size, then bilateral filter it.
+    The filter diameter shrinks with the image, so the result is close to filtering at full size and resizing afterwards.
+    """
+    ratio = min(float(max_size) / max(img.shape[0], img.shape[1]), 1.0)
+    if ratio < 1 :
+        img = cv2.resize(img, (round(img.shape[1] * ratio), round(img.shape[0] * ratio)), interpolation = cv2.INTER_LINEAR)
+    diameter = max((round(17 * ratio) // 2) * 2 + 1, 3)
+    return cv2.bilateralFilter(img, diameter, 80, 80)
+
 def image_resize(image, width = None, height = None, inter = cv2.INTER_AREA):
     # initialize the dimensions of the image to be resized and
     # grab the image size
@@ -284,6 +295,168 @@ class Quadrilateral(object) :
             else :
                 return dist(self.pts[2][0], self.pts[2][1], other.pts[2][0], other.pts[2][1])
 
+class QuadrilateralBatch(object) :
+    """
+    N textlines stored as columns, pts is N x 4 x 2 and colors are N x 3.
+    Derived geometry is computed for all textlines in one pass, indexing with an int gives a Quadrilateral
+    sharing its pts with the batch and with that geometry already in its cached properties.
+    """
+    def __init__(self, pts: np.ndarray, texts: List[str] = None, probs: np.ndarray = None, fg: np.ndarray = None, bg: np.ndarray = None) :
+        self.pts = np.asarray(pts).reshape(-1, 4, 2)
+        n = self.pts.shape[0]
+        self.texts = list(texts) if texts is not None else [''] * n
+        self.probs = np.asarray(probs, dtype = np.float64) if probs is not None else np.zeros(n)
+        self.fg = np.asarray(fg, dtype = np.int64).reshape(n, 3) if fg is not None else np.zeros((n, 3), dtype = np.int64)
+        self.bg = np.asarray(bg, dtype = np.int64).reshape(n, 3) if bg is not None else np.zeros((n, 3), dtype = np.int64)
+
+    @classmethod
+    def from_quadrilaterals(cls, quadrilaterals: List[Quadrilateral]) -> 'QuadrilateralBatch' :
+        return cls(
+            np.array([q.pts for q in quadrilaterals]).reshape(-1, 4, 2),
+            [q.text for q in quadrilaterals],
+            [q.prob for q in quadrilaterals],
+            [(q.fg_r, q.fg_g, q.fg_b) for q in quadrilaterals],
+            [(q.bg_r, q.bg_g, q.bg_b) for q in quadrilaterals]
+        )
+
+    def __len__(self) -> int :
+        return self.pts.shape[0]
+
+    def __iter__(self) :
+        for i in range(len(self)) :
+            yield self[i]
+
+    def __getitem__(self, idx) :
+        if isinstance(idx, (int, np.integer)) :
+            return self._item(int(idx))
+        # slices, index arrays and boolean masks select a smaller batch
+        rows = np.arange(len(self))[idx]
+        return QuadrilateralBatch(self.pts[rows], [self.texts[i] for i in rows], self.probs[rows], self.fg[rows], self.bg[rows])
+
+    def _item(self, i: int) -> Quadrilateral :
+        fg_r, fg_g, fg_b = self.fg[i].tolist()
+        bg_r, bg_g, bg_b = self.bg[i].tolist()
+        q = Quadrilateral(self.pts[i], self.texts[i], float(self.probs[i]), fg_r, fg_g, fg_b, bg_r, bg_g, bg_b)
+        x, y, w, h = self.aabb[i].tolist()
+        # fill the cached properties, polygon and points stay lazy
+        q.__dict__.update(
+            structure = list(self.structure[i]),
+            valid = bool(self.valid[i]),
+            aspect_ratio = self.aspect_ratio[i],
+            font_size = self.font_size[i],
+            aabb = BBox(x, y, w, h, q.text, q.prob, fg_r, fg_g, fg_b, bg_r, bg_g, bg_b),
+            is_axis_aligned = bool(self.is_axis_aligned[i]),
+            is_approximate_axis_aligned = bool(self.is_approximate_axis_aligned[i]),
+            direction = str(self.direction[i]),
+            cosangle = self.cosangle[i],
+            angle = self.angle[i],
+            centroid = self.centroid[i],
+            area = float(self.area[i])
+        )
+        return q
+
+    def to_list(self) -> List[Quadrilateral] :
+        return [self._item(i) for i in range(len(self))]
+
+    def clip(self, width, height) :
+        self.pts[:, :, 0] = np.clip(np.round(self.pts[:, :, 0]), 0, width)
+        self.pts[:, :, 1] = np.clip(np.round(self.pts[:, :, 1]), 0, height)
+        # geometry cached before clipping is stale
+        for name in ['structure', '_edge_vectors', 'font_size', 'aspect_ratio', 'valid', 'direction', 'cosangle', 'angle', 'centroid', 'aabb', 'area', 'is_axis_aligned', 'is_approximate_axis_aligned'] :
+            self.__dict__.pop(name, None)
+
+    @functools.cached_property
+    def structure(self) -> np.ndarray :
+        """
+        N x 4 x 2 midpoints of the edges, in the order of Quadrilateral.structure
+        """
+        p = self.pts
+        return (np.stack([p[:, 0] + p[:, 1], p[:, 2] + p[:, 3], p[:, 1] + p[:, 2], p[:, 3] + p[:, 0]], axis = 1) / 2).astype(int)
+
+    @functools.cached_property
+    def _edge_vectors(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] :
+        """
+        v1 and v2 of Quadrilateral and their lengths, in float32 like the per textline code
+        """
+        s = self.structure.astype(np.float32)
+        v1 = s[:, 1] - s[:, 0]
+        v2 = s[:, 3] - s[:, 2]
+        return v1, v2, np.sqrt((v1 * v1).sum(axis = 1)), np.sqrt((v2 * v2).sum(axis = 1))
+
+    @functools.cached_property
+    def valid(self) -> np.ndarray :
+        v1, v2, n1, n2 = self._edge_vectors
+        with np.errstate(divide = 'ignore', invalid = 'ignore') :
+            angle = np.arccos((v1 * v2).sum(axis = 1) / (n1 * n2)) * 180 / np.pi
+        return np.abs(angle - 90) < 10
+
+    @functools.cached_property
+    def aspect_ratio(self) -> np.ndarray :
+        _, _, n1, n2 = self._edge_vectors
+        with np.errstate(divide = 'ignore', invalid = 'ignore') :
+            return n2 / n1
+
+    @functools.cached_property
+    def font_size(self) -> np.ndarray :
+        _, _, n1, n2 = self._edge_vectors
+        return np.minimum(n1, n2)
+
+    @functools.cached_property
+    def direction(self) -> np.ndarray :
+        _, _, n1, n2 = self._edge_vectors
+        return np.where(n1 > n2, 'v', 'h')
+
+    @functools.cached_property
+    def cosangle(self) -> np.ndarray :
+        v1, _, n1, _ = self._edge_vectors
+        with np.errstate(divide = 'ignore', invalid = 'ignore') :
+            return v1[:, 0] / n1
+
+    @functools.cached_property
+    def angle(self) -> np.ndarray :
+        return np.fmod(np.arccos(self.cosangle) + np.pi, np.pi)
+
+    @functools.cached_property
+    def centroid(self) -> np.ndarray :
+        return self.pts.mean(axis = 1)
+
+    @functools.cached_property
+    def aabb(self) -> np.ndarray :
+        """
+        N x 4 of x, y, w, h
+        """
+        min_coord = self.pts.min(axis = 1)
+        max_coord = self.pts.max(axis = 1)
+        return np.concatenate([min_coord, max_coord - min_coord], axis = 1)
+
+    @functools.cached_property
+    def area(self) -> np.ndarray :
+        """
+        Area of the convex hull of the 4 points, which is half the total area of the 4 triangles they form
+        """
+        p = self.pts.astype(np.float64)
+        def triangle(a, b, c) :
+            return np.abs((p[:, b, 0] - p[:, a, 0]) * (p[:, c, 1] - p[:, a, 1]) - (p[:, c, 0] - p[:, a, 0]) * (p[:, b, 1] - p[:, a, 1])) / 2
+        return (triangle(0, 1, 2) + triangle(0, 1, 3) + triangle(0, 2, 3) + triangle(1, 2, 3)) / 2
+
+    def _unit_axis_dots(self, vectors, norms) :
+        with np.errstate(divide = 'ignore', invalid = 'ignore') :
+            unit = vectors / norms[:, None]
+        return np.abs(unit[:, 1]), np.abs(unit[:, 0])
+
+    @functools.cached_property
+    def is_axis_aligned(self) -> np.ndarray :
+        v1, _, n1, _ = self._edge_vectors
+        d1, d2 = self._unit_axis_dots(v1, n1)
+        return (d1 < 1e-2) | (d2 < 1e-2)
+
+    @functools.cached_property
+    def is_approximate_axis_aligned(self) -> np.ndarray :
+        v1, v2, n1, n2 = self._edge_vectors
+        d1, d2 = self._unit_axis_dots(v1, n1)
+        d3, d4 = self._unit_axis_dots(v2, n2)
+        return (d1 < 0.05) | (d2 < 0.05) | (d3 < 0.05) | (d4 < 0.05)
+
 def dist(x1, y1, x2, y2) :
     return np.sqrt((x1 - x2) * (x1 - x2) + (y1 - y2) * (y1 - y2))
 
@@ -407,6 +580,44 @@ def quadrilateral_can_merge_region_coarse(a: Quadrilateral, b: Quadrilateral, di
         return False
     return True
 
+def candidate_pairs(bboxes: List[Quadrilateral], discard_connection_gap: float) -> List[Tuple[int, int]] :
+    """
+    Pairs (i, j), i < j, of textlines whose aabbs are within discard_connection_gap times the larger font size of each other.
+    Both quadrilateral_can_merge_region and quadrilateral_can_merge_region_coarse reject every other pair, so only these need to be checked.
+    Each aabb is expanded by discard_connection_gap times its own font size and put in the cells of a uniform grid it covers,
+    only textlines sharing a cell are compared.
+    """
+    if len(bboxes) < 2 :
+        return []
+    batch = QuadrilateralBatch(np.array([box.pts for box in bboxes]))
+    x1, y1 = batch.aabb[:, 0].astype(np.float64), batch.aabb[:, 1].astype(np.float64)
+    x2, y2 = x1 + batch.aabb[:, 2], y1 + batch.aabb[:, 3]
+    gap = discard_connection_gap * batch.font_size.astype(np.float64)
+    ex1, ey1, ex2, ey2 = x1 - gap, y1 - gap, x2 + gap, y2 + gap
+    # cells about the size of a typical expanded textline
+    cell = max(float(np.median(np.maximum(ex2 - ex1, ey2 - ey1))), 1.0)
+    cx1, cy1 = np.floor(ex1 / cell).astype(np.int64), np.floor(ey1 / cell).astype(np.int64)
+    cx2, cy2 = np.floor(ex2 / cell).astype(np.int64), np.floor(ey2 / cell).astype(np.int64)
+    grid = {}
+    for i in range(len(bboxes)) :
+        for cx in range(cx1[i], cx2[i] + 1) :
+            for cy in range(cy1[i], cy2[i] + 1) :
+                grid.setdefault((cx, cy), []).append(i)
+    pairs = set()
+    for members in grid.values() :
+        if len(members) > 1 :
+            members = np.array(members)
+            u, v = np.triu_indices(len(members), 1)
+            pairs.update(zip(members[u].tolist(), members[v].tolist()))
+    if not pairs :
+        return []
+    u, v = np.array(sorted(pairs)).T
+    # expanded aabb of either one touches the aabb of the other
+    def touches(a, b) :
+        return (ex1[a] <= x2[b]) & (x1[b] <= ex2[a]) & (ey1[a] <= y2[b]) & (y1[b] <= ey2[a])
+    keep = touches(u, v) | touches(v, u)
+    return list(zip(u[keep].tolist(), v[keep].tolist()))
+
 def findNextPowerOf2(n):
     i = 0
     while n != 0 :
@@ -0,0 +1,102 @@
+"""
+Load test of web_main.py waiting on task state, event driven TaskState against the 50 ms sleep loops it replaced, run from the repository root:
+python web_benchmark.py [--requests 300] [--finish-interval 0.005]
+Requests are pending /run calls against the real app, a stand-in worker takes tasks from the queue and finishes one every --finish-interval seconds.
+"""
+
+import io
+import time
+import shutil
+import asyncio
+import argparse
+
+import aiohttp
+from PIL import Image
+
+import web_main
+
+parser = argparse.ArgumentParser(description = 'Load test event driven task waiting in web_main.py')
+parser.add_argument('--requests', default = 300, type = int, help = 'concurrent /run requests')
+parser.add_argument('--finish-interval', default = 0.005, type = float, help = 'seconds between two tasks finishing')
+parser.add_argument('--idle', default = 2, type = float, help = 'seconds all requests wait before the first task finishes, event loop iterations are counted over this time')
+parser.add_argument('--port', default = 5014, type = int, help = 'port of the app')
+
+class CountingEventLoop(asyncio.SelectorEventLoop) :
+	"""
+	Counts how many times the event loop wakes up
+	"""
+	iterations = 0
+
+	def _run_once(self) :
+		self.iterations += 1
+		super()._run_once()
+
+async def polling_wait_for(self, predicate, timeout = None) :
+	# what /run, /manual-translate and /post-translation-result did before TaskState events
+	loop = asyncio.get_event_loop()
+	deadline = loop.time() + timeout if timeout is not None else None
+	while not predicate(self) and (deadline is None or loop.time() < deadline) :
+		await asyncio.sleep(0.05)
+	return predicate(self)
+
+def percentile(values, p) :
+	values = sorted(values)
+	return values[min(int(len(values) * p), len(values) - 1)]
+
+async def run(args, image) :
+	loop = asyncio.get_event_loop()
+	finished_at = {}
+	latencies = []
+	task_ids = []
+
+	async def client(session) :
+		data = aiohttp.FormData()
+		data.add_field('file', image, filename = 'page.png', content_type = 'image/png')
+		data.add_field('translator', 'null')
+		async with session.post(f'http://127.0.0.1:{args.port}/run', data = data) as resp :
+			task_id = (await resp.json())['task_id']
+		latencies.append(time.perf_counter() - finished_at[task_id])
+		task_ids.append(task_id)
+
+	async def worker() :
+		for _ in range(args.requests) :
+			task_id = web_main.task_dequeued(await web_main.QUEUE.get())
+			await asyncio.sleep(args.finish_interval)
+			finished_at[task_id] = time.perf_counter()
+			web_main.TASKS[task_id].set_state('finished')
+
+	async with aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = 0)) as session :
+		clients = asyncio.gather(*[client(session) for _ in range(args.requests)])
+		while web_main.QUEUE.qsize() < args.requests :
+			await asyncio.sleep(0.01)
+		start, iterations = time.perf_counter(), loop.iterations
+		await asyncio.sleep(args.idle)
+		idle_rate = (loop.iterations - iterations) / (time.perf_counter() - start)
+		start, iterations = time.perf_counter(), loop.iterations
+		await asyncio.gather(clients, worker())
+		busy_rate = (loop.iterations - iterations) / (time.perf_counter() - start)
+	for task_id in task_ids :
+		shutil.rmtree(f'result/{task_id}', ignore_errors = True)
+	web_main.TASKS.clear()
+	return idle_rate, busy_rate, latencies
+
+async def benchmark(args) :
+	stream = io.BytesIO()
+	Image.new('RGB', (64, 64), (255, 255, 255)).save(stream, 'PNG')
+	runner, _ = await web_main.start_async_app('', args.port)
+	event_wait_for = web_main.TaskState.wait_for
+	try :
+		print(f'{args.requests} pending /run requests, one finished every {args.finish_interval * 1000:.1f}ms:')
+		for name, wait_for in [('sleep loop', polling_wait_for), ('events', event_wait_for)] :
+			web_main.TaskState.wait_for = wait_for
+			idle_rate, busy_rate, latencies = await run(args, stream.getvalue())
+			print(f'  {name:>10}: {idle_rate:8.1f} loop iterations/s idle, {busy_rate:8.1f}/s while finishing, '
+			      f'finish to response p50 {percentile(latencies, 0.5) * 1000:.1f}ms p99 {percentile(latencies, 0.99) * 1000:.1f}ms')
+	finally :
+		web_main.TaskState.wait_for = event_wait_for
+		await runner.cleanup()
+
+if __name__ == '__main__' :
+	loop = CountingEventLoop()
+	asyncio.set_event_loop(loop)
+	loop.run_until_complete(benchmark(parser.parse_args()))
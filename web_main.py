@@ -1,5 +1,6 @@
 import io
 import os
+import json
 import sys
 import time
 import asyncio
@@ -12,14 +13,20 @@ from aiohttp import web
 from aiohttp import ClientSession
 from io import BytesIO
 
-from collections import deque
-
-from translators import VALID_LANGUAGES, dispatch as run_translation
+from translators import VALID_LANGUAGES, TRANSLATION_MEMORY, dispatch as run_translation, close as close_translators
 
 NONCE = ''
-QUEUE = deque()
-TASK_DATA = {}
-TASK_STATES = {}
+QUEUE = asyncio.Queue()
+QUEUE_ENQUEUED = 0
+QUEUE_DEQUEUED = 0
+TASKS = {}
+# tasks still waiting in QUEUE, in queue order
+QUEUED_TASKS = {}
+MAX_QUEUE_SIZE = 0
+WORKERS = {}
+WORKER_TIMEOUT = 30
+
+FINISHED_STATES = ['finished', 'error', 'error-lang']
 
 app = web.Application(client_max_size = 1024 * 1024 * 10)
 routes = web.RouteTableDef()
@@ -40,6 +47,150 @@ def convert_img(img) :
 	else :
 		return img.convert('RGB')
 
+class TaskState :
+	"""
+	State of a single translation task, waiters are woken up through an asyncio.Event whenever anything changes
+	"""
+	def __init__(self, task_id, queue_seq, translator = 'youdao', tgt = 'CHS', manual = False) :
+		self.task_id = task_id
+		self.queue_seq = queue_seq
+		self.translator = translator
+		self.tgt = tgt
+		self.manual = manual
+		self.state = 'pending'
+		self.trans_request = None
+		self.trans_result = None
+		self.worker = None
+		self.dequeued_at = None
+		self.changed = asyncio.Event()
+
+	def notify(self) :
+		# wake up current waiters, later waiters wait on a fresh event
+		self.changed.set()
+		self.changed = asyncio.Event()
+
+	def set_state(self, state) :
+		self.state = state
+		self.notify()
+
+	async def wait_for(self, predicate, timeout = None) :
+		loop = asyncio.get_event_loop()
+		deadline = loop.time() + timeout if timeout is not None else None
+		while not predicate(self) :
+			changed = self.changed
+			try :
+				await asyncio.wait_for(changed.wait(), None if deadline is None else max(deadline - loop.time(), 0))
+			except asyncio.TimeoutError :
+				break
+		return predicate(self)
+
+def create_task(task_id, **kwargs) :
+	global QUEUE_ENQUEUED
+	QUEUE_ENQUEUED += 1
+	task = TaskState(task_id, QUEUE_ENQUEUED, **kwargs)
+	TASKS[task_id] = task
+	QUEUED_TASKS[task_id] = task
+	QUEUE.put_nowait(task_id)
+	return task
+
+def queue_full() :
+	return MAX_QUEUE_SIZE > 0 and QUEUE.qsize() >= MAX_QUEUE_SIZE
+
+def task_dequeued(task_id, worker_id = '0') :
+	global QUEUE_DEQUEUED
+	QUEUE_DEQUEUED += 1
+	QUEUED_TASKS.pop(task_id, None)
+	if task_id in TASKS :
+		TASKS[task_id].worker = worker_id
+		TASKS[task_id].dequeued_at = time.time()
+	# queue position of every task still waiting has changed
+	for task in QUEUED_TASKS.values() :
+		task.notify()
+	return task_id
+
+def queue_position(task_id) :
+	# tasks leave QUEUE in FIFO order, so a task's position is how many were enqueued before it and are still waiting
+	if task_id not in TASKS :
+		return 0
+	return max(TASKS[task_id].queue_seq - QUEUE_DEQUEUED, 0)
+
+def set_translation_result(task_id, result) :
+	if task_id in TASKS :
+		TASKS[task_id].trans_result = result
+		TASKS[task_id].notify()
+
+def start_translation(task_id, texts) :
+	if task_id not in TASKS :
+		return
+	task = TASKS[task_id]
+	if task.manual :
+		# manual translation
+		asyncio.gather(manual_trans_task(task_id, texts))
+	else :
+		# using machine trnaslation
+		asyncio.gather(machine_trans_task(task_id, texts, task.translator, task.tgt))
+
+def update_task_state(task_id, state) :
+	if task_id in TASKS :
+		TASKS[task_id].set_state(state)
+		print(f'Task state {task_id} to {state}')
+
+def fail_worker_tasks(worker_id, before = None) :
+	# tasks taken by a worker process that is gone will never finish, before limits it to tasks taken before that time
+	for task in list(TASKS.values()) :
+		if task.worker == worker_id and task.state not in FINISHED_STATES and (before is None or task.dequeued_at < before) :
+			update_task_state(task.task_id, 'error')
+
+def update_worker_health(worker_id, health) :
+	previous = WORKERS.get(worker_id)
+	if previous is not None and previous.get('pid') != health.get('pid') :
+		print(f'Worker {worker_id} was restarted')
+		fail_worker_tasks(worker_id, health.get('started', time.time()))
+	health['last_seen'] = time.time()
+	health['alive'] = True
+	WORKERS[worker_id] = health
+
+async def watch_workers() :
+	while True :
+		await asyncio.sleep(5)
+		for worker_id, health in WORKERS.items() :
+			if health['alive'] and time.time() - health['last_seen'] > WORKER_TIMEOUT :
+				print(f'Worker {worker_id} stopped responding')
+				health['alive'] = False
+				fail_worker_tasks(worker_id)
+
+async def wait_translation_result(task_id) :
+	if task_id not in TASKS :
+		return None
+	task = TASKS[task_id]
+	# wait for at most 1 hour
+	await task.wait_for(lambda t: t.trans_result is not None, 3600)
+	return task.trans_result
+
+class InProcessTaskBroker :
+	"""
+	Hands tasks to an inference worker running in the same process as the web app.
+	The worker may run its own event loop on another thread, all calls are forwarded to the web app's loop.
+	"""
+	def __init__(self, loop) :
+		self.loop = loop
+
+	async def get_task(self, worker_id = '0') :
+		async def get() :
+			return task_dequeued(await QUEUE.get(), worker_id)
+		return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(get(), self.loop))
+
+	def report_health(self, worker_id, health) :
+		self.loop.call_soon_threadsafe(update_worker_health, worker_id, health)
+
+	def update_state(self, task_id, state) :
+		self.loop.call_soon_threadsafe(update_task_state, task_id, state)
+
+	def request_translation(self, task_id, texts) :
+		self.loop.call_soon_threadsafe(start_translation, task_id, texts)
+
+	async def get_translation_result(self, task_id) :
+		return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(wait_translation_result(task_id), self.loop))
 
 @routes.get("/")
 async def index_async(request):
@@ -55,6 +206,8 @@ async def result_async(request):
 
 @routes.post("/run")
 async def run_async(request):
+	if queue_full() :
+		return web.json_response({'status': 'busy'}, status = 503)
 	data = await request.post()
 	size = ''
 	selected_translator = 'youdao'
@@ -91,25 +244,26 @@ async def run_async(request):
 	task_id = crypto_utils.rand_bytes(16).hex() + size
 	os.makedirs(f'result/{task_id}/', exist_ok=True)
 	img.save(f'result/{task_id}/input.png')
-	QUEUE.append(task_id)
-	TASK_DATA[task_id] = {'translator': selected_translator, 'tgt': target_language}
-	TASK_STATES[task_id] = 'pending'
-	while True :
-		await asyncio.sleep(0.05)
-		state = TASK_STATES[task_id]
-		if state == 'finished' :
-			break
+	task = create_task(task_id, translator = selected_translator, tgt = target_language)
+	await task.wait_for(lambda t: t.state in FINISHED_STATES)
+	if task.state != 'finished' :
+		return web.json_response({'task_id' : task_id, 'status': 'failed'})
 	return web.json_response({'task_id' : task_id, 'status': 'successful'})
 
 
 @routes.get("/task-internal")
 async def get_task_async(request):
-	global NONCE
 	if request.rel_url.query['nonce'] == NONCE :
-		if len(QUEUE) > 0 :
-			item = QUEUE.popleft()
-			return web.json_response({'task_id': item})
-		else :
+		worker_id = request.rel_url.query.get('worker', '0')
+		wait = float(request.rel_url.query.get('wait', 0))
+		try :
+			if wait > 0 :
+				# long polling, idle workers wait here in FIFO order
+				item = await asyncio.wait_for(QUEUE.get(), wait)
+			else :
+				item = QUEUE.get_nowait()
+			return web.json_response({'task_id': task_dequeued(item, worker_id)})
+		except (asyncio.QueueEmpty, asyncio.TimeoutError) :
 			return web.json_response({})
 	else :
 		print('unauthorized', request.rel_url.query['nonce'], NONCE)
@@ -120,17 +274,19 @@ async def machine_trans_task(task_id, texts, translator = 'youdao', target_langu
 	print('target_language', target_language)
 	if texts :
 		try :
-			TASK_DATA[task_id]['trans_result'] = await run_translation(translator, 'auto', target_language, texts)
+			set_translation_result(task_id, await run_translation(translator, 'auto', target_language, texts))
 		except Exception as ex :
-			TASK_DATA[task_id]['trans_result'] = ['error'] * len(texts)
+			set_translation_result(task_id, ['error'] * len(texts))
 	else :
-		TASK_DATA[task_id]['trans_result'] = []
+		set_translation_result(task_id, [])
 
 async def manual_trans_task(task_id, texts) :
 	if texts :
-		TASK_DATA[task_id]['trans_request'] = [{'s': txt, 't': ''} for txt in texts]
+		if task_id in TASKS :
+			TASKS[task_id].trans_request = [{'s': txt, 't': ''} for txt in texts]
+			TASKS[task_id].notify()
 	else :
-		TASK_DATA[task_id]['trans_result'] = []
+		set_translation_result(task_id, [])
 		print('manual translation complete')
 
 @routes.post("/post-translation-result")
@@ -138,77 +294,101 @@ async def post_translation_result(request):
 	rqjson = (await request.json())
 	if 'trans_result' in rqjson and 'task_id' in rqjson :
 		task_id = rqjson['task_id']
-		if task_id in TASK_DATA :
+		if task_id in TASKS :
+			task = TASKS[task_id]
 			trans_result = [r['t'] for r in rqjson['trans_result']]
-			TASK_DATA[task_id]['trans_result'] = trans_result
-			while True :
-				await asyncio.sleep(0.1)
-				if TASK_STATES[task_id] in ['error', 'error-lang'] :
-					ret = web.json_response({'task_id' : task_id, 'status': 'failed'})
-					break
-				if TASK_STATES[task_id] == 'finished' :
-					ret = web.json_response({'task_id' : task_id, 'status': 'successful'})
-					break
+			set_translation_result(task_id, trans_result)
+			await task.wait_for(lambda t: t.state in FINISHED_STATES)
 			# remove old tasks
-			del TASK_STATES[task_id]
-			del TASK_DATA[task_id]
-			return ret
+			TASKS.pop(task_id, None)
+			if task.state == 'finished' :
+				return web.json_response({'task_id' : task_id, 'status': 'successful'})
+			return web.json_response({'task_id' : task_id, 'status': 'failed'})
 	return web.json_response({})
 
 @routes.post("/request-translation-internal")
 async def request_translation_internal(request):
-	global NONCE
 	rqjson = (await request.json())
 	if rqjson['nonce'] == NONCE :
-		task_id = rqjson['task_id']
-		if task_id in TASK_DATA :
-			if 'manual' in TASK_DATA[task_id] :
-				# manual translation
-				asyncio.gather(manual_trans_task(task_id, rqjson['texts']))
-			else :
-				# using machine trnaslation
-				asyncio.gather(machine_trans_task(task_id, rqjson['texts'], TASK_DATA[task_id]['translator'], TASK_DATA[task_id]['tgt']))
+		start_translation(rqjson['task_id'], rqjson['texts'])
 	return web.json_response({})
 
 @routes.post("/get-translation-result-internal")
 async def get_translation_internal(request):
-	global NONCE
 	rqjson = (await request.json())
 	if rqjson['nonce'] == NONCE :
 		task_id = rqjson['task_id']
-		if task_id in TASK_DATA :
-			if 'trans_result' in TASK_DATA[task_id] :
-				return web.json_response({'result': TASK_DATA[task_id]['trans_result']})
+		if task_id in TASKS and TASKS[task_id].trans_result is not None :
+			return web.json_response({'result': TASKS[task_id].trans_result})
 	return web.json_response({})
 
+def task_state_json(task) :
+	return {'state': task.state, 'waiting': queue_position(task.task_id)}
+
 @routes.get("/task-state")
 async def get_task_state_async(request):
 	task_id = request.query.get('taskid')
-	if task_id and task_id in TASK_STATES :
-		try :
-			ret = web.json_response({'state': TASK_STATES[task_id], 'waiting': QUEUE.index(task_id) + 1})
-		except :
-			ret = web.json_response({'state': TASK_STATES[task_id], 'waiting': 0})
-		if TASK_STATES[task_id] in ['finished', 'error', 'error-lang'] :
+	if task_id and task_id in TASKS :
+		task = TASKS[task_id]
+		if 'state' in request.query :
+			# long polling, wait until state or queue position differs from what the client already has
+			try :
+				waiting = int(request.query.get('waiting', -1))
+			except ValueError :
+				waiting = -1
+			last = {'state': request.query.get('state'), 'waiting': waiting}
+			await task.wait_for(lambda t: task_state_json(t) != last, 30)
+		ret = web.json_response(task_state_json(task))
+		if task.state in FINISHED_STATES :
 			# remove old tasks
-			del TASK_STATES[task_id]
-			del TASK_DATA[task_id]
+			TASKS.pop(task_id, None)
 		return ret
 	return web.json_response({'state': 'error'})
 
+@routes.get("/task-state-stream")
+async def get_task_state_stream_async(request):
+	task_id = request.query.get('taskid')
+	resp = web.StreamResponse(headers = {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+	await resp.prepare(request)
+	if not task_id or task_id not in TASKS :
+		await resp.write(f'data: {json.dumps({"state": "error"})}\n\n'.encode('utf-8'))
+		return resp
+	task = TASKS[task_id]
+	last = None
+	while True :
+		await task.wait_for(lambda t: task_state_json(t) != last)
+		last = task_state_json(task)
+		await resp.write(f'data: {json.dumps(last)}\n\n'.encode('utf-8'))
+		if task.state in FINISHED_STATES :
+			# remove old tasks
+			TASKS.pop(task_id, None)
+			return resp
+
 @routes.post("/task-update-internal")
 async def post_task_update_async(request):
-	global NONCE
 	rqjson = (await request.json())
 	if rqjson['nonce'] == NONCE :
 		task_id = rqjson['task_id']
-		if task_id in TASK_STATES :
-			TASK_STATES[task_id] = rqjson['state']
-			print(f'Task state {task_id} to {TASK_STATES[task_id]}')
+		update_task_state(task_id, rqjson['state'])
+	return web.json_response({})
+
+@routes.post("/worker-health-internal")
+async def post_worker_health_async(request):
+	rqjson = (await request.json())
+	if rqjson['nonce'] == NONCE :
+		update_worker_health(rqjson['worker_id'], rqjson['health'])
 	return web.json_response({})
 
+@routes.get("/workers")
+async def get_workers_async(request):
+	now = time.time()
+	workers = [dict(health, id = worker_id, last_seen = round(now - health['last_seen'], 1)) for worker_id, health in WORKERS.items()]
+	return web.json_response({'workers': workers, 'queue': QUEUE.qsize(), 'max_queue': MAX_QUEUE_SIZE})
+
 @routes.post("/submit")
 async def submit_async(request):
+	if queue_full() :
+		return web.json_response({'status': 'busy'}, status = 503)
 	data = await request.post()
 	size = ''
 	selected_translator = 'youdao'
@@ -245,13 +425,13 @@ async def submit_async(request):
 	task_id = crypto_utils.rand_bytes(16).hex() + size
 	os.makedirs(f'result/{task_id}/', exist_ok=True)
 	img.save(f'result/{task_id}/input.png')
-	QUEUE.append(task_id)
-	TASK_DATA[task_id] = {'translator': selected_translator, 'tgt': target_language}
-	TASK_STATES[task_id] = 'pending'
+	create_task(task_id, translator = selected_translator, tgt = target_language)
 	return web.json_response({'task_id' : task_id, 'status': 'successful'})
 
 @routes.post("/manual-translate")
 async def manual_translate_async(request):
+	if queue_full() :
+		return web.json_response({'status': 'busy'}, status = 503)
 	data = await request.post()
 	size = ''
 	if 'size' in data :
@@ -278,27 +458,27 @@ async def manual_translate_async(request):
 	task_id = crypto_utils.rand_bytes(16).hex() + size
 	os.makedirs(f'result/{task_id}/', exist_ok=True)
 	img.save(f'result/{task_id}/input.png')
-	QUEUE.append(task_id)
-	TASK_DATA[task_id] = {'manual': True}
-	TASK_STATES[task_id] = 'pending'
-	while True :
-		await asyncio.sleep(0.1)
-		if 'trans_request' in TASK_DATA[task_id] :
-			return web.json_response({'task_id' : task_id, 'status': 'pending', 'trans_result': TASK_DATA[task_id]['trans_request']})
-		if TASK_STATES[task_id] in ['error', 'error-lang'] :
-			break
-		if TASK_STATES[task_id] == 'finished' :
-			# no texts detected
-			return web.json_response({'task_id' : task_id, 'status': 'successful'})
+	task = create_task(task_id, manual = True)
+	await task.wait_for(lambda t: t.trans_request is not None or t.state in FINISHED_STATES)
+	if task.trans_request is not None :
+		return web.json_response({'task_id' : task_id, 'status': 'pending', 'trans_result': task.trans_request})
+	if task.state == 'finished' :
+		# no texts detected
+		return web.json_response({'task_id' : task_id, 'status': 'successful'})
 	return web.json_response({'task_id' : task_id, 'status': 'failed'})
 
 app.add_routes(routes)
 
-async def start_async_app():
+async def on_cleanup(app) :
+	await close_translators()
+
+app.on_cleanup.append(on_cleanup)
+
+async def start_async_app(nonce, port) :
 	# schedule web server to run
 	global NONCE
-	NONCE = sys.argv[1]
-	port = int(sys.argv[2])
+	NONCE = nonce
+	asyncio.ensure_future(watch_workers())
 	runner = web.AppRunner(app)
 	await runner.setup()
 	site = web.TCPSite(runner, '127.0.0.1', port)
@@ -306,11 +486,15 @@ async def start_async_app():
 	print(f"Serving up app on 127.0.0.1:{port}")
 	return runner, site
 
-loop = asyncio.get_event_loop()
-runner, site = loop.run_until_complete(start_async_app())
-
-try:
-	loop.run_forever()
-except KeyboardInterrupt as err:
-	loop.run_until_complete(runner.cleanup())
+if __name__ == '__main__' :
+	loop = asyncio.get_event_loop()
+	if len(sys.argv) > 3 :
+		MAX_QUEUE_SIZE = int(sys.argv[3])
+	if len(sys.argv) > 4 and sys.argv[4] :
+		TRANSLATION_MEMORY.open(sys.argv[4])
+	runner, site = loop.run_until_complete(start_async_app(sys.argv[1], int(sys.argv[2])))
 
+	try:
+		loop.run_forever()
+	except KeyboardInterrupt as err:
+		loop.run_until_complete(runner.cleanup())